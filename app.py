@@ -1,42 +1,87 @@
 from emails.sender import EmailSender
 from emails.receiver import EmailReceiver
+from emails.bulk import BulkDispatcher
 from database import DatabaseManager
+from attachments import AttachmentStore
+from outbox import Outbox, DeliveryWorker
+from pipeline import ResponsePipeline
+from digest import ReplyDigest
+from scheduler import Scheduler, TimeOfDayRule, WindowRule, IntervalRule
 from build.config import Config
+from build.assets import AssetWatcher, FORWARD_IMMEDIATE
+from tenants import DEFAULT_FAMILY, FamilyRouter, load_families
+from metrics import MetricsServer, write_textfile
+from logging_setup import configure_logging
 import logging
-import schedule
 import signal
 import sys
-import time
+import threading
 from datetime import datetime
-
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+from functools import partial
 
 logger = logging.getLogger(__name__)
 
 class FamilyStoriesApp:
     VERSION = "1.0.0"
+    SHUTDOWN_TIMEOUT = 30  # seconds to wait for each group of background threads on stop
     
     def __init__(self, config_file='build/config.yml'):
         self.version = self.VERSION
         self.config = Config(config_file)
-        self.email_sender = EmailSender(
-            smtp_server=self.config.email_settings['smtp_server'],
-            smtp_port=self.config.email_settings['smtp_port'],
-            username=self.config.email_settings['username'],
-            password=self.config.email_settings['password']
+        self.email_sender = EmailSender.from_config(self.config)
+        self.bulk_dispatcher = BulkDispatcher(
+            self.email_sender,
+            max_workers=self.config.email_settings.get('bulk_max_workers', 4),
+            per_domain_rate=self.config.email_settings.get('bulk_per_domain_rate')
         )
-        self.email_receiver = EmailReceiver(self.config)
+        self.last_delivery_report = []
         self.database = DatabaseManager(self.config)
+        self.attachment_store = None
+        if self.config.attachment_settings.get('enabled', True):
+            self.attachment_store = AttachmentStore(
+                self.database,
+                max_bytes=self.config.attachment_settings.get('max_bytes', AttachmentStore.MAX_BYTES),
+                chunk_size=self.config.attachment_settings.get('chunk_size', AttachmentStore.CHUNK_SIZE)
+            )
+        self.email_receiver = EmailReceiver(self.config, database=self.database,
+                                            attachment_store=self.attachment_store)
         self.running = True
+        self.use_imap_idle = self.config.email_settings.get('imap_idle', False)
+        self.stop_event = threading.Event()
+        self.idle_thread = None
+        self.scheduler = Scheduler(
+            max_workers=self.config.schedule_settings.get('workers', Scheduler.DEFAULT_WORKERS)
+        )
+        
+        self.metrics_server = None
+        self.outbox = None
+        self.delivery_threads = []
+        if self.config.outbox_settings.get('enabled', False):
+            self.outbox = Outbox(
+                self.database,
+                lease_seconds=self.config.outbox_settings.get('lease_seconds', Outbox.LEASE_SECONDS)
+            )
         
-        self.questions = self.config.load_questions()
-        self.quotes = self.config.load_quotes()
-        self.family_members = self.config.load_family_members()
-        self.current_question_index = self.database.get_or_create_question_index()
+        # Every family shares this process's Mongo client, SMTP pool, IMAP session and scheduler
+        self.families = load_families(self.config, self.database)
+        self.default_family = next(iter(self.families.values()))
+        self.router = FamilyRouter(self.families)
+        self.asset_watcher = AssetWatcher(self.config.assets)
+        for family in self.families.values():
+            family.watch_assets(self.asset_watcher)
+        
+        pipeline_settings = self.config.pipeline_settings
+        self.pipeline = ResponsePipeline(
+            self.email_sender,
+            self.database,
+            queue_emails=self.queue_response_emails if self.outbox is not None else None,
+            parse_workers=pipeline_settings.get('parse_workers', ResponsePipeline.PARSE_WORKERS),
+            store_batch_size=pipeline_settings.get('store_batch_size', ResponsePipeline.STORE_BATCH_SIZE),
+            fanout_workers=pipeline_settings.get('fanout_workers', ResponsePipeline.FANOUT_WORKERS),
+            queue_size=pipeline_settings.get('queue_size', ResponsePipeline.QUEUE_SIZE)
+        )
+        self.pipeline.start(self.stop_event)
+        self.digest = ReplyDigest(self.database, self.email_sender, outbox=self.outbox)
         
         # Set up signal handlers
         signal.signal(signal.SIGTERM, self._signal_handler)
@@ -44,145 +89,253 @@ class FamilyStoriesApp:
 
     def _signal_handler(self, signum, frame):
         """Handle shutdown signals"""
-        logger.info(f"Received signal {signum}")
+        logger.info("Received signal %s", signum)
         self.stop()
 
-    def send_weekly_question(self):
+    def send_weekly_question(self, family_id=None):
+        """Send one family's weekly question (the first family's by default)"""
+        family = self.families[family_id] if family_id else self.default_family
         try:
-            current_question = self.questions[self.current_question_index]
-            current_quote = self.quotes[self.current_question_index % len(self.quotes)]
+            index, current_question, current_quote = family.current_selection()
             
             # Send to each family member who has receive_questions set to True
-            success = True
-            for member in self.family_members:
-                # Skip members who don't want to receive questions
-                if not member.get('receive_questions', True):
-                    logger.info(f"Skipping {member['email']} as they opted out of weekly questions")
-                    continue
-                    
-                try:
-                    self.email_sender.send_weekly_question(
-                        recipient_email=member['email'],
-                        recipient_name=member['name'],
-                        questioner_name=current_question['questioner'],
-                        question=current_question['question'],
-                        quote=current_quote['quote'],
-                        quote_author=current_quote['author'],
-                        question_number=self.current_question_index + 1
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to send email to {member['email']}: {str(e)}")
-                    success = False
+            recipients = family.members.question_recipients()
+            
+            if self.outbox is not None:
+                return self.queue_weekly_question(family, recipients, current_question, current_quote, index + 1)
+            
+            report = self.bulk_dispatcher.send_weekly_question(
+                recipients,
+                questioner_name=current_question['questioner'],
+                question=current_question['question'],
+                quote=current_quote['quote'],
+                quote_author=current_quote['author'],
+                question_number=index + 1,
+                reply_to=family.reply_to,
+                msgid_token=family.msgid_token
+            )
+            self.last_delivery_report = report
+            
+            failed = [result for result in report if result['status'] != 'sent']
+            for result in failed:
+                logger.error("Failed to send email to %s: %s", result['email'], result['error'])
+            
+            # One bad address shouldn't hold the whole family on last week's question
+            success = len(failed) < len(report) or not report
             
             if success:
-                self.advance_question()
+                family.advance_question()
             return success
             
         except Exception as e:
-            logger.error(f"Error sending weekly question: {str(e)}")
+            logger.error("Error sending weekly question for %s: %s", family.id, e)
             return False
 
+    @staticmethod
+    def _weekly_rule(family):
+        """When the family's weekly question goes out (Sunday at 6 AM unless it says otherwise)"""
+        weekly = family.weekly_question
+        return TimeOfDayRule(weekly.get('at', '06:00'), days=weekly.get('day', 'sunday'), timezone=family.timezone)
+
+    def queue_weekly_question(self, family, recipients, current_question, current_quote, question_number):
+        """Queue the weekly question in the outbox and advance once it is durably queued"""
+        # Keyed by family, the latest scheduled send slot and recipient. A run between
+        # slots (a restart, the startup send) catches up on the slot that just passed,
+        # or finds its jobs already queued and sends nothing; the next slot is left alone.
+        slot = self._weekly_rule(family).last_at_or_before()
+        prefix = 'weekly' if family.id == DEFAULT_FAMILY else f"weekly:{family.id}"
+        queued = self.outbox.enqueue_many([
+            (f"{prefix}:{slot:%Y-%m-%dT%H:%M}:{member['email'].lower()}", 'weekly_question', member['email'], {
+                'family_id': family.id,
+                'reply_to': family.reply_to,
+                'msgid_token': family.msgid_token,
+                'recipient_name': member['name'],
+                'questioner_name': current_question['questioner'],
+                'question': current_question['question'],
+                'quote': current_quote['quote'],
+                'quote_author': current_quote['author'],
+                'question_number': question_number
+            })
+            for member in recipients
+        ])
+        logger.info("Queued weekly question #%s for %s recipients in %s", question_number, queued, family.id)
+        if queued:
+            family.advance_question()
+        else:
+            # This week's broadcast was already queued; advancing again would skip a question
+            logger.info("Weekly question for %s was already queued for %s, not advancing", family.id, slot)
+        return True
+
+    def queue_response_emails(self, response, result, sender_name, question, family):
+        """Queue the confirmation and forwards for a stored response"""
+        key = result['message_id']
+        jobs = [(f"confirmation:{key}", 'confirmation', response['email'], {
+            'recipient_name': sender_name,
+            'question': question
+        })]
+        for member in family.members.forward_recipients(exclude=response['email'], mode=FORWARD_IMMEDIATE):
+            jobs.append((f"forward:{key}:{member['email']}", 'forward', member['email'], {
+                'response_key': key,
+                'sender_email': response['email'],
+                'sender_name': sender_name,
+                'response_text': response['response_text'],
+                'question': question,
+                'attachments': response.get('attachments')
+            }))
+        queued = self.outbox.enqueue_many(jobs)
+        logger.info("Queued %s emails for response from %s", queued, response['email'])
+
+    def send_digest(self, family_id=None):
+        """Send the reply digest to members of a family who chose digest delivery"""
+        family = self.families.get(family_id or DEFAULT_FAMILY, self.default_family)
+        try:
+            return self.digest.send(family, family.digest.get('every', 'daily'))
+        except Exception as e:
+            logger.error("[%s] Failed to send reply digest: %s", family.id, e)
+            return 0
+
+    def start_delivery_workers(self):
+        """Start outbox delivery workers on background threads"""
+        for index in range(self.config.outbox_settings.get('workers', 2)):
+            worker = DeliveryWorker(
+                self.outbox,
+                self.email_sender,
+                poll_interval=self.config.outbox_settings.get('poll_interval', DeliveryWorker.POLL_INTERVAL)
+            )
+            thread = threading.Thread(target=worker.run, args=(self.stop_event,), name=f'outbox-worker-{index}', daemon=True)
+            thread.start()
+            self.delivery_threads.append(thread)
+        logger.info("Started %s outbox delivery workers", len(self.delivery_threads))
+
     def check_email_responses(self):
         try:
             logger.info("Checking for email responses...")
             responses = self.email_receiver.check_responses()
-            logger.info(f"Found {len(responses)} new responses")
-            
-            current_question = self.questions[self.current_question_index]
-            
-            for response in responses:
-                logger.info(f"Processing response from {response['email']}")
-                # Add current question to the response storage
-                self.database.store_response(
-                    email=response['email'],
-                    response_text=response['response_text'],
-                    timestamp=response['timestamp'],
-                    question=current_question
-                )
-                logger.info(f"Successfully stored response from {response['email']} in database")
-                
-                # Get the sender's name
-                sender_name = self.database.get_family_member_name(response['email'])
-                if not sender_name:
-                    sender_name = 'Family Member'
-                
-                try:
-                    # Send confirmation email to the responder
-                    self.email_sender.send_confirmation(
-                        response['email'],
-                        sender_name,
-                        current_question['question']  # Use actual question text
-                    )
-                    logger.info(f"Sent confirmation email to {response['email']}")
-                except Exception as e:
-                    logger.error(f"Failed to send confirmation email: {str(e)}")
-                
-                try:
-                    # Forward the response to family members who have receive_forwards set to True (except the sender)
-                    recipients = [member for member in self.family_members 
-                                 if member['email'] != response['email'] and 
-                                 member.get('receive_forwards', True)]
-                    if recipients:
-                        self.email_sender.forward_response(
-                            sender_email=response['email'],
-                            sender_name=sender_name,
-                            response_text=response['response_text'],
-                            question=current_question['question'],
-                            recipients=recipients
-                        )
-                        logger.info(f"Forwarded response from {response['email']} to {len(recipients)} recipients")
-                except Exception as e:
-                    logger.error(f"Failed to forward response: {str(e)}")
-                    
+            self.process_responses(responses)
+            # Only move the mailbox high-water mark once everything is stored
+            self.email_receiver.commit_sync()
         except Exception as e:
-            logger.error(f"Error checking responses: {str(e)}")
+            logger.error("Error checking responses: %s", e)
             raise
 
+    def process_responses(self, responses):
+        """Run responses through the pipeline; returns once they are all stored.
+
+        Confirmations and forwards carry on in the background.
+        """
+        try:
+            batch = self.pipeline.submit([(response, self.router.route(response)) for response in responses])
+            batch.wait_stored()
+            return batch
+        except Exception as e:
+            logger.error("Error processing responses: %s", e)
+            raise
+
+    def start_idle_listener(self):
+        """Listen for replies with IMAP IDLE on a background thread instead of polling"""
+        self.idle_thread = threading.Thread(
+            target=self.email_receiver.listen,
+            args=(self.process_responses, self.stop_event),
+            name='imap-idle',
+            daemon=True
+        )
+        self.idle_thread.start()
+        logger.info("Started IMAP IDLE listener for responses")
+
     def stop(self):
+        """Stop every background thread, then close the SMTP pool and the database client"""
+        if not self.running:
+            return
         logger.info("Stopping application...")
         self.running = False
+        self.stop_event.set()
+        self.scheduler.stop()
+        # Fails replies still in flight, so a job waiting on them returns instead of hanging
+        self.pipeline.stop(timeout=self.SHUTDOWN_TIMEOUT)
+        for thread in self.delivery_threads + ([self.idle_thread] if self.idle_thread else []):
+            thread.join(self.SHUTDOWN_TIMEOUT)
+        if not self.scheduler.wait_idle(self.SHUTDOWN_TIMEOUT):
+            logger.warning("Scheduled jobs still running after %s seconds", self.SHUTDOWN_TIMEOUT)
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        # Nothing that uses them is still running
+        self.email_sender.close()
         self.database.close()
-        schedule.clear()
-
-    def advance_question(self):
-        if not self.questions:
-            logger.error("Cannot advance question: No questions loaded")
-            return False
-        
-        self.current_question_index = (self.current_question_index + 1) % len(self.questions)
-        self.database.update_question_index(
-            self.current_question_index,
-            self.questions[self.current_question_index]
-        )
-        return True
 
     def run(self):
         """Main entry point to run the application"""
         try:
-            # Schedule weekly question sending (Sunday at 6 AM)
-            schedule.every().sunday.at("06:00").do(self.send_weekly_question)
-            logger.info("Scheduled weekly questions for Sunday at 06:00")
+            settings = self.config.schedule_settings
+            timezone = settings.get('timezone')
+            
+            # Schedule weekly question sending (Sunday at 6 AM unless a family says otherwise)
+            for family in self.families.values():
+                self.scheduler.add(
+                    'weekly_question' if family.id == DEFAULT_FAMILY else f'weekly_question:{family.id}',
+                    self._weekly_rule(family),
+                    partial(self.send_weekly_question, family.id)
+                )
+            
+            # Reply digests for members with ForwardMode=digest, hourly on the hour or daily
+            for family in self.families.values():
+                digest = family.digest
+                if str(digest.get('every', 'daily')).lower() == 'hourly':
+                    digest_rule = WindowRule(60, timezone=family.timezone)
+                else:
+                    digest_rule = TimeOfDayRule(digest.get('at', '19:00'), timezone=family.timezone)
+                self.scheduler.add(
+                    'reply_digest' if family.id == DEFAULT_FAMILY else f'reply_digest:{family.id}',
+                    digest_rule,
+                    partial(self.send_digest, family.id)
+                )
+            
+            # Response checking every 15 minutes, but only between 6 AM and 10 PM, as one rule
+            checks = settings.get('response_check') or {}
+            check_rule = WindowRule(
+                checks.get('every_minutes', 15),
+                start=checks.get('start', '06:00'),
+                end=checks.get('end', '22:00'),
+                timezone=timezone
+            )
+            if self.use_imap_idle:
+                self.start_idle_listener()
+            else:
+                self.scheduler.add('check_email_responses', check_rule, self.check_email_responses)
+            
+            # Pick up edits to the asset CSVs without a restart
+            reload_interval = self.config.asset_settings.get('reload_interval', 30)
+            if reload_interval:
+                self.scheduler.add('reload_assets', IntervalRule(reload_interval), self.asset_watcher.poll)
+            
+            # Expose counters and latency histograms for Prometheus
+            metrics_settings = self.config.metrics_settings
+            if metrics_settings.get('port'):
+                self.metrics_server = MetricsServer(metrics_settings['port']).start()
+            if metrics_settings.get('textfile'):
+                self.scheduler.add(
+                    'write_metrics',
+                    IntervalRule(metrics_settings.get('textfile_interval', 60)),
+                    partial(write_textfile, metrics_settings['textfile'])
+                )
+            
+            # Close SMTP sessions that have sat idle past the pool timeout
+            self.scheduler.add('close_idle_smtp', IntervalRule(5 * 60), self.email_sender.pool.close_idle)
             
-            # Schedule response checking every 15 minutes, but only between 6 AM and 10 PM
-            for hour in range(6, 22):  # 6 AM to 10 PM
-                for minute in [0, 15, 30, 45]:
-                    schedule.every().day.at(f"{hour:02d}:{minute:02d}").do(self.check_email_responses)
-            logger.info("Scheduled response checking every 15 minutes between 6 AM and 10 PM")
+            if self.outbox is not None:
+                self.start_delivery_workers()
             
             logger.info("Application started successfully")
             
             # Run email check immediately on startup if within active hours
-            current_hour = datetime.now().hour
-            if 6 <= current_hour < 22:
+            # (the IDLE listener catches up on its own when it connects)
+            if not self.use_imap_idle and check_rule.contains():
                 self.check_email_responses()
             
-            # Main loop
-            while self.running:
-                schedule.run_pending()
-                time.sleep(60)
+            # Main loop; returns as soon as a shutdown signal sets the stop event
+            self.scheduler.run(self.stop_event)
                 
         except Exception as e:
-            logger.error(f"Fatal error in main loop: {str(e)}")
+            logger.error("Fatal error in main loop: %s", e)
             self.stop()
             sys.exit(1)
         
@@ -190,9 +343,12 @@ class FamilyStoriesApp:
         sys.exit(0)
 
 def main():
+    # LOG_LEVEL and LOG_FORMAT=json come from the environment; records are written off the sending threads
+    configure_logging()
     app = FamilyStoriesApp()
     
-    # Send a test email immediately
+    # Send a test email immediately; through the outbox this only catches up on the
+    # latest scheduled slot, so it never takes the next scheduled send's place
     logger.info("Sending test email...")
     success = app.send_weekly_question()
     if success:
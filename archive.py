@@ -0,0 +1,128 @@
+import base64
+import json
+import logging
+from datetime import datetime
+from bson import ObjectId
+
+logger = logging.getLogger(__name__)
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor can't be decoded"""
+
+class StoryArchive:
+    """Read side of the responses collection.
+
+    Lists are newest first and paginated by keyset on (response_date, _id):
+    each page returns an opaque next_cursor, and the following page resumes
+    strictly after it. The cost of a page doesn't grow with how far back the
+    reader has paged, unlike skip/limit. List views leave out response_text
+    unless include_text is set; get() returns the full story.
+    """
+    DEFAULT_PAGE_SIZE = 20
+    MAX_PAGE_SIZE = 100
+    SORT = [("response_date", -1), ("_id", -1)]
+    LIST_PROJECTION = {
+        "family_member_email": 1,
+        "family_member_name": 1,
+        "question_text": 1,
+        "response_date": 1,
+        "family_id": 1
+    }
+
+    def __init__(self, database):
+        self.collection = database.db.responses
+
+    @staticmethod
+    def encode_cursor(document):
+        position = {"d": document["response_date"].isoformat(), "i": str(document["_id"])}
+        return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            position = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            return datetime.fromisoformat(position["d"]), ObjectId(position["i"])
+        except Exception as e:
+            raise InvalidCursor(f"Invalid cursor: {str(e)}")
+
+    @staticmethod
+    def _after(cursor):
+        """Filter for documents that sort strictly after the cursor"""
+        response_date, object_id = StoryArchive.decode_cursor(cursor)
+        return {"$or": [
+            {"response_date": {"$lt": response_date}},
+            {"response_date": response_date, "_id": {"$lt": object_id}}
+        ]}
+
+    def _page(self, query, limit, cursor, include_text):
+        limit = max(1, min(limit or self.DEFAULT_PAGE_SIZE, self.MAX_PAGE_SIZE))
+        if cursor:
+            query = {"$and": [query, self._after(cursor)]} if query else self._after(cursor)
+        projection = None if include_text else self.LIST_PROJECTION
+        try:
+            # One extra document tells us whether there is another page
+            documents = list(self.collection.find(query, projection).sort(self.SORT).limit(limit + 1))
+        except Exception as e:
+            logger.error("Failed to read stories: %s", e)
+            raise
+        has_more = len(documents) > limit
+        documents = documents[:limit]
+        return {
+            "items": documents,
+            "next_cursor": self.encode_cursor(documents[-1]) if has_more else None
+        }
+
+    def list(self, email=None, question=None, since=None, until=None, search=None, family_id=None,
+             limit=DEFAULT_PAGE_SIZE, cursor=None, include_text=False):
+        """One page of stories matching every filter given.
+
+        email and question match exactly; since/until bound response_date
+        (since inclusive, until exclusive); search is a full-text query
+        against response_text; family_id limits it to one family.
+        Returns {'items': [...], 'next_cursor': str or None}.
+        """
+        query = {}
+        if family_id:
+            # Responses stored before families existed have no family_id
+            query["family_id"] = {"$in": [family_id, None]} if family_id == 'default' else family_id
+        if email:
+            query["family_member_email"] = email
+        if question:
+            query["question_text"] = question
+        if since or until:
+            query["response_date"] = {}
+            if since:
+                query["response_date"]["$gte"] = since
+            if until:
+                query["response_date"]["$lt"] = until
+        if search:
+            query["$text"] = {"$search": search}
+        return self._page(query, limit, cursor, include_text)
+
+    def by_member(self, email, **options):
+        """Stories written by one family member"""
+        return self.list(email=email, **options)
+
+    def by_question(self, question, **options):
+        """Everyone's answers to one question"""
+        return self.list(question=question, **options)
+
+    def between(self, since, until, **options):
+        """Stories received in [since, until)"""
+        return self.list(since=since, until=until, **options)
+
+    def search(self, text, **options):
+        """Stories whose text matches a full-text query, newest first"""
+        return self.list(search=text, **options)
+
+    def get(self, response_id):
+        """A single story with its full text, or None"""
+        try:
+            return self.collection.find_one({"_id": ObjectId(response_id)})
+        except Exception as e:
+            logger.error("Failed to get story %s: %s", response_id, e)
+            return None
+
+    def questions(self):
+        """Distinct question texts that have at least one story"""
+        return sorted(question for question in self.collection.distinct("question_text") if question)
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+from datetime import datetime
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+from database import DatabaseManager, MONGO_SECONDS, RESPONSES_STORED
+from schema import MIGRATIONS, SchemaManager
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:  # Motor is optional; the sync DatabaseManager doesn't need it
+    AsyncIOMotorClient = None
+
+logger = logging.getLogger(__name__)
+
+class AsyncDatabaseManager:
+    """asyncio counterpart of DatabaseManager, built on Motor.
+
+    Same methods and return values as DatabaseManager, as coroutines, so
+    database writes can overlap IMAP and SMTP work in one event loop. Scripts
+    and the threaded app keep using DatabaseManager.
+
+        database = await AsyncDatabaseManager.create(config)
+    """
+    MAX_POOL_SIZE = 50
+    DUPLICATE_KEY_ERROR = DatabaseManager.DUPLICATE_KEY_ERROR
+
+    def __init__(self, config=None):
+        if AsyncIOMotorClient is None:
+            raise ImportError("AsyncDatabaseManager needs Motor: pip install motor")
+        if not config or not config.db_settings:
+            raise ValueError("Database configuration is required")
+        self.db_settings = config.db_settings
+        self.client = None
+        self.db = None
+
+    @classmethod
+    async def create(cls, config):
+        """Build and connect a manager"""
+        database = cls(config)
+        await database.connect()
+        return database
+
+    async def connect(self):
+        """Connect and make sure the schema is current"""
+        try:
+            if not self.db_settings.get('mongodb_uri'):
+                raise ValueError("MongoDB URI is missing")
+            logger.info("Connecting to database (async): %s", self.db_settings['database_name'])
+            self.client = AsyncIOMotorClient(
+                self.db_settings['mongodb_uri'],
+                maxPoolSize=self.MAX_POOL_SIZE,
+                waitQueueTimeoutMS=5000,
+                connectTimeoutMS=5000,
+                serverSelectionTimeoutMS=5000,
+                retryWrites=True,
+                retryReads=True
+            )
+            await self.client.admin.command('ping')
+            self.db = self.client[self.db_settings['database_name']]
+            await self.setup_collections()
+            logger.info("Successfully initialized database (async): %s", self.db_settings['database_name'])
+        except Exception as e:
+            logger.error("Failed to connect to MongoDB: %s", e)
+            raise
+
+    def _migrate(self):
+        # Migrations are synchronous and rare; run them on a short-lived client off the event loop
+        client = MongoClient(self.db_settings['mongodb_uri'], serverSelectionTimeoutMS=5000)
+        try:
+            return SchemaManager(client[self.db_settings['database_name']]).migrate()
+        finally:
+            client.close()
+
+    async def setup_collections(self):
+        """Bring collections and indexes up to the current schema version"""
+        version = await self.db.app_state.find_one({"_id": SchemaManager.STATE_ID})
+        if version and version.get("version", 0) >= max(migration.version for migration in MIGRATIONS):
+            return
+        await asyncio.get_running_loop().run_in_executor(None, self._migrate)
+
+    async def close(self):
+        """Close database connection"""
+        if self.client is not None:
+            self.client.close()
+
+    async def get_or_create_question_index(self, family_id=None):
+        """Get the current question index or create it if it doesn't exist"""
+        state_id = DatabaseManager._question_index_id(family_id)
+        result = await self.db.app_state.find_one({"_id": state_id})
+        if result is None:
+            await self.db.app_state.insert_one({"_id": state_id, "current_index": 0})
+            return 0
+        return result.get("current_index", 0)
+
+    async def update_question_index(self, index, question, family_id=None):
+        """Update the current question index"""
+        await self.db.app_state.update_one(
+            {"_id": DatabaseManager._question_index_id(family_id)},
+            {"$set": {"current_index": index, "current_question": dict(question)}},
+            upsert=True
+        )
+
+    async def get_mailbox_state(self):
+        """Get the last processed IMAP UID and the UIDVALIDITY it belongs to"""
+        result = await self.db.app_state.find_one({"_id": "mailbox_sync"})
+        if result is None:
+            return None
+        return {"uidvalidity": result.get("uidvalidity"), "last_uid": result.get("last_uid", 0)}
+
+    async def update_mailbox_state(self, uidvalidity, last_uid):
+        """Record the IMAP high-water mark once responses up to it are stored"""
+        await self.db.app_state.update_one(
+            {"_id": "mailbox_sync"},
+            {"$set": {"uidvalidity": uidvalidity, "last_uid": last_uid, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+    async def get_digest_state(self, family_id=None):
+        """The end of the window the family's last reply digest covered, or None"""
+        with MONGO_SECONDS.time(operation='get_digest_state'):
+            result = await self.db.app_state.find_one({"_id": DatabaseManager._digest_state_id(family_id)})
+        return result.get("covered_until") if result else None
+
+    async def update_digest_state(self, covered_until, family_id=None):
+        """Record that replies up to covered_until have gone out in a digest"""
+        with MONGO_SECONDS.time(operation='update_digest_state'):
+            await self.db.app_state.update_one(
+                {"_id": DatabaseManager._digest_state_id(family_id)},
+                {"$set": {"covered_until": covered_until, "updated_at": datetime.utcnow()}},
+                upsert=True
+            )
+
+    async def store_response(self, email, response_text, timestamp=None, question=None, message_id=None,
+                             raw_text=None, content_type=None):
+        """Store a family member's response in the database"""
+        stored = await self.store_responses([{
+            'email': email,
+            'response_text': response_text,
+            'timestamp': timestamp,
+            'message_id': message_id,
+            'raw_text': raw_text,
+            'content_type': content_type
+        }], question=question)
+        return stored[0]['response_id']
+
+    async def get_family_member_names(self, emails):
+        """Look up names for many email addresses with a single query"""
+        try:
+            cursor = self.db.family_members.find(
+                {'email': {'$in': list(set(emails))}},
+                {'_id': 0, 'email': 1, 'name': 1}
+            )
+            return {member['email']: member['name'] async for member in cursor}
+        except Exception as e:
+            logger.error("Failed to get family member names: %s", e)
+            return {}
+
+    async def get_family_member_name(self, email):
+        """Get family member name from email"""
+        try:
+            member = await self.db.family_members.find_one({'email': email})
+            return member['name'] if member else None
+        except Exception as e:
+            logger.error("Failed to get family member name for %s: %s", email, e)
+            return None
+
+    async def store_responses(self, responses, question=None, names=None, family_id=None):
+        """Store a batch of responses; see DatabaseManager.store_responses"""
+        if not responses:
+            return []
+        try:
+            logger.info("Storing %s responses", len(responses))
+            if names is None:
+                names = await self.get_family_member_names(response['email'] for response in responses)
+
+            documents = DatabaseManager._response_documents(responses, question, names, family_id)
+            duplicates = set()
+            try:
+                with MONGO_SECONDS.time(operation='insert_responses'):
+                    await self.db.responses.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                duplicates = DatabaseManager._duplicate_indexes(e)
+                logger.info("Skipped %s responses that were already stored", len(duplicates))
+
+            raw_documents = DatabaseManager._raw_documents(responses, documents, duplicates)
+            if raw_documents:
+                try:
+                    with MONGO_SECONDS.time(operation='insert_raw_responses'):
+                        await self.db.raw_responses.insert_many(raw_documents, ordered=False)
+                except BulkWriteError as e:
+                    DatabaseManager._duplicate_indexes(e)
+
+            RESPONSES_STORED.inc(len(documents) - len(duplicates), result='stored')
+            RESPONSES_STORED.inc(len(duplicates), result='duplicate')
+            logger.info("Successfully stored %s responses", len(documents) - len(duplicates))
+            return DatabaseManager._store_results(documents, duplicates)
+        except Exception as e:
+            logger.error("Failed to store responses: %s", e)
+            raise
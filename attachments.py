@@ -0,0 +1,173 @@
+import base64
+import binascii
+import hashlib
+import logging
+import quopri
+import re
+import shutil
+import tempfile
+from gridfs import GridFSBucket
+from gridfs.errors import NoFile
+from pymongo.errors import DuplicateKeyError
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ATTACHMENTS_STORED = metrics.counter(
+    'family_stories_attachments_total', 'Reply attachments saved, matched to a file already stored, or that failed to save', ('result',))
+ATTACHMENT_BYTES = metrics.counter(
+    'family_stories_attachment_bytes_total', 'Decoded attachment bytes streamed into GridFS')
+
+_WHITESPACE = re.compile(rb'\s+')
+
+class _Base64Decoder:
+    """Decode base64 fed in arbitrary pieces, carrying partial quads over"""
+
+    def __init__(self):
+        self._pending = b''
+
+    def feed(self, data):
+        data = self._pending + _WHITESPACE.sub(b'', data)
+        usable = len(data) - len(data) % 4
+        self._pending = data[usable:]
+        return base64.b64decode(data[:usable]) if usable else b''
+
+    def close(self):
+        pending, self._pending = self._pending, b''
+        if not pending:
+            return b''
+        # Tolerate senders that leave off the padding
+        return base64.b64decode(pending + b'=' * (-len(pending) % 4))
+
+class _QuotedPrintableDecoder:
+    """Decode quoted-printable a line at a time so escapes are never split"""
+
+    def __init__(self):
+        self._pending = b''
+
+    def feed(self, data):
+        data = self._pending + data
+        cut = data.rfind(b'\n') + 1
+        self._pending = data[cut:]
+        return quopri.decodestring(data[:cut]) if cut else b''
+
+    def close(self):
+        pending, self._pending = self._pending, b''
+        return quopri.decodestring(pending) if pending else b''
+
+class _IdentityDecoder:
+    def feed(self, data):
+        return data
+
+    def close(self):
+        return b''
+
+def decoder_for(encoding):
+    """An incremental decoder for a Content-Transfer-Encoding"""
+    encoding = (encoding or '7bit').lower()
+    if encoding == 'base64':
+        return _Base64Decoder()
+    if encoding == 'quoted-printable':
+        return _QuotedPrintableDecoder()
+    return _IdentityDecoder()
+
+class AttachmentStore:
+    """Reply attachments in GridFS, stored once per distinct content.
+
+    Parts are decoded as they are downloaded and hashed on the way into a
+    spooled temporary file, so a large photo or voice memo never has to be
+    held in memory. Only content whose SHA-256 isn't stored yet is uploaded;
+    a unique index on metadata.sha256 (schema migration 5) keeps two
+    concurrent uploads of the same file from both surviving.
+    """
+    BUCKET = 'attachments'
+    CHUNK_SIZE = 255 * 1024  # GridFS chunk size
+    SPOOL_BYTES = 1024 * 1024  # decoded bytes kept in memory before spilling to disk
+    MAX_BYTES = 50 * 1024 * 1024  # per attachment, as encoded on the wire
+
+    def __init__(self, database, max_bytes=MAX_BYTES, chunk_size=CHUNK_SIZE):
+        self.db = database.db
+        self.bucket = GridFSBucket(self.db, bucket_name=self.BUCKET, chunk_size_bytes=chunk_size)
+        self.files = self.db[f"{self.BUCKET}.files"]
+        self.max_bytes = max_bytes
+
+    def _existing(self, sha256):
+        return self.files.find_one({"metadata.sha256": sha256}, {"_id": 1})
+
+    def save(self, chunks, filename=None, content_type=None, encoding=None):
+        """Stream encoded body chunks into GridFS, decoding as they arrive.
+
+        Returns a reference to store with the response: file_id, filename,
+        content_type, length and sha256.
+        """
+        try:
+            return self._save(chunks, filename, content_type, encoding)
+        except Exception:
+            ATTACHMENTS_STORED.inc(result='failed')
+            raise
+
+    def _save(self, chunks, filename, content_type, encoding):
+        decoder = decoder_for(encoding)
+        digest = hashlib.sha256()
+        length = 0
+        with tempfile.SpooledTemporaryFile(max_size=self.SPOOL_BYTES) as spool:
+            try:
+                for chunk in chunks:
+                    data = decoder.feed(chunk)
+                    if data:
+                        digest.update(data)
+                        spool.write(data)
+                        length += len(data)
+                data = decoder.close()
+                if data:
+                    digest.update(data)
+                    spool.write(data)
+                    length += len(data)
+            except (binascii.Error, ValueError) as e:
+                raise ValueError(f"Could not decode attachment {filename}: {str(e)}")
+
+            sha256 = digest.hexdigest()
+            existing = self._existing(sha256)
+            if existing is None:
+                spool.seek(0)
+                file_id, existing = self._upload(spool, filename, content_type, sha256)
+        if existing is None:
+            ATTACHMENTS_STORED.inc(result='stored')
+            ATTACHMENT_BYTES.inc(length)
+        else:
+            file_id = existing["_id"]
+            ATTACHMENTS_STORED.inc(result='duplicate')
+            logger.info("Attachment %s is already stored as %s", filename, file_id)
+
+        return {
+            "file_id": file_id,
+            "filename": filename,
+            "content_type": content_type,
+            "length": length,
+            "sha256": sha256
+        }
+
+    def _upload(self, source, filename, content_type, sha256):
+        """Upload new content: (file_id, None), or (None, existing file) when another upload won"""
+        upload = self.bucket.open_upload_stream(
+            filename or 'attachment',
+            metadata={"content_type": content_type, "sha256": sha256}
+        )
+        try:
+            shutil.copyfileobj(source, upload, self.CHUNK_SIZE)
+            upload.close()
+        except DuplicateKeyError:
+            # The same content was stored between our lookup and upload; drop our chunks
+            self.db[f"{self.BUCKET}.chunks"].delete_many({"files_id": upload._id})
+            return None, self._existing(sha256)
+        except Exception:
+            upload.abort()
+            raise
+        return upload._id, None
+
+    def open(self, file_id):
+        """A readable GridOut for a stored attachment, or None"""
+        try:
+            return self.bucket.open_download_stream(file_id)
+        except NoFile:
+            return None
@@ -0,0 +1,363 @@
+"""End-to-end benchmarks for the three paths that do the work.
+
+    python -m benchmarks.run --sizes 10,1000,10000 --output bench.json
+
+Each (size, path) runs FamilyStoriesApp in a fresh process against a local
+SMTP sink, a seeded IMAP mailbox and mongomock (or --mongo-uri for a scratch
+mongod), so peak RSS is that path's own. Paths:
+
+  send_weekly_question   the weekly broadcast to <size> recipients
+  check_email_responses  fetch, store and fan out <size> replies
+  store_response         <size> single DatabaseManager.store_response calls
+
+Results are one JSON document on stdout (or --output) with throughput,
+p50/p99 latency, SMTP/IMAP/Mongo round-trips and peak RSS per path.
+"""
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import yaml
+
+from benchmarks.servers import SMTPSink, IMAPMailbox, synthetic_reply
+
+logger = logging.getLogger(__name__)
+
+PATHS = ('send_weekly_question', 'check_email_responses', 'store_response')
+DEFAULT_SIZES = (10, 1000, 10000)
+FORWARD_MEMBERS = 2  # members with receive_forwards set; each reply fans out to them
+MEMBER_DOMAINS = 20
+BENCH_USERNAME = 'stories@bench.local'
+QUESTION_SUBJECT = 'Family Stories - Weekly Question #01'
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+def member_email(index):
+    return f"member{index}@family{index % MEMBER_DOMAINS}.example"
+
+def write_assets(directory, size):
+    """Members, questions and quotes CSVs for a family of the given size"""
+    paths = {name: os.path.join(directory, f"{name}.csv") for name in ('members', 'questions', 'quotes')}
+    with open(paths['members'], 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Name', 'Email', 'ReceiveForwards', 'ReceiveQuestions'])
+        for index in range(size):
+            writer.writerow([f"Member {index}", member_email(index), int(index < FORWARD_MEMBERS), 1])
+    with open(paths['questions'], 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Question', 'Questioner'])
+        writer.writerow(['What was your first job?', 'Member 0'])
+        writer.writerow(['Where did you grow up?', 'Member 1'])
+    with open(paths['quotes'], 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Quote', 'Author'])
+        writer.writerow(['There is no greater agony than bearing an untold story inside you.', 'Maya Angelou'])
+    return paths
+
+def write_config(directory, assets, smtp_port, imap_port):
+    """The repo's config.yml pointed at the stand-ins, with one family on the generated assets"""
+    with open(os.path.join(REPO_ROOT, 'build', 'config.yml'), 'r') as file:
+        config = yaml.safe_load(file)
+    config['email'].update({
+        'smtp_server': '127.0.0.1',
+        'smtp_port': smtp_port,
+        'smtp_starttls': False,
+        'imap_server': '127.0.0.1',
+        'imap_port': imap_port,
+        'imap_ssl': False,
+        'imap_idle': False,
+        # Measure our own cost, not the politeness delay towards real providers
+        'bulk_per_domain_rate': None
+    })
+    config['outbox'] = dict(config.get('outbox') or {}, enabled=False)
+    config['assets'] = {'snapshot_dir': None, 'reload_interval': 0}
+    config['families'] = [{
+        'id': 'bench',
+        'members': assets['members'],
+        'questions': assets['questions'],
+        'quotes': assets['quotes']
+    }]
+    path = os.path.join(directory, 'config.yml')
+    with open(path, 'w') as file:
+        yaml.safe_dump(config, file)
+    return path
+
+def expected_deliveries(size):
+    """Messages one check sends: a confirmation per reply, plus forwards to everyone but the sender"""
+    forwards = sum(FORWARD_MEMBERS - (1 if index < FORWARD_MEMBERS else 0) for index in range(size))
+    return size + forwards
+
+class _MongoCounter:
+    """pymongo command listener counting round-trips to the server"""
+
+    def __init__(self):
+        from pymongo import monitoring
+
+        class Listener(monitoring.CommandListener):
+            def started(listener, event):
+                self.commands += 1
+
+            def succeeded(listener, event):
+                pass
+
+            def failed(listener, event):
+                pass
+
+        self.commands = 0
+        self.listener = Listener()
+
+def _patch_mongo(mongo_uri):
+    """Point DatabaseManager at mongomock or a scratch mongod; returns a Mongo round-trip counter or None"""
+    import database
+
+    if not mongo_uri:
+        import mongomock
+        import mongomock.gridfs
+        # Attachments go through GridFS, which mongomock only supports once patched in
+        mongomock.gridfs.enable_gridfs_integration()
+        database.MongoClient = lambda uri, **options: mongomock.MongoClient()
+        return None
+
+    from pymongo import MongoClient
+    counter = _MongoCounter()
+    # Config always builds an authenticated URI; a scratch mongod takes the one given instead
+    database.MongoClient = lambda uri, **options: MongoClient(mongo_uri, event_listeners=[counter.listener], **options)
+    return counter
+
+def _reset_peak_rss():
+    """Forget the high-water mark a spawned child starts with.
+
+    On Linux a new process begins with its parent's peak RSS, which here
+    includes the seeded mailbox; clearing it (Linux 4.0+) makes VmHWM the
+    child's own.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_kb(reset):
+    if reset:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == 'darwin' else 1)
+
+def _run_path(path, size, config_file, options, expected, message_counter, results):
+    """Child process: build the app, run one path and put its measurements on the results queue"""
+    peak_reset = _reset_peak_rss()
+    os.environ.update({
+        'EMAIL_USERNAME': BENCH_USERNAME,
+        'EMAIL_PASSWORD': 'bench',
+        'MONGODB_USERNAME': 'bench',
+        'MONGODB_PASSWORD': 'bench',
+        'MONGODB_HOST': '127.0.0.1',
+        'MONGODB_PORT': '27017',
+        'MONGODB_DATABASE': options['database'],
+    })
+    sys.path.insert(0, REPO_ROOT)
+    mongo_counter = _patch_mongo(options['mongo_uri'])
+
+    from app import FamilyStoriesApp
+    from attachments import ATTACHMENTS_STORED
+    from logging_setup import configure_logging
+
+    # Per-message logs at INFO would swamp the timings
+    configure_logging(level=options['log_level'])
+
+    app = FamilyStoriesApp(config_file)
+    if options['mongo_uri']:
+        # Start every run from an empty scratch database
+        for name in ('responses', 'raw_responses', 'app_state'):
+            app.database.db[name].delete_many({})
+        app.database.setup_collections()
+    mongo_before = mongo_counter.commands if mongo_counter else None
+    samples = []
+    started_at = time.time()
+    started = time.perf_counter()
+    try:
+        if path == 'send_weekly_question':
+            if not app.send_weekly_question():
+                raise RuntimeError("send_weekly_question reported failure")
+            samples = [result['elapsed'] for result in app.last_delivery_report]
+        elif path == 'check_email_responses':
+            app.check_email_responses()
+            # Confirmations and forwards go out in the background; wait for the sink to see them all
+            deadline = time.monotonic() + options['timeout']
+            while message_counter.value < expected:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Only {message_counter.value} of {expected} emails arrived")
+                time.sleep(0.01)
+        elif path == 'store_response':
+            family = app.default_family
+            _, question, _ = family.current_selection()
+            text = 'x' * options['reply_bytes']
+            for index in range(size):
+                call_started = time.perf_counter()
+                app.database.store_response(
+                    member_email(index), text, question=question, message_id=f"<store-{index}@bench.local>"
+                )
+                samples.append(time.perf_counter() - call_started)
+        elapsed = time.perf_counter() - started
+    finally:
+        app.stop()
+
+    results.put({
+        'elapsed': elapsed,
+        'started_at': started_at,
+        'samples': samples,
+        'mongo_round_trips': mongo_counter.commands - mongo_before if mongo_counter else None,
+        'peak_rss_kb': _peak_rss_kb(peak_reset),
+        'attachments': {result: ATTACHMENTS_STORED.value(result=result) for result in ('stored', 'duplicate', 'failed')}
+    })
+
+def run_path(path, size, options, context):
+    """Run one path at one size against fresh stand-ins and return its result record"""
+    smtp_commands = context.Value('l', 0)
+    imap_commands = context.Value('l', 0)
+    messages = context.Value('l', 0)
+    sink = SMTPSink(smtp_commands, messages).start()
+    mailbox = IMAPMailbox(imap_commands).start()
+    results = context.Queue()
+    try:
+        with tempfile.TemporaryDirectory(prefix='family-stories-bench-') as directory:
+            assets = write_assets(directory, size)
+            config_file = write_config(directory, assets, sink.port, mailbox.port)
+
+            expected = 0
+            if path == 'check_email_responses':
+                mailbox.seed(
+                    synthetic_reply(member_email(index), BENCH_USERNAME, QUESTION_SUBJECT,
+                                    body_bytes=options['reply_bytes'], attachments=options['attachments'],
+                                    attachment_bytes=options['attachment_bytes'])
+                    for index in range(size)
+                )
+                expected = expected_deliveries(size)
+
+            child = context.Process(
+                target=_run_path,
+                args=(path, size, config_file, options, expected, messages, results),
+                name=f'bench-{path}-{size}'
+            )
+            child.start()
+            try:
+                measured = results.get(timeout=options['timeout'])
+            except Exception:
+                raise RuntimeError(f"{path} at {size} did not finish; see the child's log above")
+            finally:
+                child.join()
+    finally:
+        sink.stop()
+        mailbox.stop()
+
+    if measured['attachments']['failed']:
+        # Timings for a run that dropped attachments would flatter the save path
+        raise RuntimeError(f"{path} at {size}: {measured['attachments']['failed']} attachments failed to save")
+
+    samples = measured['samples']
+    if path == 'check_email_responses':
+        # A reply is done when its confirmation reaches the sink
+        confirmed = {}
+        for recipient, arrived, _ in sink.deliveries:
+            confirmed.setdefault(recipient, arrived)
+        samples = [arrived - measured['started_at'] for arrived in confirmed.values()]
+
+    return {
+        'path': path,
+        'size': size,
+        'seconds': round(measured['elapsed'], 4),
+        'throughput_per_second': round(size / measured['elapsed'], 2) if measured['elapsed'] else None,
+        'latency_ms': {
+            'p50': round(percentile(samples, 0.50) * 1000, 3) if samples else None,
+            'p99': round(percentile(samples, 0.99) * 1000, 3) if samples else None,
+            'max': round(max(samples) * 1000, 3) if samples else None
+        },
+        'round_trips': {
+            'smtp': smtp_commands.value,
+            'imap': imap_commands.value,
+            'mongo': measured['mongo_round_trips']
+        },
+        'emails_delivered': messages.value,
+        'attachments': measured['attachments'],
+        'peak_rss_kb': measured['peak_rss_kb']
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Family Stories against local SMTP/IMAP/Mongo stand-ins")
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help="comma-separated recipient/reply counts")
+    parser.add_argument('--paths', default=','.join(PATHS), help=f"comma-separated subset of {','.join(PATHS)}")
+    parser.add_argument('--reply-bytes', type=int, default=2048, help="size of each reply's new text")
+    parser.add_argument('--attachments', type=int, default=0, help="attachments per seeded reply")
+    parser.add_argument('--attachment-bytes', type=int, default=64 * 1024, help="size of each attachment")
+    parser.add_argument('--mongo-uri', help="scratch mongod to use instead of mongomock; its data is deleted")
+    parser.add_argument('--database', default='family_stories_bench', help="database name on --mongo-uri")
+    parser.add_argument('--timeout', type=float, default=1800, help="seconds before a single run is abandoned")
+    parser.add_argument('--log-level', default='WARNING', help="app log level inside the benchmark")
+    parser.add_argument('--output', help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    sizes = [int(value) for value in args.sizes.split(',') if value.strip()]
+    paths = [value.strip() for value in args.paths.split(',') if value.strip()]
+    unknown = set(paths) - set(PATHS)
+    if unknown:
+        parser.error(f"unknown paths: {', '.join(sorted(unknown))}")
+
+    options = {
+        'reply_bytes': args.reply_bytes,
+        'attachments': args.attachments,
+        'attachment_bytes': args.attachment_bytes,
+        'mongo_uri': args.mongo_uri,
+        'database': args.database,
+        'timeout': args.timeout,
+        'log_level': args.log_level.upper()
+    }
+    # A fresh interpreter per run keeps peak RSS and caches from leaking between paths
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for size in sizes:
+        for path in paths:
+            logger.info("Running %s at %s", path, size)
+            result = run_path(path, size, options, context)
+            logger.info("%s at %s: %s/s, p50 %s ms, p99 %s ms", path, size, result['throughput_per_second'],
+                        result['latency_ms']['p50'], result['latency_ms']['p99'])
+            results.append(result)
+
+    report = {
+        'started_at': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'mongo': 'mongod' if args.mongo_uri else 'mongomock',
+        'options': {key: value for key, value in options.items() if key not in ('mongo_uri', 'log_level')},
+        'results': results
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+        logger.info("Wrote %s results to %s", len(results), args.output)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
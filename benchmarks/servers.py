@@ -0,0 +1,322 @@
+"""Local stand-ins for the SMTP and IMAP servers the app talks to.
+
+Both speak just enough of the protocol for smtplib and imaplib as the app
+uses them, over plain TCP on 127.0.0.1, and count every command they see so
+a benchmark can report round-trips.
+"""
+import email
+import logging
+import re
+import socketserver
+import threading
+import time
+from email.message import EmailMessage
+from email.utils import format_datetime, make_msgid
+
+logger = logging.getLogger(__name__)
+
+NEWLINE = b'\n'
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class _StandIn:
+    """Runs a handler class on a background thread and counts its commands"""
+    handler = None
+
+    def __init__(self, counter=None):
+        # counter is anything with get_lock() and .value, e.g. multiprocessing.Value
+        self.counter = counter
+        self.commands = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def count(self):
+        with self._lock:
+            self.commands += 1
+        if self.counter is not None:
+            with self.counter.get_lock():
+                self.counter.value += 1
+
+    def start(self):
+        server = _Server(('127.0.0.1', 0), self.handler)
+        server.stand_in = self
+        threading.Thread(target=server.serve_forever, name=type(self).__name__, daemon=True).start()
+        self._server = server
+        return self
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def _reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        sink = self.server.stand_in
+        self._reply('220 localhost benchmark sink')
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            sink.count()
+            command = line.decode('ascii', 'replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                self._reply('250-localhost')
+                self._reply('250 AUTH PLAIN LOGIN')
+            elif verb == 'HELO':
+                self._reply('250 localhost')
+            elif verb == 'AUTH':
+                self._reply('235 Authentication successful')
+            elif verb == 'MAIL':
+                recipients = []
+                self._reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(re.search(r'<([^>]*)>', command).group(1))
+                self._reply('250 OK')
+            elif verb == 'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                size = 0
+                bare_lf = False
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data == b'.\r\n':
+                        break
+                    # RFC 5321 2.3.8: a line ends with CRLF; strict servers refuse anything else
+                    bare_lf = bare_lf or not data.endswith(b'\r\n')
+                    size += len(data)
+                if bare_lf:
+                    self._reply('500 Bare LF line endings are not allowed')
+                else:
+                    sink.delivered(recipients, size)
+                    self._reply('250 OK queued')
+                recipients = []
+            elif verb in ('RSET', 'NOOP'):
+                self._reply('250 OK')
+            elif verb == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('502 Command not implemented')
+
+class SMTPSink(_StandIn):
+    """Accepts any login and CRLF-terminated message and throws the message away.
+
+    Keeps (recipient, arrival time, size) for each delivery; message_counter
+    is bumped per message so another process can wait on deliveries.
+    """
+    handler = _SMTPHandler
+
+    def __init__(self, counter=None, message_counter=None):
+        super().__init__(counter)
+        self.message_counter = message_counter
+        self.deliveries = []
+
+    def delivered(self, recipients, size):
+        now = time.time()
+        with self._lock:
+            self.deliveries.extend((recipient, now, size) for recipient in recipients)
+        if self.message_counter is not None:
+            with self.message_counter.get_lock():
+                self.message_counter.value += 1
+
+    def reset(self):
+        with self._lock:
+            self.deliveries = []
+            self.commands = 0
+
+def _quote(value):
+    if value is None:
+        return 'NIL'
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def _bodystructure(part):
+    """Render a parsed message as an IMAP BODYSTRUCTURE"""
+    if part.is_multipart():
+        children = ''.join(_bodystructure(child) for child in part.get_payload())
+        return f'({children} {_quote(part.get_content_subtype().upper())})'
+    main_type, sub_type = part.get_content_type().split('/')
+    params = part.get_params()[1:] if part.get_params() else []
+    params = '(' + ' '.join(f'{_quote(key)} {_quote(value)}' for key, value in params) + ')' if params else 'NIL'
+    payload = _section_bytes(part)
+    encoding = _quote((part.get('Content-Transfer-Encoding') or '7BIT').upper())
+    disposition = 'NIL'
+    if part.get_content_disposition():
+        filename = part.get_filename()
+        filename = f'({_quote("FILENAME")} {_quote(filename)})' if filename else 'NIL'
+        disposition = f'({_quote(part.get_content_disposition().upper())} {filename})'
+    structure = f'({_quote(main_type.upper())} {_quote(sub_type.upper())} {params} NIL NIL {encoding} {len(payload)}'
+    if main_type == 'text':
+        structure += f' {payload.count(NEWLINE)}'
+    return structure + f' NIL {disposition} NIL NIL)'
+
+def _section_bytes(part):
+    payload = part.get_payload(decode=False)
+    return payload.encode('utf-8', 'surrogateescape') if isinstance(payload, str) else payload
+
+def _sections(message, prefix=''):
+    """Map IMAP section numbers ("1", "2.1", ...) to their raw bytes"""
+    sections = {}
+    if not message.is_multipart():
+        sections[prefix or '1'] = _section_bytes(message)
+        return sections
+    for number, child in enumerate(message.get_payload(), 1):
+        section = f'{prefix}.{number}' if prefix else str(number)
+        if child.is_multipart():
+            sections.update(_sections(child, section))
+        else:
+            sections[section] = _section_bytes(child)
+    return sections
+
+class _Message:
+    """A seeded message, parsed once up front so serving it is cheap"""
+
+    def __init__(self, uid, data):
+        parsed = email.message_from_bytes(data)
+        self.uid = uid
+        self.data = data
+        self.headers = parsed
+        self.subject = (parsed['subject'] or '').encode('utf-8')
+        self.bodystructure = _bodystructure(parsed).encode('utf-8')
+        self.sections = _sections(parsed)
+        self.seen = False
+
+class _IMAPHandler(socketserver.StreamRequestHandler):
+    HEADER_FIELDS = re.compile(r'BODY\.PEEK\[HEADER\.FIELDS \(([^)]*)\)\]')
+    PARTIAL = re.compile(r'BODY\.PEEK\[([\d.]+)\]<(\d+)\.(\d+)>')
+
+    def _write(self, data):
+        self.wfile.write(data.encode('utf-8') if isinstance(data, str) else data)
+
+    def _done(self, tag, text='OK done'):
+        self._write(f'{tag} {text}\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        mailbox = self.server.stand_in
+        self._write('* OK [CAPABILITY IMAP4rev1 IDLE] benchmark IMAP ready\r\n')
+        self.wfile.flush()
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            mailbox.count()
+            parts = line.decode('utf-8', 'replace').strip().split(' ', 2)
+            tag, command = parts[0], parts[1].upper() if len(parts) > 1 else ''
+            argument = parts[2] if len(parts) > 2 else ''
+            if command == 'CAPABILITY':
+                self._write('* CAPABILITY IMAP4rev1 IDLE\r\n')
+                self._done(tag)
+            elif command == 'LOGIN':
+                self._done(tag, 'OK [CAPABILITY IMAP4rev1 IDLE] logged in')
+            elif command == 'SELECT':
+                self._write(f'* {len(mailbox.messages)} EXISTS\r\n'
+                            f'* OK [UIDVALIDITY {mailbox.uidvalidity}]\r\n'
+                            f'* OK [UIDNEXT {mailbox.uidnext}]\r\n')
+                self._done(tag, 'OK [READ-WRITE] selected')
+            elif command == 'STATUS':
+                self._write(f'* STATUS "inbox" (UIDVALIDITY {mailbox.uidvalidity} UIDNEXT {mailbox.uidnext})\r\n')
+                self._done(tag)
+            elif command == 'UID':
+                subcommand, rest = argument.split(' ', 1)
+                if subcommand.upper() == 'SEARCH':
+                    self._search(tag, mailbox, rest)
+                elif subcommand.upper() == 'FETCH':
+                    self._fetch(tag, mailbox, rest)
+                else:
+                    self._done(tag, f'BAD unknown UID {subcommand}')
+            elif command in ('NOOP', 'CLOSE', 'EXPUNGE'):
+                self._done(tag)
+            elif command == 'LOGOUT':
+                self._write('* BYE\r\n')
+                self._done(tag)
+                return
+            else:
+                self._done(tag, f'BAD unknown {command}')
+
+    def _search(self, tag, mailbox, criteria):
+        lowest = re.search(r'UID (\d+):\*', criteria)
+        lowest = int(lowest.group(1)) if lowest else 0
+        subject = re.search(r'SUBJECT "([^"]+)"', criteria)
+        subject = subject.group(1).encode('utf-8') if subject else b''
+        unseen = 'UNSEEN' in criteria
+        uids = [message.uid for message in mailbox.messages
+                if message.uid >= lowest and subject in message.subject and not (unseen and message.seen)]
+        self._write('* SEARCH ' + ' '.join(map(str, uids)) + '\r\n')
+        self._done(tag)
+
+    def _fetch(self, tag, mailbox, arguments):
+        uid_set, items = arguments.split(' ', 1)
+        header_fields = self.HEADER_FIELDS.search(items)
+        partial = self.PARTIAL.search(items)
+        for uid in uid_set.split(','):
+            message = mailbox.by_uid.get(int(uid))
+            if message is None:
+                continue
+            output = f'* {message.uid} FETCH (UID {message.uid}'.encode('ascii')
+            if 'BODYSTRUCTURE' in items:
+                output += b' BODYSTRUCTURE ' + message.bodystructure
+            if header_fields:
+                names = header_fields.group(1)
+                headers = ''.join(f'{name}: {message.headers[name]}\r\n'
+                                  for name in names.split() if message.headers[name]) + '\r\n'
+                headers = headers.encode('utf-8')
+                output += f' BODY[HEADER.FIELDS ({names})] {{{len(headers)}}}\r\n'.encode('ascii') + headers
+            if partial:
+                section, offset, length = partial.group(1), int(partial.group(2)), int(partial.group(3))
+                data = message.sections.get(section, b'')[offset:offset + length]
+                output += f' BODY[{section}]<{offset}> {{{len(data)}}}\r\n'.encode('ascii') + data
+            self._write(output + b')\r\n')
+        self._done(tag)
+
+class IMAPMailbox(_StandIn):
+    """A single inbox served over IMAP, seeded with messages up front"""
+    handler = _IMAPHandler
+
+    def __init__(self, counter=None):
+        super().__init__(counter)
+        self.uidvalidity = 1
+        self.messages = []
+        self.by_uid = {}
+
+    @property
+    def uidnext(self):
+        return self.messages[-1].uid + 1 if self.messages else 1
+
+    def seed(self, messages):
+        """Replace the inbox with the given raw messages"""
+        self.uidvalidity += 1
+        self.messages = [_Message(uid, data) for uid, data in enumerate(messages, 1)]
+        self.by_uid = {message.uid: message for message in self.messages}
+
+def synthetic_reply(sender, recipient, subject, body_bytes=2048, attachments=0, attachment_bytes=64 * 1024):
+    """A reply like a family member would send: new text over quoted history, optional attachments"""
+    sentence = "We spent every summer at the lake and my grandmother told the same stories each night. "
+    text = (sentence * (body_bytes // len(sentence) + 1))[:body_bytes]
+    quoted = '\n'.join('> ' + line for line in [
+        f"On Sunday, {recipient} wrote:",
+        "Family Stories - this week's question is waiting for you.",
+        "Just reply to this email with your story."
+    ])
+    message = EmailMessage()
+    message['From'] = sender
+    message['To'] = recipient
+    message['Subject'] = f"Re: {subject}"
+    message['Date'] = format_datetime(email.utils.localtime())
+    message['Message-ID'] = make_msgid(domain='bench.local')
+    message.set_content(f"{text}\n\n{quoted}\n")
+    for index in range(attachments):
+        payload = bytes((index + offset) % 256 for offset in range(attachment_bytes))
+        message.add_attachment(payload, maintype='application', subtype='octet-stream',
+                               filename=f'photo-{index + 1}.bin')
+    return message.as_bytes()
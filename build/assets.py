@@ -0,0 +1,268 @@
+import csv
+import hashlib
+import logging
+import marshal
+import os
+from collections.abc import Mapping
+
+logger = logging.getLogger(__name__)
+
+# How a member gets other people's replies: one email per reply, or batched into a digest
+FORWARD_IMMEDIATE = 'immediate'
+FORWARD_DIGEST = 'digest'
+FORWARD_MODES = (FORWARD_IMMEDIATE, FORWARD_DIGEST)
+
+def _flag(value, default=True):
+    """Read a 1/0 style CSV column; blank means the default"""
+    value = (value or '').strip().lower()
+    if not value:
+        return default
+    if value in ('0', 'false', 'no', 'n', 'off'):
+        return False
+    try:
+        return bool(float(value))
+    except ValueError:
+        return True
+
+def _forward_mode(value):
+    """Read the ForwardMode column; blank means immediate"""
+    return (value or '').strip().lower() or FORWARD_IMMEDIATE
+
+class Record(Mapping):
+    """Small immutable row with attribute access that also reads like a dict.
+
+    Code that does member['email'] or member.get('receive_forwards', True)
+    keeps working, and records can be stored in Mongo like any mapping.
+    """
+    __slots__ = ()
+    COLUMNS = {}  # field -> (CSV column, converter or None for a stripped string)
+
+    def __init__(self, *values, **fields):
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+        for name, value in fields.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __reduce__(self):
+        return (type(self), self.astuple())
+
+    def astuple(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __repr__(self):
+        fields = ', '.join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+    @classmethod
+    def from_row(cls, row):
+        values = []
+        for name in cls.__slots__:
+            column, convert = cls.COLUMNS[name]
+            value = row.get(column)
+            values.append(convert(value) if convert else (value or '').strip())
+        return cls(*values)
+
+class Question(Record):
+    __slots__ = ('question', 'questioner')
+    COLUMNS = {'question': ('Question', None), 'questioner': ('Questioner', None)}
+
+class Quote(Record):
+    __slots__ = ('quote', 'author')
+    COLUMNS = {'quote': ('Quote', None), 'author': ('Author', None)}
+
+class Member(Record):
+    __slots__ = ('name', 'email', 'receive_forwards', 'receive_questions', 'forward_mode')
+    COLUMNS = {
+        'name': ('Name', None),
+        'email': ('Email', None),
+        # Columns are optional; members get everything unless the CSV says otherwise
+        'receive_forwards': ('ReceiveForwards', _flag),
+        'receive_questions': ('ReceiveQuestions', _flag),
+        'forward_mode': ('ForwardMode', _forward_mode)
+    }
+
+class ForwardingEntry(Record):
+    __slots__ = ('name', 'email')
+    COLUMNS = {'name': ('Name', None), 'email': ('Email', None)}
+
+class AssetLoader:
+    """Read asset CSVs into records with the stdlib csv module.
+
+    With a snapshot_dir, parsed records are also written there as a marshal
+    snapshot. A later load reuses the snapshot when the CSV's size and mtime
+    are unchanged, or when its content hash still matches after a touch.
+    """
+    SNAPSHOT_VERSION = 2  # bump when a record type's fields change
+
+    def __init__(self, base_dir=None, snapshot_dir=None):
+        self.base_dir = base_dir or os.getcwd()
+        self.snapshot_dir = snapshot_dir
+
+    def path(self, csv_file):
+        return os.path.join(self.base_dir, csv_file)
+
+    @staticmethod
+    def _hash(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def _snapshot_path(self, file_path, record_type):
+        name = os.path.basename(file_path)
+        digest = self._hash(file_path.encode('utf-8'))[:12]
+        return os.path.join(self.snapshot_dir, f"{name}.{record_type.__name__}.{digest}.snapshot")
+
+    def _read_snapshot(self, snapshot_path, stat):
+        try:
+            with open(snapshot_path, 'rb') as file:
+                snapshot = marshal.load(file)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None, None
+        if not isinstance(snapshot, dict) or snapshot.get('version') != self.SNAPSHOT_VERSION:
+            return None, None
+        if snapshot['size'] == stat.st_size and snapshot['mtime_ns'] == stat.st_mtime_ns:
+            return snapshot['rows'], None
+        # Touched but maybe not changed; the caller compares the hash once the file is read
+        return None, snapshot
+
+    def _write_snapshot(self, snapshot_path, stat, digest, rows):
+        try:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            temp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'wb') as file:
+                marshal.dump({
+                    'version': self.SNAPSHOT_VERSION,
+                    'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns,
+                    'sha256': digest,
+                    'rows': rows
+                }, file)
+            os.replace(temp_path, snapshot_path)
+        except OSError as e:
+            logger.warning("Could not write asset snapshot %s: %s", snapshot_path, e)
+
+    @staticmethod
+    def _parse(data, record_type):
+        # utf-8-sig drops the BOM spreadsheet exports like to add
+        reader = csv.DictReader(data.decode('utf-8-sig').splitlines())
+        return [record_type.from_row(row) for row in reader]
+
+    def load(self, csv_file, record_type):
+        """Load a CSV as a list of record_type records"""
+        file_path = self.path(csv_file)
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"CSV file not found: {file_path}")
+        stat = os.stat(file_path)
+
+        stale = None
+        if self.snapshot_dir:
+            snapshot_path = self._snapshot_path(file_path, record_type)
+            rows, stale = self._read_snapshot(snapshot_path, stat)
+            if rows is not None:
+                logger.debug("Loaded %s from snapshot", csv_file)
+                return [record_type(*row) for row in rows]
+
+        with open(file_path, 'rb') as file:
+            data = file.read()
+        digest = self._hash(data)
+        if stale is not None and stale.get('sha256') == digest:
+            records = [record_type(*row) for row in stale['rows']]
+        else:
+            records = self._parse(data, record_type)
+        if self.snapshot_dir:
+            self._write_snapshot(snapshot_path, stat, digest, [record.astuple() for record in records])
+        return records
+
+def validate_questions(questions):
+    if not questions:
+        raise ValueError("no questions")
+    for number, question in enumerate(questions, start=1):
+        if not question.question:
+            raise ValueError(f"question {number} is blank")
+
+def validate_quotes(quotes):
+    if not quotes:
+        raise ValueError("no quotes")
+    for number, quote in enumerate(quotes, start=1):
+        if not quote.quote:
+            raise ValueError(f"quote {number} is blank")
+
+def validate_members(members):
+    if not members:
+        raise ValueError("no family members")
+    seen = set()
+    for member in members:
+        email = member.email.lower()
+        if '@' not in email:
+            raise ValueError(f"invalid email address {member.email!r} for {member.name!r}")
+        if email in seen:
+            raise ValueError(f"{member.email} is listed twice")
+        if member.forward_mode not in FORWARD_MODES:
+            raise ValueError(f"unknown ForwardMode {member.forward_mode!r} for {member.email}: "
+                             f"use {' or '.join(FORWARD_MODES)}")
+        seen.add(email)
+
+class AssetWatcher:
+    """Reload asset CSVs when they change on disk.
+
+    poll() compares each file's mtime and size with the last load, so only
+    edited files are parsed. A new version is validated before on_change
+    sees it; if parsing or validation fails the old records stay in place
+    until the file changes again.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self._assets = {}
+
+    def _signature(self, csv_file):
+        try:
+            stat = os.stat(self.loader.path(csv_file))
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def watch(self, name, csv_file, record_type, on_change, validate=None):
+        """Watch csv_file, calling on_change(records) with each valid new version"""
+        self._assets[name] = {
+            'csv_file': csv_file,
+            'record_type': record_type,
+            'on_change': on_change,
+            'validate': validate,
+            'signature': self._signature(csv_file)
+        }
+
+    def poll(self):
+        """Reload every asset whose file changed; returns the names that were swapped in"""
+        reloaded = []
+        for name, asset in self._assets.items():
+            signature = self._signature(asset['csv_file'])
+            if signature == asset['signature']:
+                continue
+            asset['signature'] = signature
+            if signature is None:
+                logger.warning("%s was removed, keeping the loaded %s", asset['csv_file'], name)
+                continue
+            try:
+                records = self.loader.load(asset['csv_file'], asset['record_type'])
+                if asset['validate']:
+                    asset['validate'](records)
+            except Exception as e:
+                logger.error("Not reloading %s from %s: %s", name, asset['csv_file'], e)
+                continue
+            asset['on_change'](records)
+            logger.info("Reloaded %s %s from %s", len(records), name, asset['csv_file'])
+            reloaded.append(name)
+        return reloaded
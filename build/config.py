@@ -1,9 +1,9 @@
 import yaml
 import os
-import pandas as pd
 from dotenv import load_dotenv
 import logging
 from pathlib import Path
+from build.assets import AssetLoader, Question, Quote, Member, ForwardingEntry
 
 logger = logging.getLogger(__name__)
 
@@ -13,7 +13,7 @@ class Config:
         if env_path.exists():
             load_dotenv(dotenv_path=env_path)
         else:
-            logger.warning(f".env file not found at {env_path}. Environment variables must be set manually.")
+            logger.warning(".env file not found at %s. Environment variables must be set manually.", env_path)
         
         self._validate_environment()
         self.load_config(config_file)
@@ -41,20 +41,33 @@ class Config:
             email_settings['password'] = os.getenv('EMAIL_PASSWORD')
             
             # Debug log
-            logger.debug(f"Loaded email settings - SMTP: {email_settings['smtp_server']}:{email_settings['smtp_port']}, Username: {email_settings['username']}")
+            logger.debug("Loaded email settings - SMTP: %s:%s, Username: %s",
+                         email_settings['smtp_server'], email_settings['smtp_port'], email_settings['username'])
             
             self.email_settings = email_settings
+            self.member_settings = config.get('members') or {}
+            self.outbox_settings = config.get('outbox') or {}
+            self.schedule_settings = config.get('schedule') or {}
+            self.pipeline_settings = config.get('pipeline') or {}
+            self.families_settings = config.get('families') or []
+            self.metrics_settings = config.get('metrics') or {}
+            self.attachment_settings = config.get('attachments') or {}
+            
+            # Parsed CSVs can be cached as snapshots next to the app; off unless a directory is set
+            self.asset_settings = config.get('assets') or {}
+            self.assets = AssetLoader(snapshot_dir=self.asset_settings.get('snapshot_dir'))
             
             # Construct MongoDB URI with environment variables
             mongodb_username = os.getenv('MONGODB_USERNAME')
             mongodb_password = os.getenv('MONGODB_PASSWORD')
             mongodb_host = os.getenv('MONGODB_HOST', 'localhost')
             mongodb_port = os.getenv('MONGODB_PORT', '27017')
+            database_name = os.getenv('MONGODB_DATABASE', 'family_stories')
             
             # Construct MongoDB URI with authSource
             self.db_settings = {
-                'mongodb_uri': f"mongodb://{mongodb_username}:{mongodb_password}@{mongodb_host}:{mongodb_port}/family_stories?authSource=admin",
-                'database_name': 'family_stories'
+                'mongodb_uri': f"mongodb://{mongodb_username}:{mongodb_password}@{mongodb_host}:{mongodb_port}/{database_name}?authSource=admin",
+                'database_name': database_name
             }
             
             self._validate_config()
@@ -76,69 +89,34 @@ class Config:
 
     def load_family_members(self, csv_file='assets/emails.csv'):
         try:
-            file_path = os.path.join(os.getcwd(), csv_file)
-            if not os.path.exists(file_path):
-                raise FileNotFoundError(f"CSV file not found: {file_path}")
-            df = pd.read_csv(file_path)
-            
-            members = []
-            for _, row in df.iterrows():
-                member = {'name': row['Name'], 'email': row['Email']}
-                
-                # Check for ReceiveForwards column
-                if 'ReceiveForwards' in df.columns:
-                    member['receive_forwards'] = bool(row['ReceiveForwards'])
-                else:
-                    member['receive_forwards'] = True
-                
-                # Check for ReceiveQuestions column
-                if 'ReceiveQuestions' in df.columns:
-                    member['receive_questions'] = bool(row['ReceiveQuestions'])
-                else:
-                    member['receive_questions'] = True
-                
-                members.append(member)
-            
-            return members
+            return self.assets.load(csv_file, Member)
         except Exception as e:
-            logger.error(f"Failed to load family members: {str(e)}")
+            logger.error("Failed to load family members: %s", e)
             return []
 
     def load_questions(self, csv_file='assets/questions.csv'):
         try:
-            file_path = os.path.join(os.getcwd(), csv_file)
-            if not os.path.exists(file_path):
-                raise FileNotFoundError(f"CSV file not found: {file_path}")
-            df = pd.read_csv(file_path)
-            return [{'question': row['Question'], 'questioner': row['Questioner']} 
-                   for _, row in df.iterrows()]
+            return self.assets.load(csv_file, Question)
         except Exception as e:
-            logger.error(f"Failed to load questions: {str(e)}")
+            logger.error("Failed to load questions: %s", e)
             return []
 
     def load_quotes(self, csv_file='assets/quotes.csv'):
         try:
-            file_path = os.path.join(os.getcwd(), csv_file)
-            if not os.path.exists(file_path):
-                raise FileNotFoundError(f"CSV file not found: {file_path}")
-            df = pd.read_csv(file_path)
-            return [{'quote': row['Quote'], 'author': row['Author']} 
-                   for _, row in df.iterrows()]
+            return self.assets.load(csv_file, Quote)
         except Exception as e:
-            logger.error(f"Failed to load quotes: {str(e)}")
+            logger.error("Failed to load quotes: %s", e)
             return []
 
     def load_forwarding_list(self, csv_file='assets/forwarding_list.csv'):
         """Load the list of email addresses to forward responses to"""
         try:
-            file_path = os.path.join(os.getcwd(), csv_file)
-            if not os.path.exists(file_path):
-                logger.warning(f"Forwarding list file not found: {file_path}. Using family members list instead.")
+            if not os.path.exists(self.assets.path(csv_file)):
+                logger.warning("Forwarding list file not found: %s. Using family members list instead.",
+                               self.assets.path(csv_file))
                 return None
                 
-            df = pd.read_csv(file_path)
-            return [{'name': row['Name'], 'email': row['Email']} 
-                   for _, row in df.iterrows() if row['Email'].strip()]
+            return [entry for entry in self.assets.load(csv_file, ForwardingEntry) if entry.email]
         except Exception as e:
-            logger.error(f"Failed to load forwarding list: {str(e)}")
+            logger.error("Failed to load forwarding list: %s", e)
             return None
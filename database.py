@@ -1,14 +1,23 @@
-import re
+import hashlib
 import logging
 from datetime import datetime
 from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure, OperationFailure
+from pymongo.errors import BulkWriteError, ConnectionFailure, OperationFailure
+from schema import SchemaManager
+from archive import StoryArchive
+import metrics
 
 logger = logging.getLogger(__name__)
 
+MONGO_SECONDS = metrics.histogram(
+    'family_stories_mongo_operation_seconds', 'Time for one MongoDB round-trip', ('operation',))
+RESPONSES_STORED = metrics.counter(
+    'family_stories_responses_stored_total', 'Responses written, or skipped as already stored', ('result',))
+
 class DatabaseManager:
     MAX_RETRIES = 3
     RETRY_DELAY = 1  # seconds
+    DUPLICATE_KEY_ERROR = 11000
 
     def __init__(self, config=None):
         if not config or not config.db_settings:
@@ -22,16 +31,12 @@ class DatabaseManager:
             if not self.db_settings.get('mongodb_uri'):
                 raise ValueError("MongoDB URI is missing")
             
-            logger.info(f"Connecting to database: {self.db_settings['database_name']}")
+            logger.info("Connecting to database: %s", self.db_settings['database_name'])
             
-            # Only try to mask password if URI contains authentication info
-            safe_uri = self.db_settings['mongodb_uri']
-            if '@' in safe_uri:
-                safe_uri = safe_uri.replace(
-                    re.search(r':(.+?)@', self.db_settings['mongodb_uri']).group(1),
-                    '****'
-                )
-            logger.debug(f"Using connection string: {safe_uri}")
+            if logger.isEnabledFor(logging.DEBUG):
+                # Log where we connect, never the credentials
+                host = self.db_settings['mongodb_uri'].rsplit('@', 1)[-1].split('/', 1)[0]
+                logger.debug("Using MongoDB host: %s", host)
             
             self.client = MongoClient(
                 self.db_settings['mongodb_uri'],
@@ -50,106 +55,245 @@ class DatabaseManager:
             self.db = self.client[self.db_settings['database_name']]
             self.setup_collections()
             
-            logger.info(f"Successfully initialized database: {self.db_settings['database_name']}")
+            logger.info("Successfully initialized database: %s", self.db_settings['database_name'])
             
         except ConnectionFailure as e:
-            logger.error(f"Failed to connect to MongoDB: {str(e)}")
+            logger.error("Failed to connect to MongoDB: %s", e)
             raise
         except OperationFailure as e:
             if "Authentication failed" in str(e):
                 logger.error("MongoDB authentication failed. Please check your username and password.")
             else:
-                logger.error(f"MongoDB operation failed: {str(e)}")
+                logger.error("MongoDB operation failed: %s", e)
             raise
         except Exception as e:
-            logger.error(f"Unexpected error connecting to database: {str(e)}")
+            logger.error("Unexpected error connecting to database: %s", e)
             raise
 
     def setup_collections(self):
-        """Set up collections and their indexes"""
-        # Compound index for common query patterns
-        self.db.responses.create_index([
-            ("question_id", 1),
-            ("family_member_email", 1),
-            ("response_date", -1)
-        ])
-        
-        # Additional single-field indexes for other query patterns
-        self.db.responses.create_index([("question_text", 1)])  # Search by question text
-        self.db.responses.create_index([("family_member_name", 1)])  # Search by family member name
-        self.db.responses.create_index([("response_date", -1)])  # Pure date-based queries
-        
-        # Text index for potential full-text search of responses
-        self.db.responses.create_index([("response_text", "text")])  # Enable text search in responses
-        
-        # Family members collection
-        self.db.family_members.create_index([
-            ("email", 1)
-        ], unique=True)
-        self.db.family_members.create_index([("name", 1)])  # Search by name
-        
-        # Set up app_state collection
-        self.db.app_state.update_one(
-            {"_id": "question_index"},
-            {"$setOnInsert": {
-                "current_index": 0
-            }},
-            upsert=True
-        )
+        """Bring collections and indexes up to the current schema version"""
+        SchemaManager(self.db).migrate()
+
+    @property
+    def archive(self):
+        """Read API over stored responses"""
+        return StoryArchive(self)
 
     def close(self):
         """Close database connection"""
         if hasattr(self, 'client'):
             self.client.close()
 
-    def get_or_create_question_index(self):
+    @staticmethod
+    def _question_index_id(family_id=None):
+        # The original single-family deployment keeps its existing document
+        if family_id in (None, 'default'):
+            return "question_index"
+        return f"question_index:{family_id}"
+
+    def get_or_create_question_index(self, family_id=None):
         """Get the current question index or create it if it doesn't exist"""
-        result = self.db.app_state.find_one({"_id": "question_index"})
+        state_id = self._question_index_id(family_id)
+        with MONGO_SECONDS.time(operation='get_question_index'):
+            result = self.db.app_state.find_one({"_id": state_id})
         if result is None:
             self.db.app_state.insert_one({
-                "_id": "question_index",
+                "_id": state_id,
                 "current_index": 0
             })
             return 0
         return result.get("current_index", 0)
 
-    def update_question_index(self, index, question):
+    def update_question_index(self, index, question, family_id=None):
         """Update the current question index"""
-        self.db.app_state.update_one(
-            {"_id": "question_index"},
-            {"$set": {
-                "current_index": index,
-                "current_question": question
-            }},
-            upsert=True
-        )
-
-    def store_response(self, email, response_text, timestamp=None, question=None):
-        """Store a family member's response in the database"""
+        with MONGO_SECONDS.time(operation='update_question_index'):
+            self.db.app_state.update_one(
+                {"_id": self._question_index_id(family_id)},
+                {"$set": {
+                    "current_index": index,
+                    "current_question": dict(question)
+                }},
+                upsert=True
+            )
+
+    def get_mailbox_state(self):
+        """Get the last processed IMAP UID and the UIDVALIDITY it belongs to"""
+        with MONGO_SECONDS.time(operation='get_mailbox_state'):
+            result = self.db.app_state.find_one({"_id": "mailbox_sync"})
+        if result is None:
+            return None
+        return {
+            "uidvalidity": result.get("uidvalidity"),
+            "last_uid": result.get("last_uid", 0)
+        }
+
+    def update_mailbox_state(self, uidvalidity, last_uid):
+        """Record the IMAP high-water mark once responses up to it are stored"""
+        with MONGO_SECONDS.time(operation='update_mailbox_state'):
+            self.db.app_state.update_one(
+                {"_id": "mailbox_sync"},
+                {"$set": {
+                    "uidvalidity": uidvalidity,
+                    "last_uid": last_uid,
+                    "updated_at": datetime.utcnow()
+                }},
+                upsert=True
+            )
+
+    @staticmethod
+    def _digest_state_id(family_id=None):
+        return f"digest:{family_id or 'default'}"
+
+    def get_digest_state(self, family_id=None):
+        """The end of the window the family's last reply digest covered, or None"""
+        with MONGO_SECONDS.time(operation='get_digest_state'):
+            result = self.db.app_state.find_one({"_id": self._digest_state_id(family_id)})
+        return result.get("covered_until") if result else None
+
+    def update_digest_state(self, covered_until, family_id=None):
+        """Record that replies up to covered_until have gone out in a digest"""
+        with MONGO_SECONDS.time(operation='update_digest_state'):
+            self.db.app_state.update_one(
+                {"_id": self._digest_state_id(family_id)},
+                {"$set": {
+                    "covered_until": covered_until,
+                    "updated_at": datetime.utcnow()
+                }},
+                upsert=True
+            )
+
+    def store_response(self, email, response_text, timestamp=None, question=None, message_id=None,
+                       raw_text=None, content_type=None):
+        """Store a family member's response in the database.
+
+        raw_text, the body as received with quoted history, goes to the
+        raw_responses collection so it stays out of the response_text index.
+        """
+        stored = self.store_responses([{
+            'email': email,
+            'response_text': response_text,
+            'timestamp': timestamp,
+            'message_id': message_id,
+            'raw_text': raw_text,
+            'content_type': content_type
+        }], question=question)
+        return stored[0]['response_id']
+
+    @staticmethod
+    def _idempotency_key(response):
+        """Message-ID when the mail had one, otherwise a hash of sender and body"""
+        if response.get('message_id'):
+            return response['message_id']
+        digest = hashlib.sha256(
+            f"{response['email']}\0{response.get('raw_text') or response['response_text']}".encode('utf-8')
+        ).hexdigest()
+        return f"<sha256.{digest}@family-stories>"
+
+    def get_family_member_names(self, emails):
+        """Look up names for many email addresses with a single query"""
         try:
-            if timestamp is None:
-                timestamp = datetime.utcnow()
-                
-            logger.info(f"Storing response from {email}")
-            logger.debug(f"Response text: {response_text[:100]}...")  # Log first 100 chars
-            
-            # Create document with required information
+            with MONGO_SECONDS.time(operation='get_member_names'):
+                members = self.db.family_members.find(
+                    {'email': {'$in': list(set(emails))}},
+                    {'_id': 0, 'email': 1, 'name': 1}
+                )
+                return {member['email']: member['name'] for member in members}
+        except Exception as e:
+            logger.error("Failed to get family member names: %s", e)
+            return {}
+
+    @staticmethod
+    def _response_documents(responses, question, names, family_id=None):
+        question = question or {}
+        documents = []
+        for response in responses:
             document = {
+                'family_id': family_id or 'default',
                 'question_id': question.get('id'),  # Assuming questions have IDs
                 'question_text': question.get('question'),
-                'family_member_email': email,
-                'family_member_name': self.get_family_member_name(email),  # New helper method needed
-                'response_date': timestamp,
-                'response_text': response_text
+                'family_member_email': response['email'],
+                'family_member_name': names.get(response['email']),
+                'response_date': response.get('timestamp') or datetime.utcnow(),
+                'response_text': response['response_text'],
+                'message_id': DatabaseManager._idempotency_key(response)
             }
+            if response.get('attachments'):
+                # References to the GridFS attachments bucket, not the bytes themselves
+                document['attachments'] = response['attachments']
+            documents.append(document)
+        return documents
+
+    @staticmethod
+    def _duplicate_indexes(error):
+        """Positions a BulkWriteError rejected as already stored; re-raises anything else"""
+        errors = error.details.get('writeErrors', [])
+        if any(write_error['code'] != DatabaseManager.DUPLICATE_KEY_ERROR for write_error in errors):
+            raise error
+        return {write_error['index'] for write_error in errors}
+
+    @staticmethod
+    def _raw_documents(responses, documents, duplicates):
+        return [{
+            'response_id': document['_id'],
+            'message_id': document['message_id'],
+            'content_type': response.get('content_type'),
+            'raw_text': response['raw_text']
+        } for index, (response, document) in enumerate(zip(responses, documents))
+            if index not in duplicates and response.get('raw_text') is not None]
+
+    @staticmethod
+    def _store_results(documents, duplicates):
+        return [{
+            'email': document['family_member_email'],
+            'family_member_name': document['family_member_name'],
+            'response_id': None if index in duplicates else document['_id'],
+            'message_id': document['message_id'],
+            'duplicate': index in duplicates
+        } for index, document in enumerate(documents)]
+
+    def store_responses(self, responses, question=None, names=None, family_id=None):
+        """Store a batch of responses with one name lookup and one unordered insert.
+
+        Each response is a dict with email, response_text and optionally
+        timestamp, message_id, raw_text and content_type. Responses already
+        stored under the same Message-ID are skipped, so a retried batch is
+        safe. Pass names ({email: name}) to skip the family_members lookup.
+        family_id tags the responses with the family they answer.
+        Returns one dict per response with email, family_member_name,
+        response_id, message_id (the idempotency key) and duplicate.
+        """
+        if not responses:
+            return []
+        try:
+            logger.info("Storing %s responses", len(responses))
+            if names is None:
+                names = self.get_family_member_names(response['email'] for response in responses)
+            
+            documents = self._response_documents(responses, question, names, family_id)
+            duplicates = set()
+            try:
+                # insert_many fills in each document's _id before sending
+                with MONGO_SECONDS.time(operation='insert_responses'):
+                    self.db.responses.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                duplicates = self._duplicate_indexes(e)
+                logger.info("Skipped %s responses that were already stored", len(duplicates))
             
-            result = self.db.responses.insert_one(document)
+            raw_documents = self._raw_documents(responses, documents, duplicates)
+            if raw_documents:
+                try:
+                    with MONGO_SECONDS.time(operation='insert_raw_responses'):
+                        self.db.raw_responses.insert_many(raw_documents, ordered=False)
+                except BulkWriteError as e:
+                    self._duplicate_indexes(e)
             
-            logger.info(f"Successfully stored response with ID: {result.inserted_id}")
-            return result.inserted_id
+            RESPONSES_STORED.inc(len(documents) - len(duplicates), result='stored')
+            RESPONSES_STORED.inc(len(duplicates), result='duplicate')
+            logger.info("Successfully stored %s responses", len(documents) - len(duplicates))
+            return self._store_results(documents, duplicates)
             
         except Exception as e:
-            logger.error(f"Failed to store response from {email}: {str(e)}")
+            logger.error("Failed to store responses: %s", e)
             raise
 
     def get_family_member_name(self, email):
@@ -159,5 +303,5 @@ class DatabaseManager:
             member = self.db.family_members.find_one({'email': email})
             return member['name'] if member else None
         except Exception as e:
-            logger.error(f"Failed to get family member name for {email}: {str(e)}")
+            logger.error("Failed to get family member name for %s: %s", email, e)
             return None 
\ No newline at end of file
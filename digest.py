@@ -0,0 +1,143 @@
+import logging
+from datetime import datetime, timedelta
+from build.assets import FORWARD_DIGEST
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DIGESTS_SENT = metrics.counter(
+    'family_stories_digests_total', 'Reply digests sent, queued, or that failed to send', ('result',))
+DIGEST_SECONDS = metrics.histogram(
+    'family_stories_digest_seconds', 'Time to collect, render and send one family\'s reply digests')
+
+PERIODS = {
+    'hourly': timedelta(hours=1),
+    'daily': timedelta(days=1)
+}
+
+class ReplyDigest:
+    """Batch a family's replies into one email per member who asked for a digest.
+
+    Each run covers the replies stored since the previous run's window ended,
+    which is kept in app_state, grouped by question in a single aggregation.
+    A member's own replies are left out of their copy; members left with the
+    same replies share one rendered body. The window only advances once the
+    run is done, so a crash resends (or, through the outbox, re-queues under
+    the same keys) rather than skipping replies.
+    """
+    # Replies fetched just before a run may still be on their way through the pipeline
+    SETTLE_SECONDS = 120
+
+    def __init__(self, database, email_sender, outbox=None):
+        self.database = database
+        self.collection = database.db.responses
+        self.email_sender = email_sender
+        self.outbox = outbox
+
+    @staticmethod
+    def period(every):
+        """The window length for an 'every' setting of hourly or daily"""
+        try:
+            return PERIODS[str(every).lower()]
+        except KeyError:
+            raise ValueError(f"Unknown digest period {every!r}: use {' or '.join(PERIODS)}")
+
+    @staticmethod
+    def _family_filter(family_id):
+        # Responses stored before families existed have no family_id
+        return {"$in": [family_id, None]} if family_id in (None, 'default') else family_id
+
+    def collect(self, family_id, since, until):
+        """Replies stored in [since, until), as [{"question", "replies"}] in the order questions were first answered"""
+        pipeline = [
+            {"$match": {
+                "family_id": self._family_filter(family_id),
+                "response_date": {"$gte": since, "$lt": until}
+            }},
+            {"$sort": {"response_date": 1}},
+            {"$group": {
+                "_id": "$question_text",
+                "first_reply": {"$first": "$response_date"},
+                "replies": {"$push": {
+                    "name": "$family_member_name",
+                    "email": "$family_member_email",
+                    "text": "$response_text",
+                    "date": "$response_date",
+                    # Only replies that had attachments store the field
+                    "attachments": {"$ifNull": ["$attachments", []]}
+                }}
+            }},
+            {"$sort": {"first_reply": 1}},
+            {"$project": {"_id": 0, "question": "$_id", "replies": 1}}
+        ]
+        with metrics.span('digest.collect', family=family_id):
+            return list(self.collection.aggregate(pipeline))
+
+    @staticmethod
+    def _without(groups, email):
+        """The groups minus one member's own replies, dropping questions left empty"""
+        result = []
+        for group in groups:
+            replies = [reply for reply in group['replies'] if (reply.get('email') or '').lower() != email]
+            if replies:
+                result.append({"question": group['question'], "replies": replies})
+        return result
+
+    def send(self, family, every='daily', now=None):
+        """Send (or queue) this family's digests for the window ending now. Returns how many went out."""
+        period = self.period(every)
+        until = (now or datetime.utcnow()) - timedelta(seconds=self.SETTLE_SECONDS)
+        # The first digest looks back one period rather than over the whole archive
+        since = self.database.get_digest_state(family.id) or until - period
+        if since >= until:
+            return 0
+
+        with DIGEST_SECONDS.time():
+            recipients = family.members.forward_recipients(mode=FORWARD_DIGEST)
+            groups = self.collect(family.id, since, until) if recipients else []
+            sent = self._deliver(family, recipients, groups, since) if groups else 0
+
+        # Nothing to send still closes the window, so a member who opts in later doesn't get old replies
+        self.database.update_digest_state(until, family.id)
+        logger.info("[%s] Sent %s reply digests covering %s to %s", family.id, sent, since, until)
+        return sent
+
+    def _deliver(self, family, recipients, groups, since):
+        repliers = {(reply.get('email') or '').lower() for group in groups for reply in group['replies']}
+        bodies = {}  # recipient's own address when they replied, else None -> groups
+        prepared = {}  # same keys -> encoded message
+        jobs = []
+        sent = 0
+        for member in recipients:
+            email = member['email'].lower()
+            body_key = email if email in repliers else None
+            if body_key not in bodies:
+                bodies[body_key] = self._without(groups, email) if body_key else groups
+            member_groups = bodies[body_key]
+            if not member_groups:
+                continue
+
+            if self.outbox is not None:
+                # Keyed on the window start, which only moves once this run finishes
+                jobs.append((f"digest:{family.id}:{since.isoformat()}:{email}", 'digest', member['email'], {
+                    'family_name': family.name,
+                    'body_key': f"{family.id}:{since.isoformat()}:{body_key or ''}",
+                    'groups': member_groups
+                }))
+                continue
+
+            try:
+                if body_key not in prepared:
+                    prepared[body_key] = self.email_sender.prepare_digest(family.name, member_groups)
+                self.email_sender.send_prepared(prepared[body_key], member['email'])
+                DIGESTS_SENT.inc(result='sent')
+                sent += 1
+                logger.info("Sent reply digest to %s", member['email'])
+            except Exception as e:
+                DIGESTS_SENT.inc(result='failed')
+                logger.error("Failed to send reply digest to %s: %s", member['email'], e)
+
+        if jobs:
+            sent = self.outbox.enqueue_many(jobs)
+            DIGESTS_SENT.inc(sent, result='queued')
+        return sent
@@ -1,5 +1,7 @@
 from emails.sender import EmailSender
 from emails.receiver import EmailReceiver
+from emails.bulk import BulkDispatcher
 from emails.templates import WeeklyQuestionEmail, ConfirmationEmail
+from emails.extraction import ReplyExtractor
 
-__all__ = ['EmailSender', 'EmailReceiver', 'WeeklyQuestionEmail', 'ConfirmationEmail']
+__all__ = ['EmailSender', 'EmailReceiver', 'BulkDispatcher', 'WeeklyQuestionEmail', 'ConfirmationEmail', 'ReplyExtractor']
@@ -0,0 +1,165 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+class _Literal(bytes):
+    """Marks IMAP literal data so the tokenizer passes it through untouched"""
+
+# Paren tokens are sentinels, so a quoted string or literal of "(" or ")" can't pass for one
+_OPEN = object()
+_CLOSE = object()
+
+def _segments(fetch_data):
+    """Flatten imaplib FETCH output into bytes and literal segments.
+
+    imaplib returns a literal as a (prefix ending in {n}, literal) tuple with
+    the rest of the line in the following item.
+    """
+    for item in fetch_data:
+        if isinstance(item, tuple):
+            prefix, literal = item
+            yield prefix[:prefix.rindex(b'{')]
+            yield _Literal(literal)
+        elif item is not None:
+            # Separate the message lines so one's closing paren doesn't run into the next
+            yield item + b'\n'
+
+def _tokenize(fetch_data):
+    for segment in _segments(fetch_data):
+        if isinstance(segment, _Literal):
+            yield segment
+            continue
+        i, length = 0, len(segment)
+        while i < length:
+            char = segment[i:i + 1]
+            if char in b' \r\n':
+                i += 1
+            elif char in b'()':
+                yield _OPEN if char == b'(' else _CLOSE
+                i += 1
+            elif char == b'"':
+                i += 1
+                value = bytearray()
+                while i < length and segment[i:i + 1] != b'"':
+                    if segment[i:i + 1] == b'\\':
+                        i += 1
+                    value += segment[i:i + 1]
+                    i += 1
+                i += 1
+                yield _Literal(bytes(value))
+            else:
+                # Atom; section specs like BODY[HEADER.FIELDS (FROM)] may contain spaces and parens
+                start, depth = i, 0
+                while i < length:
+                    char = segment[i:i + 1]
+                    if char == b'[':
+                        depth += 1
+                    elif char == b']':
+                        depth -= 1
+                    elif depth == 0 and char in b' ()\r\n':
+                        break
+                    i += 1
+                atom = segment[start:i]
+                yield None if atom.upper() == b'NIL' else atom.decode('ascii', 'replace')
+
+def _parse(tokens):
+    """Turn a token stream into nested lists"""
+    stack = [[]]
+    for token in tokens:
+        if token is _OPEN:
+            stack.append([])
+        elif token is _CLOSE:
+            if len(stack) > 1:
+                finished = stack.pop()
+                stack[-1].append(finished)
+        else:
+            stack[-1].append(token)
+    return stack[0]
+
+def parse_fetch_response(fetch_data):
+    """Parse UID FETCH output into {uid: {item name: value}}.
+
+    Quoted strings and literals come back as bytes, atoms as str and NIL as None.
+    """
+    messages = {}
+    parsed = _parse(_tokenize(fetch_data))
+    for item in parsed:
+        if not isinstance(item, list):
+            continue
+        # Each message is "<seq> (NAME value NAME value ...)"
+        attributes = {}
+        for name, value in zip(item[0::2], item[1::2]):
+            if isinstance(name, str):
+                # Partial fetches come back as BODY[1]<0>; the origin isn't needed
+                attributes[name.upper().split('<')[0]] = value
+        if 'UID' in attributes:
+            messages[int(attributes['UID'])] = attributes
+    return messages
+
+def find_item(attributes, prefix):
+    """Look up a FETCH item by name prefix, e.g. BODY[HEADER, whatever the server echoed"""
+    for name, value in attributes.items():
+        if name.startswith(prefix):
+            return value
+    return None
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+def _params(value):
+    if not isinstance(value, list):
+        return {}
+    return {_text(key).lower(): _text(val) for key, val in zip(value[0::2], value[1::2])}
+
+def walk_parts(structure, section=''):
+    """Yield a description of every leaf part in a BODYSTRUCTURE.
+
+    Each part is a dict with section, content_type, charset, encoding, size,
+    disposition and filename. Attached messages (message/rfc822) are leaves.
+    """
+    if structure and isinstance(structure[0], list):
+        # Multipart: child parts first, then the subtype and extension data
+        number = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            number += 1
+            yield from walk_parts(child, f"{section}.{number}" if section else str(number))
+        return
+
+    main_type = (_text(structure[0]) or '').lower()
+    sub_type = (_text(structure[1]) or '').lower()
+    params = _params(structure[2])
+    if main_type == 'text':
+        extension_start = 8
+    elif main_type == 'message' and sub_type == 'rfc822':
+        extension_start = 10
+    else:
+        extension_start = 7
+    disposition = None
+    disposition_params = {}
+    if len(structure) > extension_start + 1 and isinstance(structure[extension_start + 1], list):
+        disposition = (_text(structure[extension_start + 1][0]) or '').lower()
+        disposition_params = _params(structure[extension_start + 1][1])
+
+    yield {
+        'section': section or '1',
+        'content_type': f"{main_type}/{sub_type}",
+        'charset': params.get('charset'),
+        'encoding': (_text(structure[5]) or '7bit').lower(),
+        'size': int(structure[6]) if structure[6] is not None else 0,
+        'disposition': disposition,
+        'filename': disposition_params.get('filename') or params.get('name')
+    }
+
+def find_text_part(structure, preferred=('text/plain', 'text/html')):
+    """Pick the inline body part to read, in order of preferred content types"""
+    candidates = [part for part in walk_parts(structure)
+                  if part['disposition'] != 'attachment' and part['content_type'] in preferred]
+    for content_type in preferred:
+        for part in candidates:
+            if part['content_type'] == content_type:
+                return part
+    return None
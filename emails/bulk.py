@@ -0,0 +1,96 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_WAIT_SECONDS = metrics.histogram(
+    'family_stories_bulk_rate_limit_wait_seconds', 'Time a bulk send waited for its domain to have a free slot')
+
+class DomainRateLimiter:
+    """Spaces out sends to the same recipient domain to stay under provider limits"""
+
+    def __init__(self, per_domain_rate=None):
+        # per_domain_rate is messages per second for each domain; None disables limiting
+        self.interval = 1.0 / per_domain_rate if per_domain_rate else 0
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def wait(self, recipient_email):
+        """Block until the recipient's domain has a free send slot"""
+        if not self.interval:
+            return
+        domain = recipient_email.rsplit('@', 1)[-1].lower()
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(domain, now))
+            self._next_slot[domain] = slot + self.interval
+        delay = slot - now
+        RATE_LIMIT_WAIT_SECONDS.observe(max(delay, 0))
+        if delay > 0:
+            time.sleep(delay)
+
+class BulkDispatcher:
+    """Sends one message per recipient across a bounded worker pool"""
+    DEFAULT_MAX_WORKERS = 4
+
+    def __init__(self, email_sender, max_workers=DEFAULT_MAX_WORKERS, per_domain_rate=None):
+        self.email_sender = email_sender
+        self.max_workers = max_workers
+        self.rate_limiter = DomainRateLimiter(per_domain_rate)
+
+    def _deliver(self, recipient, send):
+        self.rate_limiter.wait(recipient['email'])
+        started = time.monotonic()
+        try:
+            send(recipient)
+            status, error = 'sent', None
+        except Exception as e:
+            status, error = 'failed', str(e)
+        return {
+            'email': recipient['email'],
+            'status': status,
+            'error': error,
+            'elapsed': time.monotonic() - started
+        }
+
+    def dispatch(self, recipients, send):
+        """Call send(recipient) for every recipient and return a per-recipient report"""
+        if not recipients:
+            return []
+        workers = max(1, min(self.max_workers, len(recipients)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bulk-send') as executor:
+            report = list(executor.map(lambda recipient: self._deliver(recipient, send), recipients))
+
+        sent = sum(1 for result in report if result['status'] == 'sent')
+        logger.info("Bulk send finished: %s sent, %s failed", sent, len(report) - sent)
+        return report
+
+    def send_weekly_question(self, recipients, questioner_name, question, quote, quote_author, question_number=None,
+                             reply_to=None, msgid_token=None):
+        """Send the weekly question to every recipient concurrently"""
+        # Render and encode the newsletter once for the whole list
+        prepared = self.email_sender.prepare_weekly_question(
+            questioner_name=questioner_name,
+            question=question,
+            quote=quote,
+            quote_author=quote_author,
+            question_number=question_number,
+            reply_to=reply_to,
+            msgid_token=msgid_token
+        )
+
+        def send(recipient):
+            self.email_sender.send_weekly_question(
+                recipient_email=recipient['email'],
+                recipient_name=recipient['name'],
+                questioner_name=questioner_name,
+                question=question,
+                quote=quote,
+                quote_author=quote_author,
+                question_number=question_number,
+                prepared=prepared
+            )
+        return self.dispatch(recipients, send)
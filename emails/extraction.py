@@ -0,0 +1,135 @@
+import logging
+import re
+from html.parser import HTMLParser
+
+logger = logging.getLogger(__name__)
+
+class _HTMLTextParser(HTMLParser):
+    """Collect the visible text of an HTML reply, skipping quoted blocks"""
+    BLOCK_TAGS = {'p', 'div', 'br', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'table', 'hr'}
+    VOID_TAGS = {'br', 'hr', 'img', 'meta', 'link', 'input', 'area', 'base', 'col', 'wbr', 'source'}
+    HIDDEN_TAGS = {'script', 'style', 'head', 'title', 'blockquote'}
+    # Containers mail clients wrap quoted history in
+    QUOTE_CLASSES = {'gmail_quote', 'yahoo_quoted', 'moz-cite-prefix'}
+    QUOTE_IDS = {'divrplyfwdmsg', 'appendonsend', 'mail-editor-reference-message-container'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self._stack = []  # (tag, hidden) for open non-void elements
+        self._hidden_depth = 0
+
+    def _is_quote(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = set((attrs.get('class') or '').lower().split())
+        return (tag in self.HIDDEN_TAGS or classes & self.QUOTE_CLASSES
+                or (attrs.get('id') or '').lower() in self.QUOTE_IDS)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS and not self._hidden_depth:
+            self.chunks.append('\n')
+        if tag in self.VOID_TAGS:
+            return
+        hidden = bool(self._is_quote(tag, attrs))
+        self._stack.append((tag, hidden))
+        if hidden:
+            self._hidden_depth += 1
+
+    def handle_endtag(self, tag):
+        # Pop back to the matching tag; mail HTML is rarely well formed
+        for index in range(len(self._stack) - 1, -1, -1):
+            if self._stack[index][0] == tag:
+                for _, hidden in self._stack[index:]:
+                    if hidden:
+                        self._hidden_depth -= 1
+                del self._stack[index:]
+                break
+        if tag in self.BLOCK_TAGS and not self._hidden_depth:
+            self.chunks.append('\n')
+
+    def handle_data(self, data):
+        if not self._hidden_depth:
+            self.chunks.append(re.sub(r'[ \t\r\n]+', ' ', data))
+
+class ReplyExtractor:
+    """Reduce a reply email's body to just what the person wrote"""
+    FALLBACK_CHARSETS = ('utf-8', 'cp1252')
+
+    # Lines that start quoted history; everything from here down is dropped
+    QUOTE_HEADER_PATTERNS = [
+        re.compile(r'^\s*On\b.{0,200}\bwrote:\s*$', re.IGNORECASE),  # Gmail / Apple Mail
+        re.compile(r'^\s*Le\b.{0,200}\ba écrit\s*:\s*$', re.IGNORECASE),
+        re.compile(r'^\s*Am\b.{0,200}\bschrieb\b.{0,100}:\s*$', re.IGNORECASE),
+        re.compile(r'^\s*-{2,}\s*Original Message\s*-{2,}\s*$', re.IGNORECASE),
+        re.compile(r'^\s*-{2,}\s*Forwarded message\s*-{2,}\s*$', re.IGNORECASE),
+        re.compile(r'^\s*_{20,}\s*$'),  # Outlook separator
+        re.compile(r'^\s*From:\s.+$', re.IGNORECASE),  # Outlook header block (confirmed below)
+    ]
+    OUTLOOK_HEADER_FOLLOWUPS = re.compile(r'^\s*(Sent|Date|To|Subject):\s', re.IGNORECASE)
+    SIGNATURE_PATTERNS = [
+        re.compile(r'^-- ?$'),
+        # Whole lines only, so a story that starts "Sent from my grandmother's..." isn't cut
+        re.compile(r'^\s*Sent from my (iPhone|iPad|Android( phone| device)?|Samsung[\w ]*|Galaxy[\w ]*|BlackBerry[\w ]*)'
+                   r'\.?\s*$', re.IGNORECASE),
+        re.compile(r'^\s*Sent from (Mail|Yahoo Mail|Outlook)( (for|on) (iOS|Android|Windows[\w ]*|Mac))?\s*$',
+                   re.IGNORECASE),
+        re.compile(r'^\s*Get Outlook for (iOS|Android)\s*(<[^>]*>)?\s*$', re.IGNORECASE),
+    ]
+
+    @staticmethod
+    def decode(payload, charset=None):
+        """Decode body bytes, trying the declared charset before common fallbacks"""
+        for candidate in ((charset,) if charset else ()) + ReplyExtractor.FALLBACK_CHARSETS:
+            try:
+                return payload.decode(candidate)
+            except (LookupError, UnicodeDecodeError):
+                continue
+        return payload.decode('utf-8', errors='replace')
+
+    @staticmethod
+    def html_to_text(html):
+        """Convert an HTML reply to plain text, leaving out quoted history"""
+        parser = _HTMLTextParser()
+        parser.feed(html)
+        parser.close()
+        lines = [line.strip() for line in ''.join(parser.chunks).split('\n')]
+        return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+
+    @staticmethod
+    def _is_quote_header(lines, index):
+        line = lines[index]
+        # "On <date>, <name> <address>" is often wrapped before "wrote:"
+        joined = line + ' ' + lines[index + 1] if index + 1 < len(lines) else line
+        for pattern in ReplyExtractor.QUOTE_HEADER_PATTERNS[:-1]:
+            if pattern.match(line) or (line.strip().lower().startswith('on ') and pattern.match(joined)):
+                return True
+        if ReplyExtractor.QUOTE_HEADER_PATTERNS[-1].match(line):
+            following = lines[index + 1:index + 4]
+            return any(ReplyExtractor.OUTLOOK_HEADER_FOLLOWUPS.match(next_line) for next_line in following)
+        return False
+
+    @staticmethod
+    def strip_quotes(text):
+        """Cut plain text at the first quote marker or signature and drop '>' lines"""
+        lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        kept = []
+        for index, line in enumerate(lines):
+            if ReplyExtractor._is_quote_header(lines, index):
+                break
+            if any(pattern.match(line) for pattern in ReplyExtractor.SIGNATURE_PATTERNS):
+                break
+            if line.lstrip().startswith('>'):
+                continue
+            kept.append(line.rstrip())
+        return '\n'.join(kept).strip()
+
+    @staticmethod
+    def extract(body, content_type='text/plain'):
+        """Return only the newly written part of a reply body"""
+        text = ReplyExtractor.html_to_text(body) if content_type == 'text/html' else body
+        reply = ReplyExtractor.strip_quotes(text)
+        if not reply:
+            # Nothing outside the quotes (e.g. inline answers); keep the whole text rather than lose it
+            logger.debug("Reply extraction found no new text, keeping the full body")
+            return text.strip()
+        return reply
@@ -0,0 +1,105 @@
+import email.quoprimime
+import email.utils
+import html
+import logging
+import re
+import uuid
+from email.header import Header
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# SMTP requires CRLF line endings, and smtplib only converts them for str messages
+CRLF = '\r\n'
+# A trailing soft line break lets separately encoded chunks be concatenated
+# into one valid quoted-printable body without re-encoding the whole thing.
+SOFT_BREAK = '=' + CRLF
+# Chunks are encoded one short of RFC 2045's 76 so the appended '=' still fits
+QP_LINE_LENGTH = 75
+BARE_LF = re.compile(rb'(?<!\r)\n')
+
+def _qp_encode(text):
+    """Quoted-printable encode UTF-8 text the same way email.charset does"""
+    return email.quoprimime.body_encode(text.encode('utf-8').decode('latin-1'),
+                                        maxlinelen=QP_LINE_LENGTH, eol=CRLF)
+
+def _format_header(name, value):
+    try:
+        value.encode('ascii')
+    except UnicodeEncodeError:
+        value = Header(value, 'utf-8', header_name=name).encode(linesep=CRLF)
+    return f"{name}: {value}{CRLF}"
+
+class PreparedMessage:
+    """An HTML email whose shared body is encoded once.
+
+    Per-recipient messages are assembled from the cached encoded chunks plus
+    the recipient's headers and a few small personalized fragments.
+    """
+
+    def __init__(self, subject, from_addr, parts, reply_to=None, msgid_token=None):
+        # parts alternates static HTML and personalized slot names, like
+        # CompiledTemplate.render_parts() returns
+        self.subject = subject
+        self.from_addr = from_addr
+        # Embedded in each Message-ID so a reply's In-Reply-To can be traced back
+        self.msgid_token = msgid_token
+        self.slots = parts[1::2]
+        self._encoded = [_qp_encode(part) for part in parts[0::2]]
+        self._boundary = f"=_{uuid.uuid4().hex}"
+        self._subject_header = _format_header('Subject', subject)
+        self._from_header = _format_header('From', from_addr)
+        self._reply_to_header = _format_header('Reply-To', reply_to) if reply_to else ''
+        # make_msgid() would otherwise look up the host's FQDN for every recipient
+        self._msgid_domain = email.utils.parseaddr(from_addr)[1].rpartition('@')[2] or None
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _encode_fragment(value):
+        return _qp_encode(html.escape(str(value)))
+
+    def build(self, recipient_email, **fragments):
+        """Assemble the wire-format bytes for one recipient. Fragments are HTML-escaped."""
+        body = [self._encoded[0]]
+        for slot, encoded in zip(self.slots, self._encoded[1:]):
+            body.extend([SOFT_BREAK, self._encode_fragment(fragments.get(slot, '')), SOFT_BREAK, encoded])
+
+        message_id = email.utils.make_msgid(idstring=self.msgid_token, domain=self._msgid_domain)
+        message = ''.join([
+            f'MIME-Version: 1.0{CRLF}',
+            f'Content-Type: multipart/alternative;{CRLF}',
+            f' boundary="{self._boundary}"{CRLF}',
+            self._subject_header,
+            self._from_header,
+            self._reply_to_header,
+            _format_header('To', recipient_email),
+            f"Date: {email.utils.formatdate(localtime=True)}{CRLF}",
+            f"Message-ID: {message_id}{CRLF}",
+            CRLF,
+            f'--{self._boundary}{CRLF}',
+            f'Content-Type: text/html; charset="utf-8"{CRLF}',
+            f'MIME-Version: 1.0{CRLF}',
+            f'Content-Transfer-Encoding: quoted-printable{CRLF}',
+            CRLF,
+            *body,
+            f'{CRLF}--{self._boundary}--{CRLF}'
+        ])
+        # Headers and QP body are pure ASCII by construction
+        data = message.encode('ascii')
+        if BARE_LF.search(data):
+            raise ValueError("Prepared message contains a bare LF line ending")
+        return data
+
+class MessageFactory:
+    """Builds PreparedMessages for a single sending address"""
+
+    def __init__(self, from_addr):
+        self.from_addr = from_addr
+
+    def prepare(self, subject, parts, reply_to=None, msgid_token=None):
+        """Prepare a message from static HTML and personalized slots"""
+        return PreparedMessage(subject, self.from_addr, parts, reply_to=reply_to, msgid_token=msgid_token)
+
+    def prepare_html(self, subject, html_content):
+        """Prepare a message whose body is identical for every recipient"""
+        return PreparedMessage(subject, self.from_addr, [html_content])
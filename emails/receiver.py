@@ -1,57 +1,446 @@
 import imaplib
 import email
 import logging
+import re
+import select
+import ssl
 from datetime import datetime
+from email.header import decode_header, make_header
+from email.parser import BytesFeedParser, BytesHeaderParser
+from .bodystructure import parse_fetch_response, find_text_part, find_item, walk_parts
+from .extraction import ReplyExtractor
+import metrics
 
 logger = logging.getLogger(__name__)
 
+IMAP_CONNECT_SECONDS = metrics.histogram(
+    'family_stories_imap_connect_seconds', 'Time to connect, log in and select the inbox')
+IMAP_COMMAND_SECONDS = metrics.histogram(
+    'family_stories_imap_command_seconds', 'Time for one IMAP round-trip while fetching replies', ('command',))
+IMAP_MESSAGES_FETCHED = metrics.counter(
+    'family_stories_imap_messages_fetched_total', 'Replies fetched from the mailbox')
+IMAP_TEXT_BYTES = metrics.counter(
+    'family_stories_imap_text_bytes_total', 'Bytes of reply text downloaded')
+
 class EmailReceiver:
-    def __init__(self, config):
+    SUBJECT_FILTER = 'Weekly Question'
+    FETCH_BATCH_SIZE = 50  # UIDs per FETCH command
+    MAX_TEXT_BYTES = 256 * 1024  # per-message cap on downloaded body text
+    FEED_CHUNK_SIZE = 16 * 1024
+    ATTACHMENT_CHUNK_SIZE = 256 * 1024  # bytes per partial FETCH while streaming an attachment
+    # Recipient and threading headers let a reply be routed to its family
+    HEADER_FIELDS = ('BODY.PEEK[HEADER.FIELDS (FROM MESSAGE-ID SUBJECT DATE TO CC DELIVERED-TO '
+                     'X-ORIGINAL-TO IN-REPLY-TO REFERENCES X-FAMILY-STORIES-FAMILY)]')
+    RECIPIENT_HEADERS = ('to', 'cc', 'delivered-to', 'x-original-to')
+    UID_PATTERN = re.compile(rb'UID (\d+)')
+    IDLE_REFRESH = 25 * 60  # seconds; servers may drop IDLE after 29 minutes (RFC 2177)
+    IDLE_BACKOFF_MIN = 5  # seconds
+    IDLE_BACKOFF_MAX = 300  # seconds
+    STOP_CHECK_INTERVAL = 1  # seconds between stop-event checks while idling
+
+    def __init__(self, config, database=None, attachment_store=None):
         self.config = config
         self.email_settings = config.email_settings
+        self.idle_refresh = self.email_settings.get('imap_idle_refresh', self.IDLE_REFRESH)
+        self.max_text_bytes = self.email_settings.get('imap_max_text_bytes', self.MAX_TEXT_BYTES)
+        # Where the UID high-water mark is persisted; kept in memory only when None
+        self.database = database
+        # Attachments stay on the server unless there is somewhere to put them
+        self.attachment_store = attachment_store
+        self._sync_state = None
+        self._pending_sync_state = None
 
-    def check_responses(self):
-        """Check for and process email responses"""
-        try:
-            logger.info(f"Connecting to IMAP server: {self.email_settings['imap_server']}")
-            mail = imaplib.IMAP4_SSL(self.email_settings['imap_server'])
+    def connect(self):
+        """Open an authenticated IMAP session with the inbox selected"""
+        server = self.email_settings['imap_server']
+        logger.info("Connecting to IMAP server: %s", server)
+        with IMAP_CONNECT_SECONDS.time():
+            if self.email_settings.get('imap_ssl', True):
+                mail = imaplib.IMAP4_SSL(server, self.email_settings.get('imap_port', imaplib.IMAP4_SSL_PORT))
+            else:
+                # Plain IMAP is only for local test servers
+                mail = imaplib.IMAP4(server, self.email_settings.get('imap_port', imaplib.IMAP4_PORT))
             mail.login(self.email_settings['username'], self.email_settings['password'])
             mail.select('inbox')
+        return mail
 
-            # Search for unread responses containing "Weekly Question" instead of exact subject match
-            _, messages = mail.search(None, 'UNSEEN SUBJECT "Weekly Question"')
-            responses = []
-            
-            for msg_num in messages[0].split():
-                try:
-                    _, msg_data = mail.fetch(msg_num, '(RFC822)')
-                    email_body = msg_data[0][1]
-                    email_message = email.message_from_bytes(email_body)
-                    
-                    # Extract sender information
-                    sender_email = email.utils.parseaddr(email_message['from'])[1]
-                    
-                    # Extract response text
-                    response_text = ""
-                    for part in email_message.walk():
-                        if part.get_content_type() == "text/plain":
-                            response_text = part.get_payload(decode=True).decode()
-                            break
-                    
-                    responses.append({
-                        "email": sender_email,
-                        "response_text": response_text,
-                        "timestamp": datetime.utcnow()
-                    })
-                    
-                except Exception as e:
-                    logger.error(f"Error processing message {msg_num}: {str(e)}")
-                    continue
-
+    @staticmethod
+    def disconnect(mail):
+        """Close the mailbox and log out, ignoring errors from a dead session"""
+        try:
             mail.close()
             mail.logout()
-            return responses
-            
+        except (imaplib.IMAP4.error, OSError):
+            pass
+
+    def check_responses(self):
+        """Check for and process email responses"""
+        try:
+            mail = self.connect()
+            try:
+                return self.fetch_responses(mail)
+            finally:
+                self.disconnect(mail)
+
         except Exception as e:
-            logger.error(f"Error checking email responses: {str(e)}")
+            logger.error("Error checking email responses: %s", e)
             raise
+
+    def _load_sync_state(self):
+        if self._sync_state is None and self.database is not None:
+            self._sync_state = self.database.get_mailbox_state()
+        return self._sync_state
+
+    def commit_sync(self):
+        """Advance the stored high-water mark past the last fetched batch.
+
+        Call only after the responses returned by fetch_responses() are stored,
+        so a failure in between means they are fetched again rather than lost.
+        """
+        if self._pending_sync_state is None:
+            return
+        state, self._pending_sync_state = self._pending_sync_state, None
+        if self.database is not None:
+            self.database.update_mailbox_state(state['uidvalidity'], state['last_uid'])
+        self._sync_state = state
+
+    @staticmethod
+    def _response_code(mail, name):
+        """The latest value of an untagged response code such as [UIDNEXT n], or None"""
+        values = mail.untagged_responses.get(name)
+        if not values:
+            return None
+        try:
+            return int(values[-1])
+        except (TypeError, ValueError):
+            return None
+
+    def _mailbox_status(self, mail):
+        """Return (uidvalidity, uidnext) for the selected inbox.
+
+        Both come from the untagged responses to SELECT; RFC 3501 says not to
+        send STATUS for the selected mailbox. UIDNEXT is optional, so without
+        it the highest UID in the mailbox stands in.
+        """
+        uidvalidity = self._response_code(mail, 'UIDVALIDITY')
+        uidnext = self._response_code(mail, 'UIDNEXT')
+        if uidnext is None:
+            # "UID *" matches the message with the highest UID, if there is one
+            uids = self._search_uids(mail, 'UID *')
+            uidnext = max(uids) + 1 if uids else 1
+        return uidvalidity, uidnext
+
+    def _search_uids(self, mail, criteria):
+        with IMAP_COMMAND_SECONDS.time(command='search'):
+            _, data = mail.uid('SEARCH', None, criteria)
+        return [int(uid) for uid in data[0].split()]
+
+    def _find_new_uids(self, mail):
+        """Find reply UIDs past the high-water mark and the mark to commit afterwards"""
+        uidvalidity, uidnext = self._mailbox_status(mail)
+        state = self._load_sync_state()
+
+        if state is None or state.get('uidvalidity') != uidvalidity:
+            # First run, or the server renumbered the mailbox: fall back to the
+            # unseen flag once to pick up a starting point
+            if state is not None:
+                logger.warning("Mailbox UIDVALIDITY changed from %s to %s, resyncing",
+                               state.get('uidvalidity'), uidvalidity)
+            uids = self._search_uids(mail, f'UNSEEN SUBJECT "{self.SUBJECT_FILTER}"')
+            last_uid = uidnext - 1
+        else:
+            last_uid = state['last_uid']
+            # "n:*" always matches the newest message, even when its UID is below n
+            uids = [uid for uid in self._search_uids(mail, f'UID {last_uid + 1}:* SUBJECT "{self.SUBJECT_FILTER}"')
+                    if uid > last_uid]
+            last_uid = max(last_uid, uidnext - 1)
+
+        if uids:
+            last_uid = max(last_uid, max(uids))
+        return uids, {'uidvalidity': uidvalidity, 'last_uid': last_uid}
+
+    def _batches(self, uids):
+        for start in range(0, len(uids), self.FETCH_BATCH_SIZE):
+            yield ','.join(str(uid) for uid in uids[start:start + self.FETCH_BATCH_SIZE])
+
+    def _fetch_structures(self, mail, uids):
+        """Fetch BODYSTRUCTURE and the few headers we need, several messages per command"""
+        messages = {}
+        for uid_set in self._batches(uids):
+            with IMAP_COMMAND_SECONDS.time(command='fetch_structure'):
+                _, data = mail.uid('FETCH', uid_set, f'(UID BODYSTRUCTURE {self.HEADER_FIELDS})')
+            messages.update(parse_fetch_response(data))
+        return messages
+
+    def _fetch_sections(self, mail, uids, section):
+        """Fetch at most max_text_bytes of one body section for each UID"""
+        bodies = {}
+        for uid_set in self._batches(uids):
+            with IMAP_COMMAND_SECONDS.time(command='fetch_text'):
+                _, data = mail.uid('FETCH', uid_set, f'(UID BODY.PEEK[{section}]<0.{self.max_text_bytes}>)')
+            for uid, attributes in parse_fetch_response(data).items():
+                bodies[uid] = find_item(attributes, f'BODY[{section}]') or b''
+                IMAP_TEXT_BYTES.inc(len(bodies[uid]))
+        return bodies
+
+    def _decode_part(self, part, body):
+        """Decode a fetched body section with an incremental MIME parser"""
+        if len(body) >= self.max_text_bytes:
+            logger.warning("Message text exceeds %s bytes, truncating", self.max_text_bytes)
+            # Drop the partial last line so a cut base64 quad or QP escape doesn't garble the end
+            body = body[:body.rfind(b'\n') + 1]
+
+        charset_param = f'; charset="{part["charset"]}"' if part['charset'] else ''
+        parser = BytesFeedParser()
+        parser.feed((
+            f'Content-Type: {part["content_type"]}{charset_param}\r\n'
+            f'Content-Transfer-Encoding: {part["encoding"]}\r\n\r\n'
+        ).encode('ascii', 'replace'))
+        for start in range(0, len(body), self.FEED_CHUNK_SIZE):
+            parser.feed(body[start:start + self.FEED_CHUNK_SIZE])
+        payload = parser.close().get_payload(decode=True) or b''
+        return ReplyExtractor.decode(payload, part['charset'])
+
+    @staticmethod
+    def _attachment_parts(structure, text_part):
+        """Parts worth keeping besides the reply text: anything attached, and inline non-text media"""
+        text_section = text_part['section'] if text_part else None
+        return [part for part in walk_parts(structure)
+                if part['section'] != text_section
+                and (part['disposition'] == 'attachment' or not part['content_type'].startswith('text/'))]
+
+    def _stream_section(self, mail, uid, section):
+        """Yield one body section in ATTACHMENT_CHUNK_SIZE pieces, one partial FETCH each"""
+        offset = 0
+        while True:
+            with IMAP_COMMAND_SECONDS.time(command='fetch_attachment'):
+                _, data = mail.uid('FETCH', str(uid),
+                                   f'(UID BODY.PEEK[{section}]<{offset}.{self.ATTACHMENT_CHUNK_SIZE}>)')
+            attributes = parse_fetch_response(data).get(uid) or {}
+            chunk = find_item(attributes, f'BODY[{section}]') or b''
+            if chunk:
+                yield chunk
+            if len(chunk) < self.ATTACHMENT_CHUNK_SIZE:
+                return
+            offset += len(chunk)
+
+    @staticmethod
+    def _filename(part):
+        filename = part['filename']
+        if not filename:
+            return None
+        try:
+            # Mail clients commonly send non-ASCII names as RFC 2047 encoded words
+            return str(make_header(decode_header(filename)))
+        except Exception:
+            return filename
+
+    def _save_attachments(self, mail, uid, parts):
+        """Stream each attachment into the attachment store and return their references"""
+        saved = []
+        for part in parts:
+            filename = self._filename(part)
+            if part['size'] > self.attachment_store.max_bytes:
+                logger.warning("Skipping attachment %s of message %s: %s bytes is over the %s byte limit",
+                               filename, uid, part['size'], self.attachment_store.max_bytes)
+                continue
+            try:
+                saved.append(self.attachment_store.save(
+                    self._stream_section(mail, uid, part['section']),
+                    filename=filename,
+                    content_type=part['content_type'],
+                    encoding=part['encoding']
+                ))
+            except (imaplib.IMAP4.abort, OSError):
+                # The session is gone; let the batch be fetched again
+                raise
+            except Exception as e:
+                logger.error("Failed to save attachment %s of message %s: %s", filename, uid, e)
+        return saved
+
+    def fetch_responses(self, mail):
+        """Fetch responses that arrived since the last committed UID over a selected session.
+
+        Only the first text/plain part (or text/html for HTML-only replies) of
+        each message is downloaded whole, up to max_text_bytes. With an
+        attachment store, attachments and inline media are streamed into it
+        in chunks; without one they never leave the server. raw_text is the
+        decoded part as sent, quoted history included.
+        """
+        uids, sync_state = self._find_new_uids(mail)
+        responses = []
+        if not uids:
+            self._pending_sync_state = sync_state
+            return responses
+
+        structures = self._fetch_structures(mail, uids)
+
+        # Group messages by the section holding their text so each section is one FETCH
+        text_parts = {}
+        sections = {}
+        for uid, attributes in structures.items():
+            try:
+                part = find_text_part(attributes.get('BODYSTRUCTURE') or [])
+            except Exception as e:
+                logger.error("Error reading structure of message %s: %s", uid, e)
+                part = None
+            if part is not None:
+                text_parts[uid] = part
+                sections.setdefault(part['section'], []).append(uid)
+
+        bodies = {}
+        for section, section_uids in sections.items():
+            bodies.update(self._fetch_sections(mail, section_uids, section))
+
+        failed = []
+        for uid in uids:
+            try:
+                attributes = structures.get(uid)
+                if attributes is None:
+                    continue
+                headers = BytesHeaderParser().parsebytes(find_item(attributes, 'BODY[HEADER') or b'')
+
+                # Extract sender information
+                sender_email = email.utils.parseaddr(headers['from'])[1]
+
+                # Extract response text
+                raw_text, content_type = "", "text/plain"
+                if uid in text_parts:
+                    raw_text = self._decode_part(text_parts[uid], bodies.get(uid, b''))
+                    content_type = text_parts[uid]['content_type']
+
+                recipients = [address for _, address in email.utils.getaddresses(
+                    [value for name in self.RECIPIENT_HEADERS for value in headers.get_all(name, [])]
+                ) if address]
+
+                responses.append({
+                    "uid": uid,
+                    "message_id": headers['message-id'],
+                    "email": sender_email,
+                    "raw_text": raw_text,
+                    "content_type": content_type,
+                    "timestamp": datetime.utcnow(),
+                    # Routing hints for multi-family setups
+                    "recipients": recipients,
+                    "references": ' '.join(filter(None, [headers['in-reply-to'], headers['references']])),
+                    "family_header": headers['x-family-stories-family']
+                })
+                if self.attachment_store is not None:
+                    parts = self._attachment_parts(attributes.get('BODYSTRUCTURE') or [], text_parts.get(uid))
+                    if parts:
+                        responses[-1]["attachments"] = self._save_attachments(mail, uid, parts)
+
+            except (imaplib.IMAP4.abort, OSError):
+                raise
+
+            except Exception as e:
+                logger.error("Error processing message %s: %s", uid, e)
+                failed.append(uid)
+                continue
+
+        if failed:
+            # Hold the high-water mark below the first failure so that message is fetched
+            # again next time; replies after it are deduplicated by Message-ID when stored
+            state = self._load_sync_state()
+            floor = state['last_uid'] if state and state.get('uidvalidity') == sync_state['uidvalidity'] else 0
+            sync_state['last_uid'] = max(floor, min(sync_state['last_uid'], min(failed) - 1))
+            logger.warning("Will retry message %s and later on the next check", min(failed))
+
+        IMAP_MESSAGES_FETCHED.inc(len(responses))
+        self._pending_sync_state = sync_state
+        return responses
+
+    @staticmethod
+    def _has_buffered_data(mail):
+        """Whether a response is already readable without waiting on the socket.
+
+        imaplib reads through a BufferedReader (mail.file), so a line that
+        arrived in the same segment as the one just read sits in its buffer
+        where select() can't see it; so can a TLS record already decrypted.
+        peek() returns buffered bytes without any I/O, and with the socket
+        briefly non-blocking it can't wait when the buffer is empty.
+        """
+        timeout = mail.sock.gettimeout()
+        mail.sock.settimeout(0)
+        try:
+            return bool(mail.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            mail.sock.settimeout(timeout)
+
+    def _wait_for_data(self, mail, timeout, stop_event):
+        """Wait until the server sends something, the timeout passes or stop_event is set"""
+        waited = 0
+        while waited < timeout and not stop_event.is_set():
+            if self._has_buffered_data(mail):
+                return True
+            readable, _, _ = select.select([mail.sock], [], [], self.STOP_CHECK_INTERVAL)
+            if readable:
+                return True
+            waited += self.STOP_CHECK_INTERVAL
+        return False
+
+    def idle(self, mail, stop_event):
+        """Run one IMAP IDLE cycle. Returns True if new messages arrived.
+
+        imaplib has no IDLE command before Python 3.14, so this drives the
+        session by hand: it relies on imaplib's private _new_tag() for a
+        command tag, plus the sock/file attributes and send()/readline().
+        """
+        tag = mail._new_tag()
+        mail.send(tag + b' IDLE\r\n')
+        response = mail.readline()
+        if not response.startswith(b'+'):
+            raise imaplib.IMAP4.error(f"IDLE rejected: {response.strip()!r}")
+
+        new_mail = False
+        try:
+            while self._wait_for_data(mail, self.idle_refresh, stop_event):
+                line = mail.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("Connection closed during IDLE")
+                logger.debug("IDLE update: %r", line.strip())
+                if line.rstrip().endswith(b'EXISTS'):
+                    new_mail = True
+                    break
+        finally:
+            # End IDLE and read through to the tagged completion
+            mail.send(b'DONE\r\n')
+            while True:
+                line = mail.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("Connection closed while ending IDLE")
+                if line.startswith(tag):
+                    break
+        return new_mail
+
+    def listen(self, on_responses, stop_event):
+        """Keep one IMAP session open and hand new responses to on_responses as they arrive.
+
+        The high-water mark is committed after on_responses returns. Reconnects with exponential backoff until stop_event is set.
+        """
+        backoff = self.IDLE_BACKOFF_MIN
+        while not stop_event.is_set():
+            mail = None
+            try:
+                mail = self.connect()
+                if 'IDLE' not in mail.capabilities:
+                    raise imaplib.IMAP4.error("IMAP server does not support IDLE")
+                backoff = self.IDLE_BACKOFF_MIN
+
+                # Pick up anything that arrived while we were disconnected
+                on_responses(self.fetch_responses(mail))
+                self.commit_sync()
+                while not stop_event.is_set():
+                    if self.idle(mail, stop_event):
+                        on_responses(self.fetch_responses(mail))
+                        self.commit_sync()
+
+            except Exception as e:
+                logger.error("IMAP IDLE session failed: %s. Reconnecting in %s seconds", e, backoff)
+                stop_event.wait(backoff)
+                backoff = min(backoff * 2, self.IDLE_BACKOFF_MAX)
+            finally:
+                if mail is not None:
+                    self.disconnect(mail)
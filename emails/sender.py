@@ -1,80 +1,325 @@
 from email.mime.text import MIMEText
+from html import escape
 from email.mime.multipart import MIMEMultipart
 import smtplib
 import logging
+import threading
+import time
+from contextlib import contextmanager
 from .templates import WeeklyQuestionEmail, ConfirmationEmail
+from .message_factory import MessageFactory
+import metrics
 
 logger = logging.getLogger(__name__)
 
+SMTP_CONNECT_SECONDS = metrics.histogram(
+    'family_stories_smtp_connect_seconds', 'Time to connect, start TLS and log in to the SMTP server')
+SMTP_POOL_WAIT_SECONDS = metrics.histogram(
+    'family_stories_smtp_pool_wait_seconds', 'Time spent waiting for a pooled SMTP session')
+SMTP_SEND_SECONDS = metrics.histogram(
+    'family_stories_smtp_send_seconds', 'Time for the SMTP server to accept one message')
+EMAILS_SENT = metrics.counter(
+    'family_stories_emails_sent_total', 'Messages handed to the SMTP server', ('status',))
+
+class SMTPConnectionPool:
+    """Keeps authenticated SMTP sessions alive so sends can reuse them"""
+    DEFAULT_POOL_SIZE = 4
+    DEFAULT_IDLE_TIMEOUT = 300  # seconds
+    DEFAULT_TIMEOUT = 30  # seconds, so a hanging server can't stall a send forever
+
+    def __init__(self, smtp_server, smtp_port, username, password,
+                 max_size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT, timeout=DEFAULT_TIMEOUT,
+                 starttls=True):
+        self.smtp_server = smtp_server
+        self.smtp_port = smtp_port
+        self.username = username
+        self.password = password
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        # Only a local test server should ever turn this off
+        self.starttls = starttls
+        self._idle = []  # (server, last_used) pairs, most recently used last
+        self._open_count = 0
+        self._closed = False
+        self._lock = threading.Condition()
+
+    def _connect(self):
+        """Open a new SMTP session, upgrade it to TLS and log in"""
+        logger.debug("Creating SMTP connection to %s:%s...", self.smtp_server, self.smtp_port)
+        with SMTP_CONNECT_SECONDS.time():
+            server = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=self.timeout)
+            try:
+                if self.starttls:
+                    logger.debug("Starting TLS...")
+                    server.starttls()
+
+                logger.debug("Attempting login for user %s", self.username)
+                server.login(self.username, self.password)
+            except Exception:
+                self._discard(server)
+                raise
+        return server
+
+    @staticmethod
+    def _is_alive(server):
+        """Check a pooled session with NOOP before handing it out"""
+        try:
+            return server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    @staticmethod
+    def _discard(server):
+        """Close a session, ignoring errors from an already dead connection"""
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+    def _expire_idle(self):
+        """Drop idle sessions older than the idle timeout. Caller holds the lock."""
+        cutoff = time.monotonic() - self.idle_timeout
+        expired = [server for server, last_used in self._idle if last_used < cutoff]
+        if expired:
+            self._idle = [(server, last_used) for server, last_used in self._idle if last_used >= cutoff]
+            self._open_count -= len(expired)
+            self._lock.notify(len(expired))
+        return expired
+
+    def acquire(self):
+        """Get a live, authenticated session, opening a new one if needed"""
+        while True:
+            with self._lock:
+                expired = self._expire_idle()
+                while not self._idle and self._open_count >= self.max_size:
+                    self._lock.wait()
+                if self._idle:
+                    server, _ = self._idle.pop()
+                else:
+                    server = None
+                    self._open_count += 1
+
+            for stale in expired:
+                logger.debug("Closing idle SMTP connection")
+                self._discard(stale)
+
+            if server is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+
+            if self._is_alive(server):
+                return server
+
+            logger.debug("Pooled SMTP connection failed NOOP check, reconnecting...")
+            self._discard(server)
+            self._release_slot()
+
+    def release(self, server, broken=False):
+        """Return a session to the pool, or close it if it is no longer usable or the pool is closed"""
+        with self._lock:
+            if not broken and not self._closed:
+                self._idle.append((server, time.monotonic()))
+                self._lock.notify()
+                return
+        self._discard(server)
+        self._release_slot()
+
+    def _release_slot(self):
+        with self._lock:
+            self._open_count -= 1
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that borrows a session and returns it afterwards"""
+        with SMTP_POOL_WAIT_SECONDS.time():
+            server = self.acquire()
+        try:
+            yield server
+        except (smtplib.SMTPServerDisconnected, OSError):
+            self.release(server, broken=True)
+            raise
+        except BaseException:
+            self.release(server)
+            raise
+        else:
+            self.release(server)
+
+    def close_idle(self):
+        """Close sessions that have been idle longer than the idle timeout"""
+        with self._lock:
+            expired = self._expire_idle()
+        for server in expired:
+            logger.debug("Closing idle SMTP connection")
+            self._discard(server)
+
+    def close(self):
+        """Close every idle session; sessions still checked out are closed when released"""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._open_count -= len(idle)
+            self._lock.notify_all()
+        for server, _ in idle:
+            self._discard(server)
+
 class EmailSender:
-    def __init__(self, smtp_server, smtp_port, username, password):
+    # Shared <head> for forwards and digests
+    FORWARD_HTML_HEAD = """
+        <html>
+        <head>
+            <style>
+                body { font-family: Arial, sans-serif; line-height: 1.6; color: #333; }
+                .container { max-width: 600px; margin: 0 auto; padding: 20px; }
+                .header { color: #2c3e50; margin-bottom: 20px; }
+                .question { font-style: italic; color: #7f8c8d; margin-bottom: 15px; }
+                .response { background-color: #f9f9f9; padding: 15px; border-left: 4px solid #3498db; margin-bottom: 20px; }
+                .attachments { margin-bottom: 20px; }
+                .footer { font-size: 0.9em; color: #7f8c8d; margin-top: 30px; border-top: 1px solid #eee; padding-top: 10px; }
+            </style>
+        </head>
+        """
+
+    def __init__(self, smtp_server, smtp_port, username, password,
+                 pool_size=SMTPConnectionPool.DEFAULT_POOL_SIZE,
+                 idle_timeout=SMTPConnectionPool.DEFAULT_IDLE_TIMEOUT,
+                 timeout=SMTPConnectionPool.DEFAULT_TIMEOUT,
+                 starttls=True, attachment_base_url=None):
         self.smtp_server = smtp_server
         self.smtp_port = smtp_port
         self.username = username
         self.password = password
+        self.pool = SMTPConnectionPool(
+            smtp_server, smtp_port, username, password,
+            max_size=pool_size,
+            idle_timeout=idle_timeout,
+            timeout=timeout,
+            starttls=starttls
+        )
+        self.message_factory = MessageFactory(username)
+        # Forwards link attachments as <base url>/<file id> when set, otherwise just list them
+        self.attachment_base_url = attachment_base_url.rstrip('/') if attachment_base_url else None
+
+    @classmethod
+    def from_config(cls, config):
+        """A sender built from the email: and attachments: sections of config.yml"""
+        settings = config.email_settings
+        return cls(
+            smtp_server=settings['smtp_server'],
+            smtp_port=settings['smtp_port'],
+            username=settings['username'],
+            password=settings['password'],
+            pool_size=settings.get('smtp_pool_size', SMTPConnectionPool.DEFAULT_POOL_SIZE),
+            idle_timeout=settings.get('smtp_idle_timeout', SMTPConnectionPool.DEFAULT_IDLE_TIMEOUT),
+            timeout=settings.get('smtp_timeout', SMTPConnectionPool.DEFAULT_TIMEOUT),
+            starttls=settings.get('smtp_starttls', True),
+            attachment_base_url=config.attachment_settings.get('base_url')
+        )
 
-    def send_weekly_question(self, recipient_email, recipient_name, questioner_name, question, quote, quote_author, question_number=None):
-        """Send weekly question email to a family member"""
+    @staticmethod
+    def _timed_send(send, server):
         try:
-            logger.info(f"Sending weekly question to {recipient_email}")
-            logger.debug(f"Attempting to connect to SMTP server {self.smtp_server}:{self.smtp_port}")
-            
-            # Get email content
-            html_content = WeeklyQuestionEmail.get_content(
-                question=question,
-                recipient_name=recipient_name,
-                questioner_name=questioner_name,
-                quote=quote,
-                quote_author=quote_author,
-                question_number=question_number
-            )
-            
-            # Create message
-            msg = MIMEMultipart('alternative')
-            msg['Subject'] = f"Family Stories - Weekly Question #{question_number:02d}"
-            msg['From'] = self.username
-            msg['To'] = recipient_email
+            with SMTP_SEND_SECONDS.time():
+                send(server)
+        except Exception:
+            EMAILS_SENT.inc(status='failed')
+            raise
+        EMAILS_SENT.inc(status='sent')
+
+    def _with_connection(self, send):
+        """Run send(server) on a pooled session, reconnecting once if the server dropped it"""
+        try:
+            with self.pool.connection() as server:
+                self._timed_send(send, server)
+        except smtplib.SMTPServerDisconnected:
+            logger.warning("SMTP server disconnected, retrying with a new connection")
+            with self.pool.connection() as server:
+                self._timed_send(send, server)
+
+    def _send(self, msg):
+        """Send a Message object over a pooled session"""
+        self._with_connection(lambda server: server.send_message(msg))
+
+    def _send_raw(self, recipient_email, data):
+        """Send pre-built message bytes over a pooled session"""
+        self._with_connection(lambda server: server.sendmail(self.username, [recipient_email], data))
+
+    def send_prepared(self, prepared, recipient_email, **fragments):
+        """Send a PreparedMessage to one recipient with their personalized fragments"""
+        self._send_raw(recipient_email, prepared.build(recipient_email, **fragments))
+
+    def prepare_weekly_question(self, questioner_name, question, quote, quote_author, question_number=None,
+                                reply_to=None, msgid_token=None):
+        """Render and encode the weekly newsletter once; only the greeting varies per recipient.
+
+        reply_to and msgid_token tag the message so replies can be routed back to a family.
+        """
+        parts = WeeklyQuestionEmail.get_parts(
+            question=question,
+            questioner_name=questioner_name,
+            quote=quote,
+            quote_author=quote_author,
+            question_number=question_number
+        )
+        return self.message_factory.prepare(
+            f"Family Stories - Weekly Question #{question_number:02d}",
+            parts,
+            reply_to=reply_to,
+            msgid_token=msgid_token
+        )
+
+    def close(self):
+        """Close all pooled SMTP sessions"""
+        self.pool.close()
+
+    def send_weekly_question(self, recipient_email, recipient_name, questioner_name, question, quote, quote_author,
+                             question_number=None, prepared=None):
+        """Send weekly question email to a family member.
+
+        Pass a message from prepare_weekly_question() as prepared to skip
+        rendering and encoding the newsletter body for every recipient.
+        """
+        try:
+            logger.info("Sending weekly question to %s", recipient_email)
             
-            # Attach HTML version
-            msg.attach(MIMEText(html_content, 'html'))
+            if prepared is None:
+                prepared = self.prepare_weekly_question(
+                    questioner_name=questioner_name,
+                    question=question,
+                    quote=quote,
+                    quote_author=quote_author,
+                    question_number=question_number
+                )
             
             # Send email with detailed logging
             try:
-                logger.debug("Creating SMTP connection...")
-                server = smtplib.SMTP(self.smtp_server, self.smtp_port)
-                
-                logger.debug("Starting TLS...")
-                server.starttls()
-                
-                logger.debug(f"Attempting login for user {self.username}")
-                server.login(self.username, self.password)
-                
                 logger.debug("Sending message...")
-                server.send_message(msg)
+                self.send_prepared(prepared, recipient_email, recipient_name=recipient_name)
                 
-                logger.debug("Closing connection...")
-                server.quit()
-                
-                logger.info(f"Successfully sent weekly question to {recipient_email}")
+                logger.info("Successfully sent weekly question to %s", recipient_email)
                 
             except smtplib.SMTPAuthenticationError as auth_error:
-                logger.error(f"SMTP Authentication failed: {str(auth_error)}")
+                logger.error("SMTP Authentication failed: %s", auth_error)
                 raise
             except smtplib.SMTPException as smtp_error:
-                logger.error(f"SMTP error occurred: {str(smtp_error)}")
+                logger.error("SMTP error occurred: %s", smtp_error)
                 raise
             except Exception as e:
-                logger.error(f"Unexpected error during SMTP operation: {str(e)}")
+                logger.error("Unexpected error during SMTP operation: %s", e)
                 raise
             
         except Exception as e:
-            logger.error(f"Failed to send weekly question to {recipient_email}: {str(e)}")
+            logger.error("Failed to send weekly question to %s: %s", recipient_email, e)
             raise
 
     def send_confirmation(self, recipient_email, recipient_name, question):
         """Send confirmation email after receiving a response"""
         try:
-            logger.info(f"Sending confirmation to {recipient_email}")
+            logger.info("Sending confirmation to %s", recipient_email)
             
             # Get email content
             html_content = ConfirmationEmail.get_content(
@@ -92,97 +337,144 @@ class EmailSender:
             msg.attach(MIMEText(html_content, 'html'))
             
             # Send email
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                server.starttls()
-                server.login(self.username, self.password)
-                server.send_message(msg)
+            self._send(msg)
                 
-            logger.info(f"Successfully sent confirmation to {recipient_email}")
+            logger.info("Successfully sent confirmation to %s", recipient_email)
             
         except Exception as e:
-            logger.error(f"Failed to send confirmation to {recipient_email}: {str(e)}")
+            logger.error("Failed to send confirmation to %s: %s", recipient_email, e)
             raise
 
+    @staticmethod
+    def _format_size(length):
+        if length < 1024:
+            return f"{length} bytes"
+        if length < 1024 * 1024:
+            return f"{length / 1024:.1f} KB"
+        return f"{length / (1024 * 1024):.1f} MB"
+
+    def _attachment_list(self, attachments):
+        """HTML listing a response's stored attachments, linked when a base URL is configured"""
+        if not attachments:
+            return ""
+        items = []
+        for attachment in attachments:
+            name = escape(attachment.get('filename') or 'attachment')
+            if self.attachment_base_url:
+                name = f'<a href="{self.attachment_base_url}/{attachment["file_id"]}">{name}</a>'
+            items.append(f"<li>{name} ({self._format_size(attachment.get('length') or 0)})</li>")
+        return f"""
+                <div class="attachments">
+                    <strong>Attachments:</strong>
+                    <ul>{''.join(items)}</ul>
+                </div>
+        """
+
+    def prepare_forward(self, sender_name, response_text, question, attachments=None):
+        """Render and encode a forwarded response once for all of its recipients.
+
+        Attachments are listed (or linked) rather than re-attached, so each
+        recipient's copy stays small.
+        """
+        # Reply text and names come from email, so escape them before they go into the HTML
+        formatted_response = escape(response_text or '').replace('\n', '<br>')
+        sender_html = escape(sender_name or '')
+        question_html = escape(question or '')
+        
+        # Now use f-strings for the dynamic content
+        html_body = f"""
+        <body>
+            <div class="container">
+                <h2 class="header">Family Story Response</h2>
+                <p>{sender_html} has shared a response to our family story question:</p>
+                
+                <div class="question">
+                    <strong>Question:</strong> {question_html}
+                </div>
+                
+                <div class="response">
+                    <strong>{sender_html}'s Response:</strong><br><br>
+                    {formatted_response}
+                </div>
+                {self._attachment_list(attachments)}
+                <div class="footer">
+                    <p>This is an automated message from the Family Stories app.</p>
+                </div>
+            </div>
+        </body>
+        </html>
+        """
+        
+        # Combine the HTML parts
+        html_content = self.FORWARD_HTML_HEAD + html_body
+        
+        return self.message_factory.prepare_html(f"Family Story Response: {sender_name}", html_content)
+
+    def prepare_digest(self, family_name, groups):
+        """Render and encode a digest of replies, grouped by question, for one recipient.
+
+        groups is a list of {"question", "replies"} as built by ReplyDigest,
+        each reply a dict with name, text and attachments.
+        """
+        sections = []
+        count = 0
+        for group in groups:
+            replies = []
+            for reply in group['replies']:
+                count += 1
+                name = escape(reply.get('name') or 'Family Member')
+                text = escape(reply.get('text') or '').replace('\n', '<br>')
+                replies.append(f"""
+                <div class="response">
+                    <strong>{name}'s Response:</strong><br><br>
+                    {text}
+                </div>
+                {self._attachment_list(reply.get('attachments'))}""")
+            sections.append(f"""
+                <div class="question">
+                    <strong>Question:</strong> {escape(group.get('question') or '')}
+                </div>
+                {''.join(replies)}""")
+
+        noun = 'response' if count == 1 else 'responses'
+        html_body = f"""
+        <body>
+            <div class="container">
+                <h2 class="header">Family Stories Digest</h2>
+                <p>{count} new {noun} from {escape(family_name)} since your last digest:</p>
+                {''.join(sections)}
+                <div class="footer">
+                    <p>This is an automated message from the Family Stories app.</p>
+                </div>
+            </div>
+        </body>
+        </html>
+        """
+        return self.message_factory.prepare_html(
+            f"Family Stories Digest: {count} new {noun}", self.FORWARD_HTML_HEAD + html_body
+        )
+
     def forward_response(self, sender_email, sender_name, response_text, question, recipients):
         """Forward a family member's response to a list of recipients"""
         try:
-            logger.info(f"Forwarding response from {sender_email} to {len(recipients)} recipients")
+            logger.info("Forwarding response from %s to %s recipients", sender_email, len(recipients))
             
-            # Create message
-            msg = MIMEMultipart('alternative')
-            msg['Subject'] = f"Family Story Response: {sender_name}"
-            msg['From'] = self.username
-            
-            # Preprocess the response text to replace newlines with <br> tags
-            formatted_response = response_text.replace('\n', '<br>')
-            
-            # Create HTML content
-            html_head = """
-            <html>
-            <head>
-                <style>
-                    body { font-family: Arial, sans-serif; line-height: 1.6; color: #333; }
-                    .container { max-width: 600px; margin: 0 auto; padding: 20px; }
-                    .header { color: #2c3e50; margin-bottom: 20px; }
-                    .question { font-style: italic; color: #7f8c8d; margin-bottom: 15px; }
-                    .response { background-color: #f9f9f9; padding: 15px; border-left: 4px solid #3498db; margin-bottom: 20px; }
-                    .footer { font-size: 0.9em; color: #7f8c8d; margin-top: 30px; border-top: 1px solid #eee; padding-top: 10px; }
-                </style>
-            </head>
-            """
-            
-            # Now use f-strings for the dynamic content
-            html_body = f"""
-            <body>
-                <div class="container">
-                    <h2 class="header">Family Story Response</h2>
-                    <p>{sender_name} has shared a response to our family story question:</p>
-                    
-                    <div class="question">
-                        <strong>Question:</strong> {question}
-                    </div>
-                    
-                    <div class="response">
-                        <strong>{sender_name}'s Response:</strong><br><br>
-                        {formatted_response}
-                    </div>
-                    
-                    <div class="footer">
-                        <p>This is an automated message from the Family Stories app.</p>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
-            
-            # Combine the HTML parts
-            html_content = html_head + html_body
-            
-            # Attach HTML version
-            msg.attach(MIMEText(html_content, 'html'))
+            # Encode the body once; each recipient only gets their own headers
+            prepared = self.prepare_forward(sender_name, response_text, question)
             
             # Send to each recipient
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                server.starttls()
-                server.login(self.username, self.password)
-                
-                for recipient in recipients:
-                    try:
-                        # Set recipient for this specific email
-                        msg['To'] = recipient['email']
-                        server.send_message(msg)
-                        logger.info(f"Successfully forwarded response to {recipient['email']}")
-                        
-                        # Clear the 'To' field for the next recipient
-                        del msg['To']
-                        
-                    except Exception as e:
-                        logger.error(f"Failed to forward response to {recipient['email']}: {str(e)}")
-                        # Continue with other recipients even if one fails
-                        continue
+            for recipient in recipients:
+                try:
+                    self.send_prepared(prepared, recipient['email'])
+                    logger.info("Successfully forwarded response to %s", recipient['email'])
+                    
+                except Exception as e:
+                    logger.error("Failed to forward response to %s: %s", recipient['email'], e)
+                    # Continue with other recipients even if one fails
+                    continue
                 
             return True
             
         except Exception as e:
-            logger.error(f"Failed to forward response: {str(e)}")
+            logger.error("Failed to forward response: %s", e)
             return False
@@ -1,16 +1,131 @@
 from datetime import datetime
+import html as html_lib
 import os
 import logging
+import threading
 from pathlib import Path
 import re
+import metrics
 
 logger = logging.getLogger(__name__)
 
+TEMPLATE_RENDER_SECONDS = metrics.histogram(
+    'family_stories_template_render_seconds', 'Time to render an email template', ('template',))
+TEMPLATE_COMPILES = metrics.counter(
+    'family_stories_template_compiles_total', 'Times a template was read and compiled from disk', ('template',))
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+class CompiledTemplate:
+    """HTML template parsed once into static segments and placeholder slots.
+
+    The file is re-read only when its mtime changes, so a render is a single
+    join of precomputed segments with HTML-escaped values.
+    """
+    PLACEHOLDER = re.compile(r'\{\{(\w+)\}\}')
+
+    def __init__(self, path, preprocess=None):
+        self.path = path
+        self.preprocess = preprocess
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self._mtime = None
+        self._parts = []
+        self._slots = []  # (index into _parts, placeholder name)
+        self._lock = threading.Lock()
+        try:
+            self._refresh()
+        except OSError as e:
+            logger.error("Failed to load template %s: %s", path, e)
+
+    def _compile(self, source):
+        if self.preprocess:
+            source = self.preprocess(source)
+        # re.split with a capture group alternates static text and placeholder names
+        parts = self.PLACEHOLDER.split(source)
+        slots = [(index, parts[index]) for index in range(1, len(parts), 2)]
+        return parts, slots
+
+    def _refresh(self):
+        """Reload and recompile the template if the file changed on disk"""
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            logger.debug("Compiling template: %s", self.path)
+            with open(self.path, 'r', encoding='utf-8') as file:
+                parts, slots = self._compile(file.read())
+            self._parts, self._slots, self._mtime = parts, slots, mtime
+            TEMPLATE_COMPILES.inc(template=self.name)
+
+    def render(self, **values):
+        """Fill the placeholder slots with escaped values. Unknown placeholders are left as-is."""
+        with TEMPLATE_RENDER_SECONDS.time(template=self.name):
+            self._refresh()
+            parts = list(self._parts)
+            for index, name in self._slots:
+                if name in values:
+                    parts[index] = html_lib.escape(str(values[name]))
+                else:
+                    parts[index] = '{{' + name + '}}'
+            return ''.join(parts)
+
+    def render_parts(self, personalized, **values):
+        """Render everything except the personalized slots.
+
+        Returns a list alternating static HTML and personalized slot names,
+        always starting and ending with static HTML.
+        """
+        with TEMPLATE_RENDER_SECONDS.time(template=self.name):
+            self._refresh()
+            result = ['']
+            for index, part in enumerate(self._parts):
+                if index % 2 == 0:
+                    result[-1] += part
+                elif part in personalized:
+                    result.extend([part, ''])
+                elif part in values:
+                    result[-1] += html_lib.escape(str(values[part]))
+                else:
+                    result[-1] += '{{' + part + '}}'
+            return result
+
+def _add_content_type_meta(html):
+    # Add Content-Type meta tag if not present
+    if '<meta http-equiv="Content-Type"' not in html:
+        head_end = '</head>'
+        meta_tag = '<meta http-equiv="Content-Type" content="text/html; charset=UTF-8">\n'
+        html = html.replace(head_end, meta_tag + head_end)
+    return html
+
+def _adapt_confirmation_template(html):
+    # The confirmation email reuses a sign-up template; rewrite its copy once at compile time
+    html = html.replace('Jan 2025', '{{current_date}}')
+    
+    # Update message content
+    html = html.replace('Welcome to Family History', 'Thank You for Sharing')
+    html = html.replace('Thanks for signing up!', 'Response Received: "{{question}}"')
+    html = html.replace('Confirm your subscription', 'Your story has been saved')
+    html = html.replace('<a href="#insertUrlLink"', '<a href="#"')  # Remove subscription link functionality
+    html = html.replace('Yes, I want to subscribe', 'View Your Stories')
+    
+    # Update footer text
+    footer_text = """If you have any questions about your stored stories or need assistance accessing them, 
+                            you can reply to this email or contact us at familyhistory@mail.com."""
+    return re.sub(r'If you didn\'t subscribe.*?familyhistory@mail\.com\.', 
+                  footer_text, 
+                  html, 
+                  flags=re.DOTALL)
+
 class WeeklyQuestionEmail:
+    template = CompiledTemplate(
+        os.path.join(TEMPLATE_DIR, 'weekly_question.html'),
+        preprocess=_add_content_type_meta
+    )
+
     @staticmethod
     def get_content(question, recipient_name, questioner_name, quote, quote_author, question_number=None):
-        current_date = datetime.now().strftime('%b %Y')
-        
         # If question_number is not provided, try to get it from the question object
         if question_number is None and isinstance(question, dict):
             question_number = question.get('id', 1)
@@ -20,34 +135,32 @@ class WeeklyQuestionEmail:
         issue_number = f"#{question_number:02d}"  # Format as 2 digits with leading zero
         issue_date = datetime.now().strftime('%B %d, %Y')
         
-        template_path = os.path.join(os.path.dirname(__file__), 'templates/weekly_question.html')
-        logger.debug(f"Template path: {template_path}")
-        
         try:
-            with open(template_path, 'r', encoding='utf-8') as file:
-                html_template = file.read()
-                
-            # Replace text placeholders
-            html = html_template.replace('{{recipient_name}}', recipient_name)
-            html = html.replace('{{questioner_name}}', questioner_name)
-            html = html.replace('{{question}}', question)
-            html = html.replace('{{quote}}', quote)
-            html = html.replace('{{quote_author}}', quote_author)
-            html = html.replace('{{issue_number}}', issue_number)
-            html = html.replace('{{issue_date}}', issue_date)
-            
-            # Add Content-Type meta tag if not present
-            if '<meta http-equiv="Content-Type"' not in html:
-                head_end = '</head>'
-                meta_tag = '<meta http-equiv="Content-Type" content="text/html; charset=UTF-8">\n'
-                html = html.replace(head_end, meta_tag + head_end)
-            
-            return html
+            return WeeklyQuestionEmail.template.render(
+                recipient_name=recipient_name,
+                questioner_name=questioner_name,
+                question=question,
+                quote=quote,
+                quote_author=quote_author,
+                issue_number=issue_number,
+                issue_date=issue_date
+            )
             
         except Exception as e:
-            logger.error(f"Failed to load weekly question template: {str(e)}")
+            logger.error("Failed to load weekly question template: %s", e)
             # Fall back to basic HTML template
-            return f"""
+            return WeeklyQuestionEmail.get_fallback_content(
+                question, recipient_name, questioner_name, quote, quote_author
+            )
+
+    @staticmethod
+    def get_fallback_content(question, recipient_name, questioner_name, quote, quote_author):
+        """Basic HTML used when the newsletter template can't be loaded"""
+        current_date = datetime.now().strftime('%b %Y')
+        recipient_name, questioner_name, question, quote, quote_author = (
+            html_lib.escape(str(value)) for value in (recipient_name, questioner_name, question, quote, quote_author)
+        )
+        return f"""
             <html>
                 <head>
                     <meta http-equiv="Content-Type" content="text/html; charset=UTF-8">
@@ -65,39 +178,47 @@ class WeeklyQuestionEmail:
             </html>
             """
 
+    @staticmethod
+    def get_parts(question, questioner_name, quote, quote_author, question_number=None):
+        """Render the shared body once, leaving recipient_name as a personalized slot"""
+        if question_number is None:
+            question_number = 1
+        try:
+            return WeeklyQuestionEmail.template.render_parts(
+                ('recipient_name',),
+                questioner_name=questioner_name,
+                question=question,
+                quote=quote,
+                quote_author=quote_author,
+                issue_number=f"#{question_number:02d}",
+                issue_date=datetime.now().strftime('%B %d, %Y')
+            )
+        except Exception as e:
+            logger.error("Failed to load weekly question template: %s", e)
+            # The fallback HTML escapes its values, so the placeholder survives and can be split back out
+            html = WeeklyQuestionEmail.get_fallback_content(
+                question, '{{recipient_name}}', questioner_name, quote, quote_author
+            )
+            return CompiledTemplate.PLACEHOLDER.split(html)
+
 class ConfirmationEmail:
+    template = CompiledTemplate(
+        os.path.join(TEMPLATE_DIR, 'confirmation_email.html'),
+        preprocess=_adapt_confirmation_template
+    )
+
     @staticmethod
     def get_content(recipient_name, question):
-        template_path = os.path.join(os.path.dirname(__file__), 'templates/confirmation_email.html')
-        logger.debug(f"Confirmation template path: {template_path}")
-        
         try:
-            with open(template_path, 'r', encoding='utf-8') as file:
-                html = file.read()
-                
-            # Replace content placeholders
-            current_date = datetime.now().strftime('%b %Y')
-            html = html.replace('Jan 2025', current_date)
-            
-            # Update message content
-            html = html.replace('Welcome to Family History', 'Thank You for Sharing')
-            html = html.replace('Thanks for signing up!', f'Response Received: "{question}"')
-            html = html.replace('Confirm your subscription', 'Your story has been saved')
-            html = html.replace('<a href="#insertUrlLink"', '<a href="#"')  # Remove subscription link functionality
-            html = html.replace('Yes, I want to subscribe', 'View Your Stories')
-            
-            # Update footer text
-            footer_text = """If you have any questions about your stored stories or need assistance accessing them, 
-                            you can reply to this email or contact us at familyhistory@mail.com."""
-            html = re.sub(r'If you didn\'t subscribe.*?familyhistory@mail\.com\.', 
-                         footer_text, 
-                         html, 
-                         flags=re.DOTALL)
-            
-            return html
+            return ConfirmationEmail.template.render(
+                recipient_name=recipient_name,
+                question=question,
+                current_date=datetime.now().strftime('%b %Y')
+            )
             
         except Exception as e:
-            logger.error(f"Failed to load confirmation template: {str(e)}")
+            logger.error("Failed to load confirmation template: %s", e)
+            recipient_name, question = html_lib.escape(str(recipient_name)), html_lib.escape(str(question))
             # Fall back to basic text template
             return f"""
             <html>
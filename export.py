@@ -0,0 +1,313 @@
+import html
+import json
+import logging
+import os
+import re
+from collections import OrderedDict
+from datetime import datetime
+from tenants import DEFAULT_FAMILY
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('jsonl', 'markdown', 'html', 'pdf')
+
+def _slug(value):
+    return re.sub(r'[^a-z0-9]+', '-', (value or 'unknown').lower()).strip('-') or 'unknown'
+
+def _date(value):
+    return f"{value:%B} {value.day}, {value.year}" if isinstance(value, datetime) else str(value or '')
+
+class _AppendFiles:
+    """Keep a bounded number of output files open for appending"""
+    MAX_OPEN = 32
+
+    def __init__(self):
+        self._files = OrderedDict()
+
+    def get(self, path):
+        if path in self._files:
+            self._files.move_to_end(path)
+            return self._files[path]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle = open(path, 'a', encoding='utf-8')
+        self._files[path] = handle
+        if len(self._files) > self.MAX_OPEN:
+            _, oldest = self._files.popitem(last=False)
+            oldest.close()
+        return handle
+
+    def flush(self):
+        for handle in self._files.values():
+            handle.flush()
+            os.fsync(handle.fileno())
+
+    def close(self):
+        for handle in self._files.values():
+            handle.close()
+        self._files.clear()
+
+class StoryExporter:
+    """Stream the responses collection into a story book.
+
+    Responses come off a server-side cursor ordered by question, then date,
+    and are appended to the output files as they arrive, so memory stays flat
+    however large the archive is. Outputs go to one directory per run:
+    stories.jsonl, members/<name>.md, book.html and, when WeasyPrint is
+    installed, book.pdf. Each exporter covers one family, under
+    <output_dir>/<family id>, with its own progress.
+
+    Progress is checkpointed in app_state together with each output file's
+    size. An interrupted run resumes from the checkpoint, with the files cut
+    back to the checkpointed sizes, so nothing is written twice. After a run
+    completes, the next one only exports responses stored since then.
+    """
+    BATCH_SIZE = 500
+    CHECKPOINT_EVERY = 1000
+    SORT = [("question_text", 1), ("response_date", 1), ("_id", 1)]
+    PROJECTION = {
+        "family_member_email": 1,
+        "family_member_name": 1,
+        "question_text": 1,
+        "response_date": 1,
+        "response_text": 1
+    }
+
+    def __init__(self, database, output_dir='exports', name='default', formats=FORMATS, family_id=DEFAULT_FAMILY):
+        self.db = database.db
+        self.family_id = family_id
+        self.output_dir = os.path.join(output_dir, _slug(family_id))
+        # The default family keeps the progress recorded before exports were per family
+        self.state_id = f"export:{name}" if family_id == DEFAULT_FAMILY else f"export:{name}:{family_id}"
+        self.formats = set(formats)
+        self.files = _AppendFiles()
+
+    def _load_state(self):
+        return self.db.app_state.find_one({"_id": self.state_id}) or {}
+
+    def _save_run(self, run):
+        self.db.app_state.update_one({"_id": self.state_id}, {"$set": {"run": run}}, upsert=True)
+
+    def _finish_run(self, run):
+        self.db.app_state.update_one(
+            {"_id": self.state_id},
+            {"$set": {"last_id": run["upper_id"], "completed_at": datetime.utcnow(), "last_run_dir": run["dir"]},
+             "$unset": {"run": ""}},
+            upsert=True
+        )
+
+    def _family_query(self):
+        # Responses stored before families existed have no family_id
+        return {"family_id": {"$in": [self.family_id, None]} if self.family_id == DEFAULT_FAMILY else self.family_id}
+
+    def _new_run(self, state, full):
+        latest = self.db.responses.find_one(self._family_query(), {"_id": 1}, sort=[("_id", -1)])
+        if latest is None:
+            return None
+        since_id = None if full else state.get("last_id")
+        if since_id is not None and latest["_id"] <= since_id:
+            return None
+        started = datetime.utcnow()
+        return {
+            "dir": os.path.join(self.output_dir, started.strftime('%Y%m%dT%H%M%S')),
+            "started_at": started,
+            "since_id": since_id,
+            # Responses stored after the run starts belong to the next one
+            "upper_id": latest["_id"],
+            "position": None,
+            "exported": 0,
+            "offsets": [],
+            "last_question": None,
+            "member_questions": {}
+        }
+
+    def _query(self, run):
+        id_range = {"$lte": run["upper_id"]}
+        if run["since_id"] is not None:
+            id_range["$gt"] = run["since_id"]
+        query = dict(self._family_query(), _id=id_range)
+        position = run["position"]
+        if position:
+            question, response_date, object_id = position
+            # Resume strictly after the last checkpointed response in (question, date, _id) order
+            query = {"$and": [query, {"$or": [
+                {"question_text": {"$gt": question}},
+                {"question_text": question, "response_date": {"$gt": response_date}},
+                {"question_text": question, "response_date": response_date, "_id": {"$gt": object_id}}
+            ]}]}
+        return query
+
+    def _path(self, run, *parts):
+        return os.path.join(run["dir"], *parts)
+
+    def _restore_files(self, run):
+        """Cut every output back to its size at the last checkpoint"""
+        if not os.path.isdir(run["dir"]):
+            return
+        offsets = dict(run["offsets"])
+        for root, _, filenames in os.walk(run["dir"]):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                size = offsets.get(os.path.relpath(path, run["dir"]))
+                if size is None:
+                    os.remove(path)
+                else:
+                    with open(path, 'r+b') as handle:
+                        handle.truncate(size)
+
+    def _checkpoint(self, run, document):
+        self.files.flush()
+        run["position"] = [document.get("question_text") or '', document["response_date"], document["_id"]]
+        # [relative path, size] pairs; file names aren't safe as Mongo field names
+        run["offsets"] = [
+            [os.path.relpath(os.path.join(root, filename), run["dir"]), os.path.getsize(os.path.join(root, filename))]
+            for root, _, filenames in os.walk(run["dir"]) for filename in filenames
+        ]
+        self._save_run(run)
+
+    def _write_jsonl(self, run, document):
+        record = {
+            "id": str(document["_id"]),
+            "email": document.get("family_member_email"),
+            "name": document.get("family_member_name"),
+            "question": document.get("question_text"),
+            "date": document["response_date"].isoformat() if isinstance(document.get("response_date"), datetime) else None,
+            "text": document.get("response_text")
+        }
+        self.files.get(self._path(run, 'stories.jsonl')).write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def _write_markdown(self, run, document):
+        name = document.get("family_member_name") or document.get("family_member_email")
+        key = _slug(document.get("family_member_email") or name)
+        path = self._path(run, 'members', f"{key}.md")
+        new_file = not os.path.exists(path)
+        handle = self.files.get(path)
+        if new_file:
+            handle.write(f"# Stories from {name}\n")
+        question = document.get("question_text") or "Untitled question"
+        if run["member_questions"].get(key) != question:
+            handle.write(f"\n## {question}\n")
+            run["member_questions"][key] = question
+        handle.write(f"\n*{_date(document.get('response_date'))}*\n\n{(document.get('response_text') or '').strip()}\n")
+
+    def _write_html(self, run, document):
+        path = self._path(run, 'book.html')
+        new_file = not os.path.exists(path)
+        handle = self.files.get(path)
+        if new_file:
+            handle.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>Family Stories</title>'
+                         '<style>body{font-family:Georgia,serif;max-width:40em;margin:auto}'
+                         'h2{page-break-before:always}article{margin:1.5em 0}'
+                         '.meta{color:#666;font-style:italic}</style></head>\n<body>\n<h1>Family Stories</h1>\n')
+        question = document.get("question_text") or "Untitled question"
+        if run["last_question"] != question:
+            handle.write(f"<h2>{html.escape(question)}</h2>\n")
+            run["last_question"] = question
+        paragraphs = ''.join(f"<p>{html.escape(paragraph)}</p>"
+                             for paragraph in re.split(r'\n\s*\n', (document.get('response_text') or '').strip()))
+        name = document.get("family_member_name") or document.get("family_member_email")
+        handle.write(f'<article><p class="meta">{html.escape(name or "")}, '
+                     f'{_date(document.get("response_date"))}</p>{paragraphs}</article>\n')
+
+    def _finish_html(self, run):
+        path = self._path(run, 'book.html')
+        if not os.path.exists(path):
+            return None
+        self.files.get(path).write('</body></html>\n')
+        self.files.close()
+        return path
+
+    def _write_pdf(self, run, html_path):
+        try:
+            from weasyprint import HTML
+        except ImportError:
+            logger.warning("WeasyPrint is not installed; skipping the PDF book (book.html is ready to print)")
+            return None
+        pdf_path = self._path(run, 'book.pdf')
+        HTML(filename=html_path).write_pdf(pdf_path)
+        return pdf_path
+
+    def export(self, full=False):
+        """Export new responses (or all with full=True), resuming an interrupted run. Returns the run directory."""
+        state = self._load_state()
+        run = state.get("run")
+        if run and not full:
+            logger.info("[%s] Resuming export into %s after %s responses", self.family_id, run['dir'], run['exported'])
+            self._restore_files(run)
+        else:
+            run = self._new_run(state, full)
+            if run is None:
+                logger.info("[%s] No new responses to export", self.family_id)
+                return None
+            logger.info("[%s] Exporting to %s", self.family_id, run['dir'])
+        os.makedirs(run["dir"], exist_ok=True)
+
+        writers = []
+        if 'jsonl' in self.formats:
+            writers.append(self._write_jsonl)
+        if 'markdown' in self.formats:
+            writers.append(self._write_markdown)
+        if self.formats & {'html', 'pdf'}:
+            writers.append(self._write_html)
+
+        cursor = self.db.responses.find(self._query(run), self.PROJECTION, batch_size=self.BATCH_SIZE).sort(self.SORT)
+        try:
+            document = None
+            since_checkpoint = 0
+            for document in cursor:
+                for write in writers:
+                    write(run, document)
+                run["exported"] += 1
+                since_checkpoint += 1
+                if since_checkpoint >= self.CHECKPOINT_EVERY:
+                    self._checkpoint(run, document)
+                    since_checkpoint = 0
+            if document is not None and since_checkpoint:
+                self._checkpoint(run, document)
+
+            html_path = self._finish_html(run) if self.formats & {'html', 'pdf'} else None
+            if html_path and 'pdf' in self.formats:
+                self._write_pdf(run, html_path)
+        except Exception as e:
+            logger.error("Export stopped after %s responses: %s", run['exported'], e)
+            raise
+        finally:
+            cursor.close()
+            self.files.close()
+
+        self._finish_run(run)
+        logger.info("[%s] Exported %s responses to %s", self.family_id, run['exported'], run['dir'])
+        return run["dir"]
+
+def main():
+    """Export the story archive"""
+    import argparse
+    from build.config import Config
+    from database import DatabaseManager
+    from logging_setup import configure_logging
+
+    parser = argparse.ArgumentParser(description="Export family stories to JSONL, Markdown and an HTML/PDF book")
+    parser.add_argument('--output', default='exports', help="directory to write exports under")
+    parser.add_argument('--full', action='store_true', help="export everything, not just responses since the last export")
+    parser.add_argument('--formats', default=','.join(FORMATS), help=f"comma-separated subset of {','.join(FORMATS)}")
+    parser.add_argument('--name', default='default', help="export name; each name tracks its own progress")
+    parser.add_argument('--family', action='append', help="family id to export (repeatable); defaults to every configured family")
+    args = parser.parse_args()
+
+    configure_logging()
+    formats = [value.strip() for value in args.formats.split(',') if value.strip()]
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        parser.error(f"unknown formats: {', '.join(sorted(unknown))}")
+
+    config = Config()
+    families = args.family or [str(settings.get('id', '')).lower() for settings in config.families_settings or []]
+    database = DatabaseManager(config)
+    try:
+        for family_id in families or [DEFAULT_FAMILY]:
+            StoryExporter(database, args.output, name=args.name, formats=formats,
+                          family_id=family_id.lower()).export(full=args.full)
+    finally:
+        database.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+DEFAULT_LEVEL = 'INFO'
+DEFAULT_RATE_LIMIT = 20  # records per message template per window; 0 turns limiting off
+DEFAULT_RATE_WINDOW = 60  # seconds
+
+# Attributes every LogRecord has; anything else came in through extra= and goes into the JSON
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with any extra= fields alongside the message"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class RateLimitFilter(logging.Filter):
+    """Let through at most `limit` records per message template per window.
+
+    Records are keyed on logger and unformatted message, so every
+    "Sent confirmation email to %s" line shares one budget however many
+    recipients there are. Warnings and errors always pass. When a window
+    closes, the next record from that template notes how many were dropped.
+    """
+
+    def __init__(self, limit=DEFAULT_RATE_LIMIT, window=DEFAULT_RATE_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self._windows = {}  # key -> [window start, records seen]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.limit:
+            return True
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            state = self._windows.get(key)
+            if state is None or now - state[0] >= self.window:
+                suppressed = state[1] - self.limit if state is not None and state[1] > self.limit else 0
+                self._windows[key] = [now, 1]
+                if suppressed:
+                    record.suppressed = suppressed
+                    record.msg = f"{record.msg} (and {suppressed} similar messages suppressed)"
+                return True
+            state[1] += 1
+            return state[1] <= self.limit
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
+
+    The stock prepare() runs the whole formatter on the calling thread. Here
+    only the args are merged, so the message reflects them as they were when
+    logged, even if they change before the listener gets to the record.
+    Timestamps, tracebacks and JSON are still rendered on the listener, and
+    extra= fields are kept for JsonFormatter.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+_listener = None
+
+def _env(name, default):
+    value = os.getenv(name)
+    return default if value is None else value.strip()
+
+def configure_logging(level=None, log_format=None, rate_limit=None, rate_window=None, stream=None):
+    """Route all logging through a queue to a single writer thread.
+
+    Unset arguments come from the environment: LOG_LEVEL (default INFO),
+    LOG_FORMAT ("text" or "json"), LOG_RATE_LIMIT and LOG_RATE_WINDOW.
+    Safe to call more than once; the previous listener is stopped first.
+    """
+    global _listener
+    level = (level or _env('LOG_LEVEL', DEFAULT_LEVEL)).upper()
+    log_format = (log_format or _env('LOG_FORMAT', 'text')).lower()
+    if rate_limit is None:
+        rate_limit = int(_env('LOG_RATE_LIMIT', DEFAULT_RATE_LIMIT))
+    if rate_window is None:
+        rate_window = float(_env('LOG_RATE_WINDOW', DEFAULT_RATE_WINDOW))
+
+    stop_logging()
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    records = queue.SimpleQueue()
+    handler = _DeferredQueueHandler(records)
+    handler.addFilter(RateLimitFilter(rate_limit, rate_window))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+def stop_logging():
+    """Flush queued records and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register(stop_logging)
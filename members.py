@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+from build.assets import FORWARD_DIGEST, FORWARD_IMMEDIATE
+
+logger = logging.getLogger(__name__)
+
+class MemberDirectory:
+    """In-process index of family members by email and delivery preference.
+
+    Membership and preferences come from the family members CSV; names stored
+    in the family_members collection take precedence. Once the TTL expires the
+    indexes are rebuilt on a background thread, so callers never wait on
+    Mongo for a name or a recipient list.
+    """
+    DEFAULT_TTL = 300  # seconds
+
+    def __init__(self, config, database=None, ttl=DEFAULT_TTL, csv_file='assets/emails.csv'):
+        self.config = config
+        self.database = database
+        self.ttl = ttl
+        self.csv_file = csv_file
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        # (by_email, names, question_recipients, forward_recipients), swapped as a whole
+        self._indexes = ({}, {}, (), ())
+        self.refresh()
+
+    def _load_members(self):
+        return self.config.load_family_members(self.csv_file)
+
+    def _load_names(self):
+        if self.database is None:
+            return {}
+        try:
+            members = self.database.db.family_members.find({}, {'_id': 0, 'email': 1, 'name': 1})
+            return {member['email'].lower(): member['name'] for member in members if member.get('email')}
+        except Exception as e:
+            logger.error("Failed to load family member names: %s", e)
+            return {}
+
+    def refresh(self, members=None):
+        """Rebuild every index, from the given members or by reloading the CSV"""
+        if members is None:
+            members = self._load_members()
+            if not members and self._indexes[0]:
+                logger.warning("Family members list came back empty, keeping the previous list")
+                return
+        names = self._load_names()
+
+        by_email = {}
+        for member in members:
+            key = member['email'].lower()
+            if key in names:
+                member = dict(member, name=names[key])
+            by_email[key] = member
+        for key, member in by_email.items():
+            names.setdefault(key, member['name'])
+
+        question_recipients = tuple(member for member in by_email.values() if member.get('receive_questions', True))
+        forward_recipients = tuple(member for member in by_email.values() if member.get('receive_forwards', True))
+
+        with self._lock:
+            self._indexes = (by_email, names, question_recipients, forward_recipients)
+            self._loaded_at = time.monotonic()
+        logger.info("Loaded %s family members (%s receive questions, %s receive forwards)",
+                    len(by_email), len(question_recipients), len(forward_recipients))
+
+    def _current(self):
+        if self.ttl and time.monotonic() - self._loaded_at > self.ttl:
+            # Let one caller refresh while everyone else keeps using the current indexes
+            if self._lock.acquire(blocking=False):
+                self._loaded_at = time.monotonic()
+                self._lock.release()
+                threading.Thread(target=self._safe_refresh, name='member-refresh', daemon=True).start()
+        return self._indexes
+
+    def _safe_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error("Failed to refresh member directory: %s", e)
+
+    @property
+    def members(self):
+        return list(self._current()[0].values())
+
+    def get(self, email):
+        """Get a member by email address, or None"""
+        return self._current()[0].get(email.lower())
+
+    def get_name(self, email):
+        """Get a member's name by email address, or None"""
+        return self._current()[1].get(email.lower())
+
+    def get_names(self, emails):
+        """Map each known email address to the member's name"""
+        names = self._current()[1]
+        return {email: names[email.lower()] for email in emails if email.lower() in names}
+
+    def question_recipients(self):
+        """Members who receive the weekly question"""
+        return list(self._current()[2])
+
+    @staticmethod
+    def forward_mode(member):
+        """FORWARD_DIGEST or FORWARD_IMMEDIATE; anything unrecognised gets immediate forwards"""
+        return FORWARD_DIGEST if member.get('forward_mode') == FORWARD_DIGEST else FORWARD_IMMEDIATE
+
+    def forward_recipients(self, exclude=None, mode=None):
+        """Members who receive forwarded responses, optionally leaving out the sender.
+
+        mode limits the list to members taking immediate forwards or digests.
+        """
+        recipients = self._current()[3]
+        if mode is not None:
+            recipients = [member for member in recipients if self.forward_mode(member) == mode]
+        if exclude is None:
+            return list(recipients)
+        exclude = exclude.lower()
+        return [member for member in recipients if member['email'].lower() != exclude]
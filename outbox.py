@@ -0,0 +1,244 @@
+import logging
+import os
+import socket
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+class Outbox:
+    """Durable queue of outbound email jobs in the outbox collection.
+
+    Every job has a caller-chosen _id (its idempotency key), so queueing the
+    same email twice is a no-op. Workers claim jobs with a time-limited lease;
+    a job whose worker died is picked up again once the lease expires.
+    """
+    MAX_ATTEMPTS = 8
+    BASE_BACKOFF = 30  # seconds, doubled after each failed attempt
+    MAX_BACKOFF = 6 * 60 * 60  # seconds
+    LEASE_SECONDS = 120
+    DUPLICATE_KEY_ERROR = 11000
+
+    def __init__(self, database, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.collection = database.db.outbox
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Indexes for claiming jobs are created by the schema migrations (schema.py)
+
+    @staticmethod
+    def _job(key, kind, recipient_email, payload):
+        now = datetime.utcnow()
+        return {
+            "_id": key,
+            "kind": kind,
+            "recipient_email": recipient_email,
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "created_at": now,
+            "updated_at": now
+        }
+
+    def enqueue(self, key, kind, recipient_email, payload):
+        """Queue one email. Returns False if a job with this key already exists."""
+        try:
+            self.collection.insert_one(self._job(key, kind, recipient_email, payload))
+            return True
+        except DuplicateKeyError:
+            logger.info("Outbox job %s already queued, skipping", key)
+            return False
+
+    def enqueue_many(self, jobs):
+        """Queue (key, kind, recipient_email, payload) tuples with one write. Returns how many were new."""
+        documents = [self._job(*job) for job in jobs]
+        if not documents:
+            return 0
+        try:
+            return len(self.collection.insert_many(documents, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if any(error['code'] != self.DUPLICATE_KEY_ERROR for error in errors):
+                raise
+            logger.info("Skipped %s outbox jobs that were already queued", len(errors))
+            return e.details.get('nInserted', len(documents) - len(errors))
+
+    def claim(self, worker_id):
+        """Lease the next due job to worker_id, or return None if nothing is due"""
+        now = datetime.utcnow()
+        return self.collection.find_one_and_update(
+            {"$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                # A worker that claimed this died before finishing
+                {"status": "sending", "lease_expires_at": {"$lte": now}}
+            ]},
+            {"$set": {
+                "status": "sending",
+                "lease_owner": worker_id,
+                "lease_expires_at": now + timedelta(seconds=self.lease_seconds),
+                "updated_at": now
+            }},
+            sort=[("next_attempt_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def complete(self, job):
+        """Record a successful delivery"""
+        now = datetime.utcnow()
+        self.collection.update_one(
+            {"_id": job["_id"], "lease_owner": job["lease_owner"]},
+            {"$set": {"status": "sent", "sent_at": now, "updated_at": now},
+             "$unset": {"lease_owner": "", "lease_expires_at": "", "last_error": ""},
+             "$inc": {"attempts": 1}}
+        )
+
+    def fail(self, job, error):
+        """Record a failed attempt and schedule a retry with exponential backoff"""
+        now = datetime.utcnow()
+        attempts = job.get("attempts", 0) + 1
+        update = {"attempts": attempts, "last_error": error, "updated_at": now}
+        if attempts >= self.max_attempts:
+            update["status"] = "failed"
+            logger.error("Outbox job %s failed permanently after %s attempts: %s", job['_id'], attempts, error)
+        else:
+            delay = min(self.BASE_BACKOFF * 2 ** (attempts - 1), self.MAX_BACKOFF)
+            update["status"] = "pending"
+            update["next_attempt_at"] = now + timedelta(seconds=delay)
+            logger.warning("Outbox job %s failed (attempt %s), retrying in %s seconds: %s",
+                           job['_id'], attempts, delay, error)
+        self.collection.update_one(
+            {"_id": job["_id"], "lease_owner": job["lease_owner"]},
+            {"$set": update, "$unset": {"lease_owner": "", "lease_expires_at": ""}}
+        )
+
+class DeliveryWorker:
+    """Claims outbox jobs and sends them through an EmailSender"""
+    POLL_INTERVAL = 5  # seconds to wait when the outbox is empty
+    PREPARED_CACHE_SIZE = 32
+
+    def __init__(self, outbox, email_sender, poll_interval=POLL_INTERVAL, worker_id=None):
+        self.outbox = outbox
+        self.email_sender = email_sender
+        self.poll_interval = poll_interval
+        # Unique per worker, not per thread: every worker is built on the main thread, and the lease
+        # owner is what stops a worker whose lease expired from completing a sibling's re-claim
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:12]}"
+        # Shared bodies (the newsletter, one forward) are encoded once per worker, not per job
+        self._prepared = OrderedDict()
+        self.handlers = {
+            "weekly_question": self._send_weekly_question,
+            "confirmation": self._send_confirmation,
+            "forward": self._send_forward,
+            "digest": self._send_digest
+        }
+
+    def _cached(self, key, build):
+        if key not in self._prepared:
+            self._prepared[key] = build()
+            if len(self._prepared) > self.PREPARED_CACHE_SIZE:
+                self._prepared.popitem(last=False)
+        return self._prepared[key]
+
+    def _send_weekly_question(self, job):
+        payload = job["payload"]
+        prepared = self._cached(
+            ("weekly_question", payload.get("family_id"), payload["question_number"], payload["question"], payload["quote"]),
+            lambda: self.email_sender.prepare_weekly_question(
+                questioner_name=payload["questioner_name"],
+                question=payload["question"],
+                quote=payload["quote"],
+                quote_author=payload["quote_author"],
+                question_number=payload["question_number"],
+                reply_to=payload.get("reply_to"),
+                msgid_token=payload.get("msgid_token")
+            )
+        )
+        self.email_sender.send_prepared(prepared, job["recipient_email"], recipient_name=payload["recipient_name"])
+
+    def _send_confirmation(self, job):
+        payload = job["payload"]
+        self.email_sender.send_confirmation(job["recipient_email"], payload["recipient_name"], payload["question"])
+
+    def _send_forward(self, job):
+        payload = job["payload"]
+        prepared = self._cached(
+            ("forward", payload["response_key"]),
+            lambda: self.email_sender.prepare_forward(
+                payload["sender_name"], payload["response_text"], payload["question"],
+                payload.get("attachments")
+            )
+        )
+        self.email_sender.send_prepared(prepared, job["recipient_email"])
+
+    def _send_digest(self, job):
+        payload = job["payload"]
+        prepared = self._cached(
+            ("digest", payload["body_key"]),
+            lambda: self.email_sender.prepare_digest(payload["family_name"], payload["groups"])
+        )
+        self.email_sender.send_prepared(prepared, job["recipient_email"])
+
+    def process_one(self):
+        """Claim and deliver a single job. Returns False when nothing was due."""
+        job = self.outbox.claim(self.worker_id)
+        if job is None:
+            return False
+        try:
+            self.handlers[job["kind"]](job)
+        except Exception as e:
+            self.outbox.fail(job, str(e))
+        else:
+            self.outbox.complete(job)
+            logger.info("Delivered outbox job %s", job['_id'])
+        return True
+
+    def run(self, stop_event):
+        """Deliver jobs until stop_event is set"""
+        logger.info("Outbox worker %s started", self.worker_id)
+        while not stop_event.is_set():
+            try:
+                if not self.process_one():
+                    stop_event.wait(self.poll_interval)
+            except Exception as e:
+                logger.error("Outbox worker error: %s", e)
+                stop_event.wait(self.poll_interval)
+        logger.info("Outbox worker %s stopped", self.worker_id)
+
+def main():
+    """Run delivery workers in their own process, alongside or instead of the app's"""
+    import signal
+    from build.config import Config
+    from database import DatabaseManager
+    from emails.sender import EmailSender
+    from logging_setup import configure_logging
+
+    configure_logging()
+    config = Config()
+    database = DatabaseManager(config)
+    email_sender = EmailSender.from_config(config)
+    outbox = Outbox(database, lease_seconds=config.outbox_settings.get('lease_seconds', Outbox.LEASE_SECONDS))
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+
+    workers = [
+        threading.Thread(
+            target=DeliveryWorker(outbox, email_sender, config.outbox_settings.get('poll_interval', DeliveryWorker.POLL_INTERVAL)).run,
+            args=(stop_event,),
+            name=f'outbox-worker-{index}'
+        )
+        for index in range(config.outbox_settings.get('workers', 2))
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    email_sender.close()
+    database.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+import logging
+import queue
+import threading
+import time
+import weakref
+from emails.extraction import ReplyExtractor
+from build.assets import FORWARD_IMMEDIATE
+import metrics
+
+logger = logging.getLogger(__name__)
+
+STAGE_SECONDS = metrics.histogram(
+    'family_stories_pipeline_stage_seconds', 'Time one reply (or one store batch) spends in a pipeline stage', ('stage',))
+
+class ResponseBatch:
+    """Tracks one group of replies through the pipeline.
+
+    wait_stored() returns once every reply is in the database, which is when
+    it is safe to move the mailbox high-water mark; wait_done() also waits
+    for the confirmations and forwards. Both give up after DEFAULT_TIMEOUT
+    unless told otherwise, and fail straight away if the pipeline stops.
+    """
+    DEFAULT_TIMEOUT = 300  # seconds
+
+    def __init__(self, size):
+        self._lock = threading.Lock()
+        self._unstored = size
+        self._pending = 0
+        self.error = None
+        self.results = []
+        self.stored = threading.Event()
+        self.done = threading.Event()
+        if size == 0:
+            self.stored.set()
+            self.done.set()
+
+    def _mark_stored(self, results):
+        with self._lock:
+            self.results.extend(results)
+            self._unstored -= len(results)
+            finished = self._unstored <= 0
+        if finished:
+            self.stored.set()
+            self._check_done()
+
+    def _fail(self, error, abandon=False):
+        # abandon also gives up on fan-out tasks that will never run, e.g. on shutdown
+        with self._lock:
+            if self.error is None:
+                self.error = error
+            self._unstored = 0
+            if abandon:
+                self._pending = 0
+        self.stored.set()
+        self._check_done()
+
+    def _add_tasks(self, count):
+        with self._lock:
+            self._pending += count
+
+    def _finish_task(self):
+        with self._lock:
+            self._pending -= 1
+        self._check_done()
+
+    def _check_done(self):
+        with self._lock:
+            finished = self._unstored <= 0 and self._pending <= 0
+        if finished:
+            self.done.set()
+
+    def wait_stored(self, timeout=DEFAULT_TIMEOUT):
+        """Block until every reply is stored; raises if storing failed"""
+        if not self.stored.wait(timeout):
+            raise TimeoutError("Timed out waiting for responses to be stored")
+        if self.error is not None:
+            raise self.error
+        return self.results
+
+    def wait_done(self, timeout=DEFAULT_TIMEOUT):
+        """Block until every reply is stored and all of its emails are sent or queued"""
+        self.wait_stored(timeout)
+        return self.done.wait(timeout)
+
+class ResponsePipeline:
+    """Staged processing of incoming replies: parse -> store -> fan-out.
+
+    The receiver's fetch feeds the first queue. Each stage has its own worker
+    threads and a bounded queue in front of it, so a slow SMTP call only ties
+    up one fan-out worker and a burst of replies pushes back on the fetch
+    instead of piling up in memory. Confirmations and forwards go out as
+    separate tasks, one per recipient, so they run concurrently across replies.
+
+    Each reply travels with the Family it was routed to, which supplies the
+    question it answers, the sender's name and the forward recipients.
+    """
+    PARSE_WORKERS = 2
+    STORE_BATCH_SIZE = 50
+    FANOUT_WORKERS = 8
+    QUEUE_SIZE = 100
+    STOP_CHECK_INTERVAL = 1  # seconds between stop checks while a worker waits
+
+    def __init__(self, email_sender, database, queue_emails=None,
+                 parse_workers=PARSE_WORKERS, store_batch_size=STORE_BATCH_SIZE,
+                 fanout_workers=FANOUT_WORKERS, queue_size=QUEUE_SIZE):
+        self.email_sender = email_sender
+        self.database = database
+        # With the outbox enabled, fan-out queues jobs instead of sending directly
+        self.queue_emails = queue_emails
+        self.parse_workers = parse_workers
+        self.store_batch_size = store_batch_size
+        self.fanout_workers = fanout_workers
+        self.parse_queue = queue.Queue(maxsize=queue_size)
+        self.store_queue = queue.Queue(maxsize=queue_size)
+        self.fanout_queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = None
+        self.threads = []
+        # Batches still in flight, so stop() can fail them instead of leaving callers waiting
+        self._batches = weakref.WeakSet()
+        self._batches_lock = threading.Lock()
+
+    def start(self, stop_event):
+        """Start every stage's workers; they exit once stop_event is set"""
+        self.stop_event = stop_event
+        stages = [('parse', self._parse_worker, self.parse_workers),
+                  ('store', self._store_worker, 1),
+                  ('fanout', self._fanout_worker, self.fanout_workers)]
+        for stage, target, count in stages:
+            for index in range(count):
+                thread = threading.Thread(target=target, name=f'pipeline-{stage}-{index}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        logger.info("Started response pipeline (%s parse, 1 store, %s fan-out workers)",
+                    self.parse_workers, self.fanout_workers)
+
+    def stop(self, timeout=None):
+        """Fail every batch still in flight and wait up to timeout for the workers to exit"""
+        if self.stop_event is None:
+            return
+        self.stop_event.set()
+        with self._batches_lock:
+            batches = list(self._batches)
+        for batch in batches:
+            batch._fail(RuntimeError("Response pipeline stopped"), abandon=True)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        alive = [thread.name for thread in self.threads if thread.is_alive()]
+        if alive:
+            logger.warning("Pipeline workers still running after stop: %s", ', '.join(alive))
+
+    @staticmethod
+    def _drop(items):
+        """Fail the batches of items that can't move on because the pipeline is stopping"""
+        for batch in {id(item[0]): item[0] for item in items}.values():
+            batch._fail(RuntimeError("Response pipeline stopped"), abandon=True)
+
+    def _put(self, target_queue, item):
+        # Block while the next stage is backed up, but give up on shutdown
+        while not self.stop_event.is_set():
+            try:
+                target_queue.put(item, timeout=self.STOP_CHECK_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source_queue):
+        while not self.stop_event.is_set():
+            try:
+                return source_queue.get(timeout=self.STOP_CHECK_INTERVAL)
+            except queue.Empty:
+                continue
+        return None
+
+    def submit(self, routed):
+        """Feed fetched replies, as (response, family) pairs, into the pipeline and return their ResponseBatch"""
+        if self.stop_event is None:
+            raise RuntimeError("Response pipeline has not been started")
+        batch = ResponseBatch(len(routed))
+        with self._batches_lock:
+            self._batches.add(batch)
+        logger.info("Found %s new responses", len(routed))
+        for response, family in routed:
+            # Replies are filed under the question the family is on when they arrive
+            _, question, _ = family.current_selection()
+            if not self._put(self.parse_queue, (batch, response, family, question)):
+                batch._fail(RuntimeError("Response pipeline stopped"), abandon=True)
+                break
+        return batch
+
+    def _parse_worker(self):
+        while True:
+            item = self._get(self.parse_queue)
+            if item is None:
+                return
+            response, family = item[1], item[2]
+            with STAGE_SECONDS.time(stage='parse'), \
+                    metrics.span('reply.parse', message_id=response.get('message_id'), family=family.id):
+                try:
+                    # Keep only what the person wrote; the quoted newsletter stays in raw_text
+                    response['response_text'] = ReplyExtractor.extract(response['raw_text'], response['content_type'])
+                except Exception as e:
+                    logger.error("Failed to extract reply text from %s: %s", response['email'], e)
+                    response['response_text'] = response['raw_text']
+            if not self._put(self.store_queue, item):
+                self._drop([item])
+
+    def _drain_store_queue(self, first):
+        items = [first]
+        while len(items) < self.store_batch_size:
+            try:
+                items.append(self.store_queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _store_worker(self):
+        while True:
+            first = self._get(self.store_queue)
+            if first is None:
+                return
+            # Store whatever has queued up in one write per family and question
+            groups = {}
+            for item in self._drain_store_queue(first):
+                groups.setdefault((item[2].id, item[3]['question']), []).append(item)
+            for items in groups.values():
+                with STAGE_SECONDS.time(stage='store'), \
+                        metrics.span('reply.store', replies=len(items), family=items[0][2].id):
+                    self._store(items)
+
+    def _store(self, items):
+        responses = [item[1] for item in items]
+        _, _, family, question = items[0]
+        try:
+            stored = self.database.store_responses(
+                responses,
+                question=question,
+                names=family.members.get_names(response['email'] for response in responses),
+                family_id=family.id
+            )
+        except Exception as e:
+            logger.error("Failed to store %s responses: %s", len(responses), e)
+            for batch in {id(item[0]): item[0] for item in items}.values():
+                batch._fail(e)
+            return
+
+        for (batch, response, family, question), result in zip(items, stored):
+            try:
+                tasks = self._fanout_tasks(response, result, family, question['question'])
+            except Exception as e:
+                logger.error("Failed to prepare emails for response from %s: %s", response['email'], e)
+                tasks = []
+            batch._add_tasks(len(tasks))
+            batch._mark_stored([result])
+            for task in tasks:
+                if not self._put(self.fanout_queue, (batch, task, result['message_id'])):
+                    self._drop(items)
+                    return
+
+    def _fanout_tasks(self, response, result, family, question):
+        """Break a stored reply into independent send (or queue) tasks"""
+        sender_name = result['family_member_name'] or 'Family Member'
+
+        if self.queue_emails is not None:
+            # Outbox keys are idempotent, so re-queueing for a duplicate is safe and
+            # covers a crash between storing the response and queueing its emails
+            return [lambda: self.queue_emails(response, result, sender_name, question, family)]
+
+        if result['duplicate']:
+            logger.info("Response from %s was already stored, skipping", response['email'])
+            return []
+        logger.info("Processing response from %s", response['email'])
+
+        tasks = [lambda: self._send_confirmation(response['email'], sender_name, question)]
+        # Forward the response to family members who have receive_forwards set to True (except the sender);
+        # members on a digest get it in their next one instead
+        recipients = family.members.forward_recipients(exclude=response['email'], mode=FORWARD_IMMEDIATE)
+        if recipients:
+            prepared = self.email_sender.prepare_forward(
+                sender_name, response['response_text'], question, response.get('attachments')
+            )
+            for recipient in recipients:
+                tasks.append(lambda email=recipient['email']: self._send_forward(prepared, response['email'], email))
+        return tasks
+
+    def _send_confirmation(self, email, sender_name, question):
+        try:
+            self.email_sender.send_confirmation(email, sender_name, question)
+            logger.info("Sent confirmation email to %s", email)
+        except Exception as e:
+            logger.error("Failed to send confirmation email: %s", e)
+
+    def _send_forward(self, prepared, sender_email, recipient_email):
+        try:
+            self.email_sender.send_prepared(prepared, recipient_email)
+            logger.info("Forwarded response from %s to %s", sender_email, recipient_email)
+        except Exception as e:
+            logger.error("Failed to forward response to %s: %s", recipient_email, e)
+
+    def _fanout_worker(self):
+        while True:
+            item = self._get(self.fanout_queue)
+            if item is None:
+                return
+            batch, task, message_id = item
+            try:
+                with STAGE_SECONDS.time(stage='fanout'), metrics.span('reply.fanout', message_id=message_id):
+                    task()
+            except Exception as e:
+                logger.error("Response fan-out task failed: %s", e)
+            finally:
+                batch._finish_task()
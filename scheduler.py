@@ -0,0 +1,204 @@
+import heapq
+import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, time as dt_time
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+def _parse_time(value):
+    hour, minute = (int(part) for part in value.split(':'))
+    return dt_time(hour, minute)
+
+def _parse_days(days):
+    if days is None:
+        return None
+    if isinstance(days, str):
+        days = [days]
+    return {WEEKDAYS.index(day.lower()) for day in days}
+
+class _CalendarRule:
+    """Base for rules evaluated in a local time zone on selected weekdays"""
+    LOOKAHEAD_DAYS = 8
+
+    def __init__(self, days=None, timezone=None):
+        self.days = _parse_days(days)
+        # None means the process's local time zone
+        self.tz = ZoneInfo(timezone) if timezone else None
+
+    def _now(self, now):
+        if now is None:
+            now = datetime.now(self.tz) if self.tz else datetime.now().astimezone()
+        return now.astimezone(self.tz) if self.tz else now.astimezone()
+
+    def _local(self, day, at):
+        local = datetime.combine(day, at)
+        return local.replace(tzinfo=self.tz) if self.tz else local.astimezone()
+
+    def _run_days(self, now):
+        for offset in range(self.LOOKAHEAD_DAYS):
+            day = (now + timedelta(days=offset)).date()
+            if self.days is None or day.weekday() in self.days:
+                yield day
+
+class TimeOfDayRule(_CalendarRule):
+    """Runs at a fixed local time, e.g. Sundays at 06:00"""
+
+    def __init__(self, at, days=None, timezone=None):
+        super().__init__(days, timezone)
+        self.at = _parse_time(at)
+
+    def next_after(self, now=None):
+        now = self._now(now)
+        for day in self._run_days(now):
+            candidate = self._local(day, self.at)
+            if candidate > now:
+                return candidate
+        return None
+
+    def last_at_or_before(self, now=None):
+        """The most recent scheduled run up to now, or None"""
+        now = self._now(now)
+        for offset in range(self.LOOKAHEAD_DAYS):
+            day = (now - timedelta(days=offset)).date()
+            if self.days is None or day.weekday() in self.days:
+                candidate = self._local(day, self.at)
+                if candidate <= now:
+                    return candidate
+        return None
+
+    def __repr__(self):
+        return f"TimeOfDayRule(at={self.at:%H:%M}, days={self.days}, tz={self.tz})"
+
+class WindowRule(_CalendarRule):
+    """Runs every N minutes inside a daily window, e.g. every 15 minutes 06:00-22:00"""
+
+    def __init__(self, every_minutes, start='00:00', end='23:59', days=None, timezone=None):
+        super().__init__(days, timezone)
+        self.interval = timedelta(minutes=every_minutes)
+        self.start = _parse_time(start)
+        self.end = _parse_time(end)
+
+    def contains(self, now=None):
+        """Whether now falls inside today's window"""
+        now = self._now(now)
+        if self.days is not None and now.weekday() not in self.days:
+            return False
+        return self.start <= now.time() < self.end
+
+    def next_after(self, now=None):
+        now = self._now(now)
+        for day in self._run_days(now):
+            start, end = self._local(day, self.start), self._local(day, self.end)
+            if now >= end:
+                continue
+            if now < start:
+                return start
+            steps = (now - start) // self.interval + 1
+            candidate = start + steps * self.interval
+            if candidate < end:
+                return candidate
+        return None
+
+    def __repr__(self):
+        return (f"WindowRule(every={self.interval}, window={self.start:%H:%M}-{self.end:%H:%M}, "
+                f"days={self.days}, tz={self.tz})")
+
+class IntervalRule:
+    """Runs every N seconds, for housekeeping jobs"""
+
+    def __init__(self, seconds):
+        self.interval = timedelta(seconds=seconds)
+
+    def next_after(self, now=None):
+        return (now or datetime.now().astimezone()) + self.interval
+
+    def __repr__(self):
+        return f"IntervalRule(every={self.interval})"
+
+class Scheduler:
+    """Heap-based scheduler that sleeps exactly until the next due job.
+
+    Jobs run on a thread pool, so a long job doesn't delay the others; a job
+    that is still running when it comes due again is skipped for that slot.
+    Call stop() after setting the stop event to wake the loop immediately.
+    """
+    DEFAULT_WORKERS = 4
+
+    def __init__(self, max_workers=DEFAULT_WORKERS):
+        self.max_workers = max_workers
+        self._heap = []
+        self._counter = itertools.count()
+        self._running = set()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._wakeup = threading.Event()
+
+    def add(self, name, rule, func):
+        """Schedule func to run whenever rule next fires"""
+        next_run = rule.next_after()
+        if next_run is None:
+            logger.warning("Job %s has no upcoming run for %r, not scheduling it", name, rule)
+            return
+        with self._lock:
+            heapq.heappush(self._heap, (next_run.timestamp(), next(self._counter), name, rule, func))
+        logger.info("Scheduled %s (%r), next run at %s", name, rule, next_run.isoformat())
+        # Let a running loop recompute its sleep
+        self._wakeup.set()
+
+    def _run_job(self, name, func):
+        try:
+            func()
+        except Exception as e:
+            logger.error("Scheduled job %s failed: %s", name, e)
+        finally:
+            with self._lock:
+                self._running.discard(name)
+                self._idle.notify_all()
+
+    def run(self, stop_event):
+        """Run due jobs until stop_event is set"""
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='scheduler')
+        try:
+            while not stop_event.is_set():
+                with self._lock:
+                    due_at = self._heap[0][0] if self._heap else None
+                now = datetime.now().astimezone().timestamp()
+
+                if due_at is None or due_at > now:
+                    # Sleep until the next job is due; add() and stop() cut the wait short
+                    self._wakeup.wait(None if due_at is None else due_at - now)
+                    self._wakeup.clear()
+                    continue
+
+                with self._lock:
+                    _, _, name, rule, func = heapq.heappop(self._heap)
+                    already_running = name in self._running
+                    if not already_running:
+                        self._running.add(name)
+
+                if already_running:
+                    logger.warning("Skipping %s: previous run still in progress", name)
+                else:
+                    executor.submit(self._run_job, name, func)
+
+                next_run = rule.next_after()
+                if next_run is not None:
+                    with self._lock:
+                        heapq.heappush(self._heap, (next_run.timestamp(), next(self._counter), name, rule, func))
+        finally:
+            # Don't hold up shutdown on a job that's mid-run
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stop(self):
+        """Wake the run loop so it notices the stop event"""
+        self._wakeup.set()
+
+    def wait_idle(self, timeout=None):
+        """Wait for jobs that are mid-run to finish. Returns False if some are still running."""
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._running, timeout)
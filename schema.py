@@ -0,0 +1,203 @@
+import logging
+from datetime import datetime
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+INDEX_NOT_FOUND = 27
+
+def index_name(keys):
+    """The name Mongo gives an index by default, e.g. response_date_-1"""
+    return '_'.join(f"{field}_{direction}" for field, direction in keys)
+
+class Index:
+    """One index a migration wants to exist"""
+
+    def __init__(self, collection, keys, **options):
+        self.collection = collection
+        self.keys = keys
+        self.options = options
+        self.name = options.get('name') or index_name(keys)
+
+    def __repr__(self):
+        return f"{self.collection}.{self.name}"
+
+class Migration:
+    """A numbered schema step: indexes to create and index names to drop"""
+
+    def __init__(self, version, description, create=(), drop=()):
+        self.version = version
+        self.description = description
+        self.create = list(create)
+        self.drop = list(drop)  # (collection, index name)
+
+MESSAGE_ID_UNIQUE = {"unique": True, "partialFilterExpression": {"message_id": {"$type": "string"}}}
+
+MIGRATIONS = [
+    Migration(1, "Baseline indexes", create=[
+        Index('responses', [("question_id", 1), ("family_member_email", 1), ("response_date", -1)]),
+        Index('responses', [("response_text", "text")]),
+        # Idempotency key so a retried batch can't store the same email twice
+        Index('responses', [("message_id", 1)], **MESSAGE_ID_UNIQUE),
+        Index('raw_responses', [("message_id", 1)], **MESSAGE_ID_UNIQUE),
+        Index('family_members', [("email", 1)], unique=True),
+        Index('family_members', [("name", 1)]),
+        # Claimable outbox jobs
+        Index('outbox', [("status", 1), ("next_attempt_at", 1)]),
+        Index('outbox', [("status", 1), ("lease_expires_at", 1)]),
+    ]),
+    Migration(2, "Drop single-field response indexes nothing queries", drop=[
+        # Never used by a query; they only added work to every insert
+        ('responses', 'question_text_1'),
+        ('responses', 'family_member_name_1'),
+        ('responses', 'response_date_-1'),
+    ]),
+    Migration(3, "Keyset indexes for reading the story archive", create=[
+        # Each filter the archive offers, followed by its (response_date, _id) sort
+        Index('responses', [("response_date", -1), ("_id", -1)]),
+        Index('responses', [("family_member_email", 1), ("response_date", -1), ("_id", -1)]),
+        Index('responses', [("question_text", 1), ("response_date", -1), ("_id", -1)]),
+    ], drop=[
+        # Led by question_id, which is never set, so no query could use it
+        ('responses', 'question_id_1_family_member_email_1_response_date_-1'),
+    ]),
+    Migration(4, "Serve question-ordered export from the question index", create=[
+        # Ascending, for exporting question by question in date order; the archive's
+        # newest-first reads within one question walk the same index backwards
+        Index('responses', [("question_text", 1), ("response_date", 1), ("_id", 1)]),
+    ], drop=[
+        ('responses', 'question_text_1_response_date_-1__id_-1'),
+    ]),
+    Migration(5, "Deduplicate reply attachments by content hash", create=[
+        # Set once an upload finishes, so a second copy of the same file can't be kept
+        Index('attachments.files', [("metadata.sha256", 1)],
+              unique=True, partialFilterExpression={"metadata.sha256": {"$type": "string"}}),
+    ]),
+    Migration(6, "Read a family's replies by date for reply digests", create=[
+        Index('responses', [("family_id", 1), ("response_date", 1)]),
+    ]),
+]
+
+class SchemaManager:
+    """Applies MIGRATIONS in order and records the version reached in app_state.
+
+    When the stored version is current, startup costs a single find_one.
+    Indexes are only built when index_information() shows they are missing,
+    so re-running a migration (two processes starting at once) is harmless.
+    """
+    STATE_ID = "schema"
+
+    def __init__(self, db, migrations=MIGRATIONS):
+        self.db = db
+        self.migrations = sorted(migrations, key=lambda migration: migration.version)
+
+    @property
+    def latest_version(self):
+        return self.migrations[-1].version if self.migrations else 0
+
+    def current_version(self):
+        state = self.db.app_state.find_one({"_id": self.STATE_ID})
+        return state.get("version", 0) if state else 0
+
+    def _record_version(self, version):
+        self.db.app_state.update_one(
+            {"_id": self.STATE_ID},
+            {"$max": {"version": version}, "$set": {"updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+    def _existing_indexes(self, collection, cache):
+        if collection not in cache:
+            cache[collection] = set(self.db[collection].index_information())
+        return cache[collection]
+
+    def _apply(self, migration):
+        existing = {}
+        for index in migration.create:
+            if index.name in self._existing_indexes(index.collection, existing):
+                continue
+            logger.info("Creating index %r", index)
+            self.db[index.collection].create_index(index.keys, **index.options)
+            existing[index.collection].add(index.name)
+        for collection, name in migration.drop:
+            if name not in self._existing_indexes(collection, existing):
+                continue
+            logger.info("Dropping index %s.%s", collection, name)
+            try:
+                self.db[collection].drop_index(name)
+            except OperationFailure as e:
+                # Another process dropped it first
+                if e.code != INDEX_NOT_FOUND:
+                    raise
+            existing[collection].discard(name)
+
+    def migrate(self):
+        """Bring the database up to the latest schema version. Returns the version reached."""
+        version = self.current_version()
+        if version >= self.latest_version:
+            logger.debug("Database schema is current (version %s)", version)
+            return version
+        for migration in self.migrations:
+            if migration.version <= version:
+                continue
+            logger.info("Applying schema migration %s: %s", migration.version, migration.description)
+            try:
+                self._apply(migration)
+            except Exception as e:
+                logger.error("Schema migration %s failed: %s", migration.version, e)
+                raise
+            self._record_version(migration.version)
+            version = migration.version
+        return version
+
+    def unused_indexes(self, collections=None):
+        """List indexes with no recorded use since the server started, via $indexStats.
+
+        Counters reset on server restart, so check after a representative run.
+        """
+        if collections is None:
+            collections = sorted({index.collection for migration in self.migrations for index in migration.create})
+        unused = []
+        for collection in collections:
+            for stats in self.db[collection].aggregate([{"$indexStats": {}}]):
+                if stats['name'] == '_id_' or stats['accesses']['ops'] > 0:
+                    continue
+                unused.append({
+                    'collection': collection,
+                    'name': stats['name'],
+                    'since': stats['accesses'].get('since')
+                })
+        return unused
+
+    def report_unused_indexes(self, collections=None):
+        """Log unused indexes and return them"""
+        unused = self.unused_indexes(collections)
+        for index in unused:
+            logger.warning("Index %s.%s has not been used since %s", index['collection'], index['name'], index['since'])
+        if not unused:
+            logger.info("All indexes have been used")
+        return unused
+
+def main():
+    """Apply pending migrations and report unused indexes"""
+    import argparse
+    from build.config import Config
+    from database import DatabaseManager
+    from logging_setup import configure_logging
+
+    parser = argparse.ArgumentParser(description="Manage the Family Stories database schema")
+    parser.add_argument('--unused', action='store_true', help="report indexes $indexStats shows as unused")
+    args = parser.parse_args()
+
+    configure_logging()
+    database = DatabaseManager(Config())
+    try:
+        schema = SchemaManager(database.db)
+        logger.info("Database schema is at version %s", schema.current_version())
+        if args.unused:
+            schema.report_unused_indexes()
+    finally:
+        database.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import logging
+import re
+import threading
+from collections import OrderedDict
+from build.assets import Question, Quote, Member, validate_questions, validate_quotes, validate_members
+from members import MemberDirectory
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FAMILY = 'default'
+FAMILY_ID_PATTERN = re.compile(r'^[a-z0-9][a-z0-9_-]{0,62}$')
+# make_msgid(idstring='fs-<id>') puts the token just before the '@'
+MSGID_TOKEN_PATTERN = re.compile(r'\.fs-([a-z0-9][a-z0-9_-]*)@', re.IGNORECASE)
+
+def plus_address(address, tag):
+    """user@example.com + tag -> user+tag@example.com"""
+    local, _, domain = address.partition('@')
+    return f"{local.split('+')[0]}+{tag}@{domain}" if domain else address
+
+class Family:
+    """One family's questions, quotes, members, schedule and question cursor.
+
+    questions, quotes and current_question_index are read and replaced
+    together under one lock, since an asset reload can swap them mid-run.
+    """
+
+    def __init__(self, family_id, config, database, settings=None, reply_address=None):
+        settings = settings or {}
+        if not FAMILY_ID_PATTERN.match(family_id):
+            raise ValueError(f"Invalid family id {family_id!r}: use lowercase letters, digits, '-' and '_'")
+        self.id = family_id
+        self.name = settings.get('name') or family_id
+        self.database = database
+        self.questions_file = settings.get('questions', 'assets/questions.csv')
+        self.quotes_file = settings.get('quotes', 'assets/quotes.csv')
+        self.members_file = settings.get('members', 'assets/emails.csv')
+
+        schedule = config.schedule_settings
+        self.timezone = settings.get('timezone', schedule.get('timezone'))
+        self.weekly_question = dict(schedule.get('weekly_question') or {}, **(settings.get('weekly_question') or {}))
+        self.digest = dict(schedule.get('digest') or {}, **(settings.get('digest') or {}))
+
+        # Replies come back to user+<family>@domain; the Message-ID carries the id as a fallback
+        self.reply_to = plus_address(reply_address, family_id) if reply_address else None
+        self.msgid_token = f"fs-{family_id}" if reply_address else None
+
+        self._lock = threading.Lock()
+        self.questions = config.load_questions(self.questions_file)
+        self.quotes = config.load_quotes(self.quotes_file)
+        self.members = MemberDirectory(
+            config,
+            database=database,
+            ttl=config.member_settings.get('cache_ttl', MemberDirectory.DEFAULT_TTL),
+            csv_file=self.members_file
+        )
+        self.current_question_index = database.get_or_create_question_index(family_id)
+        if self.questions:
+            # The CSV may have been shortened while the app was down
+            self.swap_questions(self.questions)
+
+    def __repr__(self):
+        return f"Family({self.id!r})"
+
+    def swap_questions(self, questions):
+        """Swap in a reloaded question list, keeping the current index inside it"""
+        with self._lock:
+            self.questions = questions
+            if self.current_question_index >= len(questions):
+                logger.warning("[%s] Question list shrank to %s; moving from question #%s back to #1",
+                               self.id, len(questions), self.current_question_index + 1)
+                self.current_question_index = 0
+                self.database.update_question_index(0, questions[0], self.id)
+
+    def swap_quotes(self, quotes):
+        with self._lock:
+            self.quotes = quotes
+
+    def current_selection(self):
+        """The current question index, question and quote, read together"""
+        with self._lock:
+            index = self.current_question_index
+            return index, self.questions[index], self.quotes[index % len(self.quotes)]
+
+    def advance_question(self):
+        if not self.questions:
+            logger.error("[%s] Cannot advance question: No questions loaded", self.id)
+            return False
+
+        with self._lock:
+            self.current_question_index = (self.current_question_index + 1) % len(self.questions)
+            self.database.update_question_index(
+                self.current_question_index,
+                self.questions[self.current_question_index],
+                self.id
+            )
+        return True
+
+    def watch_assets(self, watcher):
+        """Register this family's CSVs with an AssetWatcher"""
+        watcher.watch(f'{self.id} questions', self.questions_file, Question, self.swap_questions, validate_questions)
+        watcher.watch(f'{self.id} quotes', self.quotes_file, Quote, self.swap_quotes, validate_quotes)
+        watcher.watch(f'{self.id} family members', self.members_file, Member, self.members.refresh, validate_members)
+
+def load_families(config, database):
+    """Build every configured family, keyed by id, in config order.
+
+    Without a families: section this is the single 'default' family on the
+    original asset paths, using the legacy question_index state document.
+    """
+    settings = config.families_settings
+    if not settings:
+        return OrderedDict([(DEFAULT_FAMILY, Family(DEFAULT_FAMILY, config, database))])
+
+    reply_address = config.email_settings.get('reply_address') or config.email_settings['username']
+    families = OrderedDict()
+    for family_settings in settings:
+        family_id = str(family_settings.get('id', '')).lower()
+        if family_id in families:
+            raise ValueError(f"Family {family_id} is configured twice")
+        families[family_id] = Family(family_id, config, database, family_settings, reply_address)
+    logger.info("Loaded %s families: %s", len(families), ', '.join(families))
+    return families
+
+class FamilyRouter:
+    """Work out which family a reply belongs to.
+
+    Checked in order: an X-Family-Stories-Family header, a +family tag on
+    any recipient address, the family token in In-Reply-To/References, and
+    finally the sender's membership when it is in exactly one family. Anything
+    still unresolved goes to the first family.
+    """
+
+    def __init__(self, families):
+        self.families = families
+        self.fallback = next(iter(families.values()))
+
+    def _from_recipients(self, recipients):
+        for address in recipients or ():
+            local = address.partition('@')[0]
+            if '+' in local:
+                family = self.families.get(local.split('+', 1)[1].lower())
+                if family is not None:
+                    return family
+        return None
+
+    def _from_references(self, references):
+        for token in MSGID_TOKEN_PATTERN.findall(references or ''):
+            family = self.families.get(token.lower())
+            if family is not None:
+                return family
+        return None
+
+    def _from_sender(self, email):
+        matches = [family for family in self.families.values() if family.members.get(email) is not None]
+        return matches[0] if len(matches) == 1 else None
+
+    def route(self, response):
+        if len(self.families) == 1:
+            return self.fallback
+        family = (self.families.get((response.get('family_header') or '').strip().lower())
+                  or self._from_recipients(response.get('recipients'))
+                  or self._from_references(response.get('references'))
+                  or self._from_sender(response['email']))
+        if family is None:
+            logger.warning("Could not tell which family a reply from %s belongs to; filing it under %s",
+                           response['email'], self.fallback.id)
+            return self.fallback
+        return family
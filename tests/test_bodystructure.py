@@ -0,0 +1,26 @@
+from emails.bodystructure import parse_fetch_response, walk_parts
+
+
+def test_quoted_paren_is_a_string_not_a_list():
+    fetch_data = [
+        b'1 (UID 7 BODYSTRUCTURE (("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 12 1 NIL NIL NIL)'
+        b'("APPLICATION" "OCTET-STREAM" ("NAME" ")") NIL NIL "BASE64" 400 NIL '
+        b'("ATTACHMENT" ("FILENAME" "(")) NIL) "MIXED"))'
+    ]
+    structure = parse_fetch_response(fetch_data)[7]['BODYSTRUCTURE']
+    parts = list(walk_parts(structure))
+    assert [part['section'] for part in parts] == ['1', '2']
+    assert parts[1]['content_type'] == 'application/octet-stream'
+    assert parts[1]['filename'] == '('
+    assert parts[1]['size'] == 400
+
+
+def test_literal_paren_is_a_string_not_a_list():
+    fetch_data = [
+        (b'1 (UID 8 BODYSTRUCTURE ("APPLICATION" "PDF" ("NAME" {1}', b')'),
+        b') NIL NIL "BASE64" 99 NIL NIL NIL NIL))'
+    ]
+    structure = parse_fetch_response(fetch_data)[8]['BODYSTRUCTURE']
+    part, = walk_parts(structure)
+    assert part['filename'] == ')'
+    assert part['size'] == 99
@@ -0,0 +1,22 @@
+import pytest
+from emails.extraction import ReplyExtractor
+
+
+def test_story_line_starting_with_sent_from_my_is_kept():
+    body = ("We lived on a farm.\n"
+            "Sent from my grandmother's kitchen table, I still remember the smell of bread.\n"
+            "Every Sunday we walked to church.")
+    assert ReplyExtractor.extract(body) == body
+
+
+@pytest.mark.parametrize('signature', [
+    'Sent from my iPhone',
+    'Sent from my Samsung Galaxy smartphone.',
+    'Sent from my Android device',
+    'Sent from Yahoo Mail on Android',
+    'Sent from Mail for Windows 10',
+    'Get Outlook for iOS<https://aka.ms/o0ukef>',
+])
+def test_mobile_signature_is_cut(signature):
+    body = f"We lived on a farm.\n\n{signature}\n\nOn Sun, Jun 2, 2024 at 6:00 AM Family Stories wrote:\n> Question"
+    assert ReplyExtractor.extract(body) == "We lived on a farm."